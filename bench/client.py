@@ -0,0 +1,136 @@
+"""
+Builds the messages a Terraria client sends, for the synthetic capture
+generator and the bot swarm.
+"""
+
+import struct
+
+from game.player import Player
+from net.messages import ConnectionRequestMessage, \
+    PlayerInfoMessage, PlayerHpMessage, PlayerManaMessage, \
+    PlayerBuffMessage, PlayerInventoryMessage, RequestWorldDataMessage, \
+    TileBlockRequestMessage, SpawnMessage, PlayerUpdateMessage
+from net.protocols import PROTOCOL_VERSION
+
+INVENTORY_SLOTS = 10
+# Pixels per tile, for converting tile coordinates to positions
+TILE_SIZE = 16.0
+# Pixels moved per update when walking
+WALK_SPEED = 3.0
+
+# Player control flags
+CONTROL_LEFT = 4
+CONTROL_RIGHT = 8
+
+# Offset of the spawn coordinates in a WorldDataMessage payload
+WORLD_SPAWN_OFFSET = 15
+
+
+class ClientSession(object):
+    """
+    The client side of a session: just the player the messages are
+    built from (or parsed into, by the microbenchmarks).
+    """
+
+    def __init__(self, playerId, name):
+        self.reusableMessages = {}
+        self.player = Player()
+        self.player.playerId = playerId
+        self.player.name = name
+        self.player.hair = 3
+        self.player.hairDye = 0
+        for color in ('hairColor', 'skinColor', 'eyeColor', 'shirtColor',
+                      'underShirtColor', 'pantsColor', 'shoeColor'):
+            setattr(self.player, color, (0x80, 0x80, 0x80))
+        self.player.life = self.player.lifeMax = 100
+        self.player.mana = self.player.manaMax = 20
+
+
+def connectionRequest():
+    message = ConnectionRequestMessage()
+    message.clientVersion = PROTOCOL_VERSION
+    return message.serialize()
+
+
+def playerData(session):
+    """
+    Returns the frames sent in answer to a RequestPlayerDataMessage,
+    ending with the world data request.
+    """
+
+    frames = [
+        PlayerInfoMessage(session).serialize(),
+        PlayerHpMessage(session).serialize(),
+        PlayerManaMessage(session).serialize(),
+        PlayerBuffMessage(session).serialize(),
+    ]
+    for slot in xrange(INVENTORY_SLOTS):
+        message = PlayerInventoryMessage(session)
+        message.slot = slot
+        message.stack = 1
+        message.itemId = slot + 1
+        frames.append(message.serialize())
+    frames.append(RequestWorldDataMessage().serialize())
+    return frames
+
+
+def tileBlockRequest(x, y):
+    message = TileBlockRequestMessage()
+    message.tileX = x
+    message.tileY = y
+    return message.serialize()
+
+
+def spawn(session, x, y):
+    session.player.spawn = (x, y)
+    session.player.position = (x * TILE_SIZE, y * TILE_SIZE)
+    return SpawnMessage(session).serialize()
+
+
+def playerUpdate(session):
+    return PlayerUpdateMessage(session).serialize()
+
+
+def worldSpawn(payload):
+    """
+    Reads the spawn tile from the payload of a WorldDataMessage.
+    """
+
+    return struct.unpack_from("<ii", payload, WORLD_SPAWN_OFFSET)
+
+
+def still(player, rand):
+    player.velocity = (0.0, 0.0)
+    player.control = 0
+
+
+def patrol(player, rand):
+    """
+    Walks back and forth, turning around now and then.
+    """
+
+    vx = player.velocity[0] or WALK_SPEED
+    if rand.random() < 0.02:
+        vx = -vx
+    player.velocity = (vx, 0.0)
+    player.control = CONTROL_RIGHT if vx > 0 else CONTROL_LEFT
+    player.position = (player.position[0] + vx, player.position[1])
+
+
+def wander(player, rand):
+    """
+    Walks and falls in random directions.
+    """
+
+    vx = rand.uniform(-WALK_SPEED, WALK_SPEED)
+    vy = rand.uniform(-WALK_SPEED, WALK_SPEED)
+    player.velocity = (vx, vy)
+    player.control = CONTROL_RIGHT if vx > 0 else CONTROL_LEFT
+    player.position = (player.position[0] + vx, player.position[1] + vy)
+
+
+MOVEMENT_PATTERNS = {
+    'still': still,
+    'patrol': patrol,
+    'wander': wander,
+}
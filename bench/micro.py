@@ -0,0 +1,438 @@
+"""
+Microbenchmarks for the message codec and world code, checked against a
+stored baseline.
+
+Each benchmark is run for at least --min-time seconds, best of a few
+runs, and reports operations per second and the net number of garbage
+collected objects left allocated per operation, including whatever the
+operation's result keeps alive (counted with the collector disabled,
+so other objects freed straight away do not show up).
+
+Speeds are not compared as they are, since they depend on the machine:
+every run also times L{REFERENCE}, a plain Python loop using none of
+the server's code, and a benchmark's speed is compared as a multiple of
+the reference's speed in the same run. Allocating more than the
+baseline fails the run. Being more than --tolerance slower than the
+baseline, relative to the reference, is reported, and only fails the
+run with --strict: timings on a shared or busy machine still vary by
+more than that between benchmarks.
+
+After a change which is meant to make a benchmark slower or faster, or
+to add a benchmark, regenerate the baseline on an otherwise idle
+machine and commit it with the change:
+
+    python -m bench.micro --update
+
+Usage: python -m bench.micro [--update] [--strict] [--baseline path]
+    [name ...]
+"""
+
+import atexit
+import gc
+import json
+import os
+import struct
+import sys
+import tempfile
+from optparse import OptionParser
+from timeit import default_timer
+
+from twisted.internet.address import IPv4Address
+
+from bench import client
+from bench.replay import NullTransport
+from config.server import ServerConfig
+from game.tiles import Tile, TileSection, airTile, ironTile, \
+    SECTION_WIDTH, SECTION_HEIGHT
+from net.factories import TerrariaFactory
+from net.messages import ChatMessage, TileConfirmMessage, \
+    TileSectionMessage, WorldDataMessage
+from net.parsers import BinaryMessageParser
+from net.protocols import BinaryMessageProtocol
+from net.server import tmpDebugWorldRemoveMe
+from util.readers import WorldFileReader
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Allowed slowdown relative to the reference, as a fraction of the
+# baseline
+TOLERANCE = 0.25
+# Objects per operation allowed on top of the tolerance, so tiny counts
+# do not fail on noise
+ALLOCATION_SLACK = 1.0
+REPEATS = 5
+MIN_TIME = 0.2
+
+BROADCAST_CLIENTS = (10, 100, 250)
+FRAMES_PER_STREAM = 100
+FRAGMENT_SIZE = 7
+
+# name -> setup function returning the operation to time
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+REFERENCE = "reference loop"
+
+
+@benchmark(REFERENCE)
+def referenceLoop():
+    def loop():
+        total = 0
+        for i in xrange(100):
+            total += i * i
+        return total
+    return loop
+
+
+def sectionRow(tile):
+    message = TileSectionMessage()
+    message.x = 0
+    message.y = 0
+    message.tiles = [tile] * SECTION_WIDTH
+    return message.serialize
+
+
+@benchmark("serialize air row")
+def serializeAir():
+    return sectionRow(airTile)
+
+
+@benchmark("serialize dense row")
+def serializeDense():
+    return sectionRow(ironTile)
+
+
+@benchmark("serialize important row")
+def serializeImportant():
+    # trees have frame coordinates
+    return sectionRow(Tile(
+        5, frameX=22, frameY=66, wall=2, liquid=0, isLighted=True,
+        active=True))
+
+
+@benchmark("serialize chat")
+def serializeChat():
+    message = ChatMessage()
+    message.text = "The quick brown fox jumps over the lazy dog"
+    return message.serialize
+
+
+@benchmark("serialize world data")
+def serializeWorldData():
+    message = WorldDataMessage()
+    message.world = tmpDebugWorldRemoveMe()
+    return message.serialize
+
+
+@benchmark("serialize tile confirm")
+def serializeTileConfirm():
+    message = TileConfirmMessage()
+    message.startX, message.startY, message.endX, message.endY = 1, 2, 5, 4
+    return message.serialize
+
+
+def inboundFrames():
+    session = client.ClientSession(1, "bench")
+    frames = [client.connectionRequest()]
+    frames.extend(client.playerData(session))
+    frames.append(client.tileBlockRequest(100, 199))
+    frames.append(client.spawn(session, 100, 199))
+    frames.append(client.playerUpdate(session))
+    return session, frames
+
+
+def _parseSetup(frame, session):
+    parser = BinaryMessageParser()
+    messageRaw = bytearray(frame[BinaryMessageProtocol.headerFormatLen:])
+    return lambda: parser.parse(messageRaw, session)
+
+
+def _registerParsers():
+    session, frames = inboundFrames()
+    seen = set()
+    for frame in frames:
+        messageType = ord(frame[BinaryMessageProtocol.headerFormatLen])
+        if messageType in seen:
+            continue
+        seen.add(messageType)
+        parsed = BinaryMessageParser().parse(
+            bytearray(frame[BinaryMessageProtocol.headerFormatLen:]), session)
+        benchmark("parse %s" % (parsed.__class__.__name__,))(
+            lambda frame=frame: _parseSetup(frame, session))
+
+_registerParsers()
+
+
+class FramingProtocol(BinaryMessageProtocol):
+    """
+    Parses messages and drops them, to time framing and parsing alone.
+    """
+
+    def __init__(self):
+        BinaryMessageProtocol.__init__(self, BinaryMessageParser(), self)
+        self.player = client.ClientSession(1, "bench").player
+        self.reusableMessages = {}
+        self.received = 0
+
+    def startReceivingMessages(self, sender):
+        pass
+
+    def messageReceived(self, message):
+        self.received += 1
+
+
+def _framingSetup(chunkSize):
+    session = client.ClientSession(1, "bench")
+    stream = client.playerUpdate(session) * FRAMES_PER_STREAM
+    if chunkSize is None:
+        chunks = [stream]
+    else:
+        chunks = [stream[i:i + chunkSize]
+                  for i in xrange(0, len(stream), chunkSize)]
+    protocol = FramingProtocol()
+    protocol.makeConnection(NullTransport(IPv4Address('TCP', '127.0.0.1', 1)))
+
+    def feed():
+        for chunk in chunks:
+            protocol.dataReceived(chunk)
+    return feed
+
+
+@benchmark("dataReceived coalesced x%d" % (FRAMES_PER_STREAM,))
+def framingCoalesced():
+    return _framingSetup(None)
+
+
+@benchmark("dataReceived per frame x%d" % (FRAMES_PER_STREAM,))
+def framingPerFrame():
+    return _framingSetup(len(client.playerUpdate(
+        client.ClientSession(1, "bench"))))
+
+
+@benchmark("dataReceived fragmented x%d" % (FRAMES_PER_STREAM,))
+def framingFragmented():
+    return _framingSetup(FRAGMENT_SIZE)
+
+
+@benchmark("setTile fill section")
+def fillSection():
+    def fill():
+        section = TileSection()
+        for y in xrange(SECTION_HEIGHT):
+            for x in xrange(SECTION_WIDTH):
+                section.setTile(x, y, ironTile)
+    return fill
+
+
+@benchmark("world snapshot and release")
+def worldSnapshot():
+    world = tmpDebugWorldRemoveMe()
+    return lambda: world.snapshot().release()
+
+
+@benchmark("getSectionsInBlockAround")
+def sectionsAround():
+    world = tmpDebugWorldRemoveMe()
+    section = world.getSectionAt(world.spawn)
+    return lambda: list(world.getSectionsInBlockAround(section))
+
+
+def _writeWorldHeader(path):
+    header = struct.pack("<i", 39)
+    header += chr(5) + "Bench"
+    header += struct.pack("<iiiiiiiii", 1, 0, 16800, 0, 9600, 600, 800,
+                          100, 199)
+    header += struct.pack("<ddd?i?", 200.0, 400.0, 13500.0, True, 0, False)
+    # bosses, saved NPCs and later bosses
+    header += struct.pack("<ii?????????", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    header += struct.pack("<??Bi?", 0, 0, 0, 0, 0)
+    header += struct.pack("<iiid", 0, 0, 0, 0.0)
+    with open(path, "wb") as f:
+        f.write(header)
+
+
+@benchmark("read world header")
+def readWorldHeader():
+    fd, path = tempfile.mkstemp(suffix=".wld")
+    os.close(fd)
+    atexit.register(os.remove, path)
+    _writeWorldHeader(path)
+    return WorldFileReader(path).readWorld
+
+
+def _broadcastSetup(clients):
+    config = ServerConfig()
+    config.serverPassword = ""
+    factory = TerrariaFactory(tmpDebugWorldRemoveMe(), config)
+    for i in xrange(clients):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(
+            NullTransport(IPv4Address('TCP', '127.0.0.1', 10000 + i)))
+    message = ChatMessage()
+    message.text = "The quick brown fox jumps over the lazy dog"
+    return lambda: factory.protocolManager.sendMessageToAllProtocols(message)
+
+
+def _registerBroadcasts():
+    for clients in BROADCAST_CLIENTS:
+        benchmark("broadcast chat to %d" % (clients,))(
+            lambda clients=clients: _broadcastSetup(clients))
+
+_registerBroadcasts()
+
+
+def runOps(op, iterations):
+    """
+    Runs C{op} C{iterations} times, keeping every result until the end
+    so that what a parsed message holds on to is counted.
+
+    @return: the elapsed time and the net number of objects tracked by
+        the garbage collector that were allocated per call
+    """
+
+    results = [None] * iterations
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        start = default_timer()
+        for i in xrange(iterations):
+            results[i] = op()
+        elapsed = default_timer() - start
+        allocated = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return elapsed, float(allocated) / iterations
+
+
+def measure(op, minTime):
+    """
+    Picks an iteration count taking about C{minTime} seconds, then keeps
+    the best of L{REPEATS} runs.
+
+    @return: C{(opsPerSec, allocationsPerOp)}
+    """
+
+    iterations = 1
+    while True:
+        elapsed, allocations = runOps(op, iterations)
+        if elapsed >= minTime:
+            break
+        if elapsed <= 0:
+            iterations *= 10
+        else:
+            iterations = max(
+                iterations + 1, int(iterations * minTime * 1.2 / elapsed))
+    best = elapsed
+    for i in xrange(REPEATS - 1):
+        elapsed, runAllocations = runOps(op, iterations)
+        best = min(best, elapsed)
+        allocations = min(allocations, runAllocations)
+    return iterations / best, allocations
+
+
+def compare(name, result, baseline, scale, tolerance):
+    """
+    @param scale: How much faster the reference ran than in the baseline.
+
+    @return: C{(slower, allocating)}, lists of reasons C{result} regressed
+        from C{baseline} in speed and in allocations
+    """
+
+    opsPerSec, allocations = result
+    slower = []
+    allocating = []
+    expected = baseline['opsPerSec'] * scale
+    if opsPerSec < expected * (1 - tolerance):
+        slower.append("%s: %.0f ops/s, baseline %.0f at this speed" % (
+            name, opsPerSec, expected))
+    if allocations > baseline['allocationsPerOp'] * (1 + tolerance) + \
+            ALLOCATION_SLACK:
+        allocating.append("%s: %.1f objects/op, baseline %.1f" % (
+            name, allocations, baseline['allocationsPerOp']))
+    return slower, allocating
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] [name ...]")
+    parser.add_option("--baseline", default=BASELINE_PATH,
+                      help="baseline JSON file")
+    parser.add_option("--update", action="store_true", default=False,
+                      help="write the results as the new baseline")
+    parser.add_option("--strict", action="store_true", default=False,
+                      help="fail on slower benchmarks, not only on ones "
+                      "allocating more")
+    parser.add_option("--tolerance", type="float", default=TOLERANCE,
+                      help="allowed slowdown relative to the reference, as "
+                      "a fraction of the baseline")
+    parser.add_option("--min-time", type="float", default=MIN_TIME,
+                      help="seconds to run each benchmark for")
+    options, names = parser.parse_args(argv[1:])
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    slower = []
+    allocating = []
+    print "%-36s %14s %10s %9s" % ("benchmark", "ops/s", "objs/op", "change")
+    scale = None
+    for name, setup in BENCHMARKS:
+        # the reference always runs, the others are scaled by it
+        if names and name != REFERENCE and \
+                not [n for n in names if n in name]:
+            continue
+        results[name] = measure(setup(), options.min_time)
+        opsPerSec, allocations = results[name]
+        change = ""
+        if name == REFERENCE:
+            if name in baseline:
+                scale = opsPerSec / baseline[name]['opsPerSec']
+                change = "x%.2f" % (scale,)
+        elif name in baseline and scale is not None:
+            change = "%+.1f%%" % (
+                (opsPerSec / (baseline[name]['opsPerSec'] * scale) - 1)
+                * 100,)
+            benchmarkSlower, benchmarkAllocating = compare(
+                name, results[name], baseline[name], scale,
+                options.tolerance)
+            slower.extend(benchmarkSlower)
+            allocating.extend(benchmarkAllocating)
+        print "%-36s %14.1f %10.1f %9s" % (
+            name, opsPerSec, allocations, change)
+
+    if options.update:
+        for name, (opsPerSec, allocations) in results.iteritems():
+            baseline[name] = {
+                'opsPerSec': round(opsPerSec, 1),
+                'allocationsPerOp': round(allocations, 2),
+            }
+        with open(options.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            f.write("\n")
+        print "baseline written to %s" % (options.baseline,)
+        return 0
+
+    for title, problems in (("Slower:", slower),
+                            ("Allocating more:", allocating)):
+        if problems:
+            print
+            print title
+            for problem in problems:
+                print "  " + problem
+    if allocating or (slower and options.strict):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,151 @@
+"""
+Replays a capture (see L{net.capture}) through L{TerrariaProtocol}s on
+fake transports and reports message throughput and per-type parse and
+handle latency. Handlers run inline rather than in the reactor thread
+pool, so the numbers cover parsing, handling and serializing replies.
+
+Usage: python -m bench.replay [--timed] [--repeat N] capture
+"""
+
+import sys
+import time
+from optparse import OptionParser
+from timeit import default_timer
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from config.server import ServerConfig
+from net.capture import readCapture, OPENED, DATA, CLOSED
+from net.factories import TerrariaFactory
+from net.handlers import MessageHandlerLocator
+from net.server import tmpDebugWorldRemoveMe
+from util.metrics import registry
+
+
+class InlineHandlerLocator(MessageHandlerLocator):
+    """
+    Runs handlers straight away instead of in the reactor thread pool.
+    """
+
+    def locateHandler(self, message, messageHandler=None):
+        if messageHandler is None:
+            messageHandler = self.messageHandler
+        try:
+            handlerFunc = self.handlerLookup[message.__class__]
+        except KeyError:
+            return None
+        return maybeDeferred(handlerFunc, messageHandler, message)
+
+
+class NullTransport(StringTransport):
+    """
+    A transport which counts the bytes written to it and throws them away.
+    """
+
+    def __init__(self, peer):
+        StringTransport.__init__(self, peerAddress=peer)
+        self.client = (peer.host, peer.port)
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+class Replay(object):
+    """
+    Feeds the sessions of a capture into protocols built by a
+    L{TerrariaFactory}.
+
+    @ivar timed: Whether to wait between records as long as was recorded,
+        instead of replaying as fast as possible.
+    """
+
+    def __init__(self, factory, timed=False):
+        self.factory = factory
+        self.timed = timed
+        self.protocols = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.sessions = 0
+
+    def _open(self, session):
+        protocol = self.factory.buildProtocol(None)
+        transport = NullTransport(
+            IPv4Address('TCP', '127.0.0.1', 10000 + session % 50000))
+        protocol.makeConnection(transport)
+        self.protocols[session] = protocol
+        self.sessions += 1
+
+    def _close(self, session):
+        protocol = self.protocols.pop(session)
+        self.bytesOut += protocol.transport.written
+        protocol.connectionLost(Failure(ConnectionDone()))
+
+    def run(self, records):
+        start = default_timer()
+        for when, session, kind, data in records:
+            if self.timed:
+                delay = start + when - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == OPENED:
+                self._open(session)
+            elif kind == DATA:
+                self.bytesIn += len(data)
+                self.protocols[session].dataReceived(data)
+            elif kind == CLOSED:
+                self._close(session)
+        for session in self.protocols.keys():
+            self._close(session)
+        return default_timer() - start
+
+
+def report(replay, elapsed):
+    received = sum(s.received for s in registry.messages.itervalues())
+    print "%d sessions, %d messages, %d bytes in, %d bytes out in %.3fs" % (
+        replay.sessions, received, replay.bytesIn, replay.bytesOut, elapsed)
+    print "%.0f messages/s, %.0f bytes/s in, %.0f bytes/s out" % (
+        received / elapsed, replay.bytesIn / elapsed,
+        replay.bytesOut / elapsed)
+    print "%-26s %8s %10s %10s %10s %10s" % (
+        "type", "count", "parse us", "p99 us", "handle us", "p99 us")
+    for s in sorted(registry.messages.itervalues(), key=lambda s: s.name):
+        if not s.received:
+            continue
+        print "%-26s %8d %10.1f %10.1f %10.1f %10.1f" % (
+            s.name, s.received, s.parse.mean() * 1e6,
+            s.parse.percentile(0.99) * 1e6, s.handle.mean() * 1e6,
+            s.handle.percentile(0.99) * 1e6)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [--timed] [--repeat N] capture")
+    parser.add_option(
+        "--timed", action="store_true", default=False,
+        help="replay at the recorded timing instead of full speed")
+    parser.add_option(
+        "--repeat", type="int", default=1,
+        help="number of times to replay the capture")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("expected one capture file")
+
+    records = list(readCapture(args[0]))
+    config = ServerConfig()
+    config.serverPassword = ""
+    factory = TerrariaFactory(tmpDebugWorldRemoveMe(), config)
+    factory.messageHandlerLocator = InlineHandlerLocator()
+
+    replay = Replay(factory, options.timed)
+    elapsed = 0.0
+    for i in xrange(options.repeat):
+        elapsed += replay.run(records)
+    report(replay, elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
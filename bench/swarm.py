@@ -0,0 +1,339 @@
+"""
+Connects a swarm of headless bots to a local server. Each bot joins
+like a real client, then sends player updates at a fixed rate until the
+run ends. Reports join latency, tile section throughput and how long
+the server's reactor was stalled.
+
+The server is either started in this process (--in-process), or is
+already running locally, in which case its stall figures are read from
+the metrics endpoint (--metrics-port). In process, the bots share the
+server's reactor, so their own work shows up as server lag.
+
+Usage: python -m bench.swarm [options]
+"""
+
+import ConfigParser
+import random
+import re
+import struct
+import sys
+import urllib2
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.internet.task import LoopingCall
+
+from bench import client
+from net.messages import Message, DisconnectMessage, \
+    RequestPlayerDataMessage, PasswordRequestMessage, WorldDataMessage, \
+    TileLoadingMessage, TileSectionMessage, SendSpawnMessage
+from util.metrics import Histogram
+
+FRAME_HEADER = "<HB"
+FRAME_HEADER_LEN = struct.calcsize(FRAME_HEADER)
+
+
+class Bot(Protocol):
+    """
+    A client which joins the server, then keeps moving.
+
+    @ivar joinTime: Seconds from connecting until the server asked for
+        the spawn, or C{None} if that has not happened yet.
+    """
+
+    def __init__(self, swarm, index):
+        self.swarm = swarm
+        self.session = client.ClientSession(index % 255, "bot%d" % (index,))
+        self.rand = random.Random(index)
+        self.connectedAt = None
+        self.joinTime = None
+        self.sectionStart = None
+        self.sectionEnd = None
+        self.sectionBytes = 0
+        self._buffer = ""
+        self._updates = None
+
+    def connectionMade(self):
+        self.connectedAt = reactor.seconds()
+        self.transport.write(client.connectionRequest())
+
+    def dataReceived(self, data):
+        self._buffer += data
+        while len(self._buffer) >= FRAME_HEADER_LEN:
+            length, messageType = struct.unpack_from(
+                FRAME_HEADER, self._buffer)
+            end = length + Message.headerFormatLen
+            if len(self._buffer) < end:
+                break
+            frame, self._buffer = self._buffer[:end], self._buffer[end:]
+            self.frameReceived(messageType, frame)
+
+    def frameReceived(self, messageType, frame):
+        payload = frame[FRAME_HEADER_LEN:]
+        if messageType == TileSectionMessage.MESSAGE_TYPE:
+            self.sectionBytes += len(frame)
+            self.sectionEnd = reactor.seconds()
+        elif messageType == TileLoadingMessage.MESSAGE_TYPE:
+            if self.sectionStart is None:
+                self.sectionStart = reactor.seconds()
+        elif messageType == RequestPlayerDataMessage.MESSAGE_TYPE:
+            self.transport.write("".join(client.playerData(self.session)))
+        elif messageType == WorldDataMessage.MESSAGE_TYPE:
+            self.session.player.spawn = client.worldSpawn(payload)
+            self.transport.write(
+                client.tileBlockRequest(*self.session.player.spawn))
+        elif messageType == SendSpawnMessage.MESSAGE_TYPE:
+            self.transport.write(
+                client.spawn(self.session, *self.session.player.spawn))
+            self.joined()
+        elif messageType == PasswordRequestMessage.MESSAGE_TYPE:
+            self.swarm.failed(self, "server wants a password")
+            self.transport.loseConnection()
+        elif messageType == DisconnectMessage.MESSAGE_TYPE:
+            self.swarm.failed(self, "disconnected: %s" % (payload,))
+
+    def joined(self):
+        if self.joinTime is not None:
+            return
+        self.joinTime = reactor.seconds() - self.connectedAt
+        self.swarm.joined(self)
+        if self.swarm.rate > 0:
+            self._updates = LoopingCall(self.move)
+            self._updates.start(1.0 / self.swarm.rate, now=False)
+
+    def move(self):
+        self.swarm.pattern(self.session.player, self.rand)
+        self.transport.write(client.playerUpdate(self.session))
+        self.swarm.updatesSent += 1
+
+    def connectionLost(self, reason):
+        if self._updates is not None and self._updates.running:
+            self._updates.stop()
+        self.swarm.lost(self)
+
+
+class Swarm(ClientFactory):
+    """
+    Connects C{count} bots to C{host}:C{port}, C{connectRate} a second.
+
+    @ivar joinHistogram: A L{Histogram} of bot join times.
+    """
+
+    def __init__(self, host, port, count, connectRate, rate, pattern):
+        self.host = host
+        self.port = port
+        self.count = count
+        self.connectRate = connectRate
+        self.rate = rate
+        self.pattern = pattern
+        self.bots = []
+        self.failures = {}
+        self.joinHistogram = Histogram()
+        self.updatesSent = 0
+        self.stopping = False
+        self._started = 0
+
+    def buildProtocol(self, addr):
+        bot = Bot(self, len(self.bots))
+        self.bots.append(bot)
+        return bot
+
+    def start(self):
+        self._connector = LoopingCall(self._connectNext)
+        self._connector.start(1.0 / self.connectRate, now=True)
+
+    def _connectNext(self):
+        if self._started >= self.count:
+            self._connector.stop()
+            return
+        self._started += 1
+        reactor.connectTCP(self.host, self.port, self)
+
+    def stop(self):
+        self.stopping = True
+        if self._connector.running:
+            self._connector.stop()
+        for bot in self.bots:
+            if bot.transport is not None and bot.connected:
+                bot.transport.loseConnection()
+
+    def joined(self, bot):
+        self.joinHistogram.observe(bot.joinTime)
+
+    def failed(self, bot, reason):
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def lost(self, bot):
+        if not self.stopping:
+            self.failed(bot, "connection lost")
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed(None, "connect failed: %s" % (reason.getErrorMessage(),))
+
+    def report(self, elapsed):
+        joined = [bot for bot in self.bots if bot.joinTime is not None]
+        lines = ["%d bots connected, %d joined in %.1fs" % (
+            len(self.bots), len(joined), elapsed)]
+        lines.append("join: %s" % (self.joinHistogram.summary(),))
+
+        delivering = [bot for bot in self.bots if bot.sectionEnd is not None]
+        total = sum(bot.sectionBytes for bot in delivering)
+        if delivering:
+            perBot = [bot.sectionBytes / max(bot.sectionEnd - bot.sectionStart,
+                                             1e-6)
+                      for bot in delivering]
+            span = max(bot.sectionEnd for bot in delivering) - \
+                min(bot.sectionStart for bot in delivering)
+            lines.append(
+                "sections: %d bytes, %.0f bytes/s overall, %.0f bytes/s "
+                "per bot on average" % (
+                    total, total / max(span, 1e-6),
+                    sum(perBot) / len(perBot)))
+        lines.append("player updates sent: %d (%.0f/s)" % (
+            self.updatesSent, self.updatesSent / max(elapsed, 1e-6)))
+        for reason, count in sorted(self.failures.iteritems()):
+            lines.append("failed: %dx %s" % (count, reason))
+        return lines
+
+
+class LocalServer(object):
+    """
+    Runs a L{TerrariaServer} in this process.
+    """
+
+    def __init__(self, configPath, port):
+        from config.server import ServerConfig
+        from net.server import TerrariaServer
+
+        config = ConfigParser.RawConfigParser()
+        config.read(configPath)
+        config.set("Global", "port", str(port))
+        config.set("Global", "listen_ip", "127.0.0.1")
+        config.set("Global", "password", "")
+        self.server = TerrariaServer(ServerConfig().from_config(config))
+
+    def start(self):
+        return self.server.start()
+
+    def stallStats(self):
+        watchdog = self.server.watchdog
+        return {
+            'stalls': watchdog.stalls,
+            'lag': watchdog.lagHistogram.total,
+            'longest': watchdog.longestStall,
+        }
+
+
+class RemoteServer(object):
+    """
+    A server running in another local process, whose stall figures are
+    read from its metrics endpoint.
+    """
+
+    METRICS = {
+        'stalls': 'terraria_reactor_stalls_total',
+        'lag': 'terraria_reactor_lag_seconds_sum',
+        'longest': 'terraria_reactor_longest_stall_seconds',
+    }
+
+    def __init__(self, metricsPort):
+        self.metricsPort = metricsPort
+
+    def start(self):
+        pass
+
+    def stallStats(self):
+        if not self.metricsPort:
+            return None
+        try:
+            text = urllib2.urlopen(
+                "http://127.0.0.1:%d/metrics" % (self.metricsPort,)).read()
+        except (urllib2.URLError, IOError):
+            return None
+        stats = {}
+        for key, name in self.METRICS.iteritems():
+            match = re.search(r"^%s (\S+)$" % (name,), text, re.M)
+            if match:
+                stats[key] = float(match.group(1))
+        return stats
+
+
+def stallReport(before, after):
+    if before is None or after is None:
+        return ["server stalls: unknown (no metrics port)"]
+    return ["server reactor lag: %.3fs in total, %d stalls, longest "
+            "heartbeat delay %.3fs" % (
+                after['lag'] - before['lag'],
+                after['stalls'] - before['stalls'], after['longest'])]
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--bots", type="int", default=100,
+                      help="number of bots to connect")
+    parser.add_option("--connect-rate", type="float", default=50.0,
+                      help="bots connected per second")
+    parser.add_option("--rate", type="float", default=20.0,
+                      help="player updates per second sent by each bot")
+    parser.add_option("--pattern", default="patrol",
+                      choices=sorted(client.MOVEMENT_PATTERNS),
+                      help="movement pattern: %s" % (
+                          ", ".join(sorted(client.MOVEMENT_PATTERNS)),))
+    parser.add_option("--duration", type="float", default=30.0,
+                      help="seconds to run for")
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=7777)
+    parser.add_option("--in-process", action="store_true", default=False,
+                      help="start a server in this process")
+    parser.add_option("--config", default="server.cfg",
+                      help="server config used with --in-process")
+    parser.add_option("--metrics-port", type="int", default=0,
+                      help="metrics port of an out of process server")
+    options, args = parser.parse_args(argv[1:])
+
+    if options.in_process:
+        server = LocalServer(options.config, options.port)
+    else:
+        server = RemoteServer(options.metrics_port)
+    swarm = Swarm(
+        options.host, options.port, options.bots, options.connect_rate,
+        options.rate, client.MOVEMENT_PATTERNS[options.pattern])
+
+    results = {}
+
+    def begin():
+        d = maybeDeferred(server.start)
+        d.addCallback(started)
+        d.addErrback(failed)
+
+    def started(ignored):
+        results['before'] = server.stallStats()
+        results['start'] = reactor.seconds()
+        swarm.start()
+        reactor.callLater(options.duration, finish)
+
+    def failed(failure):
+        sys.stderr.write("Server failed to start: %s\n" % (
+            failure.getErrorMessage(),))
+        reactor.stop()
+
+    def finish():
+        results['elapsed'] = reactor.seconds() - results['start']
+        results['after'] = server.stallStats()
+        swarm.stop()
+        reactor.callLater(0.5, reactor.stop)
+
+    reactor.callWhenRunning(begin)
+    reactor.run()
+    if 'elapsed' not in results:
+        sys.exit(1)
+
+    for line in swarm.report(results['elapsed']) + stallReport(
+            results['before'], results['after']):
+        print line
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,149 @@
+"""
+Writes a synthetic capture for L{bench.replay}: every session performs
+the join handshake, then floods player updates with a tile block request
+every so often. Bytes are cut into randomly sized chunks so that frames
+arrive both fragmented and coalesced, as they do from real clients.
+
+Usage: python -m bench.synthetic [--sessions N] [--updates N] [--rate R]
+    output
+"""
+
+import random
+import sys
+from optparse import OptionParser
+
+from bench import client
+from net.capture import CaptureWriter
+from net.messages import PlayerUpdateMessage
+
+# Sessions start this many seconds apart
+SESSION_STAGGER = 0.05
+# Seconds the client takes to answer each handshake step
+HANDSHAKE_DELAY = 0.02
+# One in this many player updates is followed by a tile block request
+TILE_REQUEST_EVERY = 500
+# Largest chunk the stream is cut into
+MAX_CHUNK = 512
+
+WORLD_WIDTH = 800
+WORLD_HEIGHT = 600
+SPAWN = (100, 199)
+
+
+def handshake(session):
+    """
+    Returns the steps of a join as lists of frames. Each step is sent
+    once the server has answered the previous one.
+    """
+
+    return [
+        [client.connectionRequest()],
+        client.playerData(session),
+        [client.tileBlockRequest(*SPAWN)],
+        [client.spawn(session, *SPAWN)],
+    ]
+
+
+def movement(session, updates, rand):
+    """
+    Yields the frames of a player patrolling near spawn, with the odd
+    tile block request.
+    """
+
+    for i in xrange(updates):
+        client.patrol(session.player, rand)
+        yield client.playerUpdate(session)
+        if i % TILE_REQUEST_EVERY == TILE_REQUEST_EVERY - 1:
+            yield client.tileBlockRequest(
+                rand.randint(0, WORLD_WIDTH - 1),
+                rand.randint(0, WORLD_HEIGHT - 1))
+
+
+def chunked(data, rand):
+    """
+    Cuts C{data} into randomly sized chunks.
+    """
+
+    pos = 0
+    while pos < len(data):
+        size = rand.randint(1, MAX_CHUNK)
+        yield data[pos:pos + size]
+        pos += size
+
+
+def sessionRecords(index, updates, rate, rand):
+    """
+    Yields C{(time, data)} for everything one session sends, with time
+    relative to the session starting.
+    """
+
+    session = client.ClientSession(index % 255, "bot%d" % (index,))
+    when = 0.0
+    for step in handshake(session):
+        when += HANDSHAKE_DELAY
+        for chunk in chunked("".join(step), rand):
+            yield when, chunk
+
+    # Send movement in batches of roughly one frame's worth of updates
+    pending = []
+    for data in movement(session, updates, rand):
+        pending.append(data)
+        if data[2] == chr(PlayerUpdateMessage.MESSAGE_TYPE):
+            when += 1.0 / rate
+            if rand.random() < 0.5:
+                for chunk in chunked("".join(pending), rand):
+                    yield when, chunk
+                pending = []
+    if pending:
+        for chunk in chunked("".join(pending), rand):
+            yield when, chunk
+
+
+def generate(path, sessions, updates, rate, seed=0):
+    rand = random.Random(seed)
+    records = []
+    for index in xrange(sessions):
+        start = index * SESSION_STAGGER
+        records.append((start, index, "open", None))
+        last = start
+        for when, data in sessionRecords(index, updates, rate, rand):
+            last = start + when
+            records.append((last, index, "data", data))
+        records.append((last, index, "close", None))
+    # stable, so each session's records keep their order
+    records.sort(key=lambda r: r[0])
+
+    writer = CaptureWriter(path)
+    ids = {}
+    total = 0
+    for when, index, kind, data in records:
+        if kind == "open":
+            ids[index] = writer.opened(when)
+        elif kind == "data":
+            writer.data(ids[index], data, when)
+            total += len(data)
+        else:
+            writer.closed(ids[index], when)
+    writer.close()
+    return total
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] output")
+    parser.add_option("--sessions", type="int", default=10,
+                      help="number of sessions")
+    parser.add_option("--updates", type="int", default=1000,
+                      help="player updates per session")
+    parser.add_option("--rate", type="float", default=20.0,
+                      help="player updates per second")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("expected one output file")
+
+    path = args[0]
+    total = generate(path, options.sessions, options.updates, options.rate)
+    print "wrote %d sessions, %d bytes to %s" % (options.sessions, total, path)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+"""
+Compares the L{SimulationTime} timing wheel against Twisted's
+L{task.Clock} with a large number of pending timers.
+
+Usage: python -m bench.timers [pending] [operations]
+"""
+
+import random
+import sys
+from timeit import default_timer
+
+from twisted.internet import base
+from twisted.internet.task import Clock
+
+from game.environment import SimulationTime
+
+GRANULARITY = 16
+# Pending timers are spread over this many seconds
+HORIZON = 3600.0
+# Seconds of simulation advanced frame by frame
+ADVANCE_SECONDS = 10
+
+
+def noop():
+    pass
+
+
+def prefillClock(clock, delays):
+    """
+    Fills a L{Clock} without paying for the sort C{callLater} does on
+    every insert, which would make setting up 100k timers quadratic.
+    """
+
+    now = clock.seconds()
+    for delay in delays:
+        clock.calls.append(base.DelayedCall(
+            now + delay, noop, (), {}, clock.calls.remove,
+            lambda c: None, clock.seconds))
+    clock.calls.sort(key=lambda c: c.getTime())
+
+
+def prefillSimulation(simulation, delays):
+    for delay in delays:
+        simulation.callLater(delay, noop)
+
+
+def timeIt(func, *args):
+    start = default_timer()
+    result = func(*args)
+    return default_timer() - start, result
+
+
+def scheduleMany(clock, delays):
+    return [clock.callLater(delay, noop) for delay in delays]
+
+
+def cancelAll(calls):
+    for call in calls:
+        if call.active():
+            call.cancel()
+
+
+def advanceFrames(clock, frames):
+    for i in xrange(frames):
+        clock.advance(1.0 / GRANULARITY)
+
+
+def run(clock, prefill, pending, operations, rand):
+    delays = [rand.uniform(0, HORIZON) for i in xrange(pending)]
+    extra = [rand.uniform(0, HORIZON) for i in xrange(operations)]
+
+    results = {}
+    results['prefill'], ignored = timeIt(prefill, clock, delays)
+    results['schedule'], calls = timeIt(scheduleMany, clock, extra)
+    results['cancel'], ignored = timeIt(cancelAll, calls)
+    frames = ADVANCE_SECONDS * GRANULARITY
+    results['advance'], ignored = timeIt(advanceFrames, clock, frames)
+    results['remaining'] = len(clock.getDelayedCalls())
+    return results
+
+
+def report(name, results, operations):
+    frames = ADVANCE_SECONDS * GRANULARITY
+    print "%-16s prefill %8.3fs  schedule %8.2fus/op  cancel %8.2fus/op  " \
+        "advance %8.2fus/frame  pending %d" % (
+            name,
+            results['prefill'],
+            results['schedule'] * 1e6 / operations,
+            results['cancel'] * 1e6 / operations,
+            results['advance'] * 1e6 / frames,
+            results['remaining'])
+
+
+def main(argv):
+    pending = int(argv[1]) if len(argv) > 1 else 100000
+    operations = int(argv[2]) if len(argv) > 2 else 100
+
+    print "%d pending timers over %ds, %d scheduled/cancelled, " \
+        "%ds advanced at %d frames/s" % (
+            pending, HORIZON, operations, ADVANCE_SECONDS, GRANULARITY)
+
+    report("task.Clock",
+           run(Clock(), prefillClock, pending, operations,
+               random.Random(0)),
+           operations)
+    report("SimulationTime",
+           run(SimulationTime(GRANULARITY, None), prefillSimulation,
+               pending, operations, random.Random(0)),
+           operations)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
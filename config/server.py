@@ -1,8 +1,13 @@
 import logging
 import logging.config
 
+from config.database import SimpleDatabaseConfig
+
 GLOBAL_SECTION = "Global"
 WORLD_SECTION = "World"
+DIAGNOSTICS_SECTION = "Diagnostics"
+ADMIN_SECTION = "Admin"
+DATABASE_SECTION = "Database"
 
 
 class ServerConfig:
@@ -12,12 +17,81 @@ class ServerConfig:
         self.listenPort = None
         self.serverPassword = None
         self.worldPath = None
+        self.autosaveInterval = 30.0
+        self.journalDirectory = ""
+        self.journalSyncInterval = 1.0
+        self.databaseConfig = SimpleDatabaseConfig(
+            "sqlite", ":memory:", None, None, None, None)
+        self.watchdogThreshold = 0.25
+        self.slowJoinThreshold = 5.0
+        self.profilerRate = 200
+        self.profileDirectory = "."
+        self.adminPort = 0
+        self.metricsPort = 0
+        self.statsLogInterval = 0
+        self.flightRecorderFrames = 256
+        self.flightRecorderBytes = 64
+        self.flightRecorderDirectory = "."
+        self.capturePath = ""
+
+    def _get(self, config, section, option, default):
+        """
+        Reads an optional setting, falling back to C{default}
+        """
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return default
 
     def from_config(self, config):
         self.listenAddress = config.get(GLOBAL_SECTION, "listen_ip")
         self.listenPort = int(config.get(GLOBAL_SECTION, "port"))
         self.serverPassword = config.get(GLOBAL_SECTION, "password")
         self.worldPath = config.get(WORLD_SECTION, "world_path")
+        self.autosaveInterval = float(self._get(
+            config, WORLD_SECTION, "autosave_interval",
+            self.autosaveInterval))
+        self.journalDirectory = self._get(
+            config, WORLD_SECTION, "journal_dir", self.journalDirectory)
+        self.journalSyncInterval = float(self._get(
+            config, WORLD_SECTION, "journal_sync_interval",
+            self.journalSyncInterval))
+        self.databaseConfig = SimpleDatabaseConfig(
+            self._get(config, DATABASE_SECTION, "databaseType",
+                      self.databaseConfig.databaseType),
+            self._get(config, DATABASE_SECTION, "databaseName",
+                      self.databaseConfig.databaseName),
+            self._get(config, DATABASE_SECTION, "userName", None),
+            self._get(config, DATABASE_SECTION, "password", None),
+            self._get(config, DATABASE_SECTION, "hostname", None),
+            self._get(config, DATABASE_SECTION, "port", None))
+        self.watchdogThreshold = float(self._get(
+            config, DIAGNOSTICS_SECTION, "watchdog_threshold",
+            self.watchdogThreshold))
+        self.slowJoinThreshold = float(self._get(
+            config, DIAGNOSTICS_SECTION, "slow_join_threshold",
+            self.slowJoinThreshold))
+        self.profilerRate = int(self._get(
+            config, DIAGNOSTICS_SECTION, "profiler_rate", self.profilerRate))
+        self.profileDirectory = self._get(
+            config, DIAGNOSTICS_SECTION, "profile_dir", self.profileDirectory)
+        self.flightRecorderFrames = int(self._get(
+            config, DIAGNOSTICS_SECTION, "flight_frames",
+            self.flightRecorderFrames))
+        self.flightRecorderBytes = int(self._get(
+            config, DIAGNOSTICS_SECTION, "flight_bytes",
+            self.flightRecorderBytes))
+        self.flightRecorderDirectory = self._get(
+            config, DIAGNOSTICS_SECTION, "flight_dir",
+            self.flightRecorderDirectory)
+        self.capturePath = self._get(
+            config, DIAGNOSTICS_SECTION, "capture_path", self.capturePath)
+        self.adminPort = int(self._get(
+            config, ADMIN_SECTION, "port", self.adminPort))
+        self.metricsPort = int(self._get(
+            config, ADMIN_SECTION, "metrics_port", self.metricsPort))
+        self.statsLogInterval = float(self._get(
+            config, ADMIN_SECTION, "stats_log_interval",
+            self.statsLogInterval))
         
         if config.get(GLOBAL_SECTION, "log_enabled"):
             logging.config.fileConfig('logging.cfg')
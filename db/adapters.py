@@ -1,28 +1,82 @@
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+import logging
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 
 from db.entities import Base
+from util.metrics import Histogram, registry
+from util.timer import monotonic
+
+logger = logging.getLogger()
 
-Session = sessionmaker()
+# Worker threads (and pooled connections) used for server databases
+DEFAULT_POOL_SIZE = 4
+# Statement kinds query latency is recorded for
+STATEMENT_KINDS = ("select", "insert", "update", "delete", "other")
 
 
 class DatabaseAdapter(object):
     """
     Database adapter that talks to a sql alchemy engine/session
+
+    All database work runs on a dedicated pool of worker threads, each
+    with its own session, so callers on the reactor or in message
+    handlers only ever get a L{Deferred} back (see L{runInSession}).
+    Server databases use a L{QueuePool} with one connection per worker.
+    SQLite only allows one writer at a time, so it gets a single worker
+    and connection instead, with the journal in WAL mode so reads are not
+    blocked by a write in progress.
+
+    @ivar queryHistograms: A dict of statement kind (see
+        L{STATEMENT_KINDS}) to a L{Histogram} of query latencies.
+    @ivar operationHistogram: A L{Histogram} of the time from calling
+        L{runInSession} until the work was committed, queueing included.
+    @ivar pending: Operations queued or running.
     """
 
-    def __init__(self, dbConfig):
+    def __init__(self, dbConfig, poolSize=DEFAULT_POOL_SIZE, clock=reactor):
         self.dbConfig = dbConfig
+        self.poolSize = 1 if dbConfig.databaseType == "sqlite" else poolSize
         self.engine = self.__createEngineFromConfig(self.dbConfig)
-        Session.configure(bind=self.engine)
-        self.session = Session()
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
         Base.metadata.create_all(self.engine)
 
+        self.queryHistograms = dict(
+            (kind, Histogram()) for kind in STATEMENT_KINDS)
+        self.operationHistogram = Histogram()
+        self.pending = 0
+        # queries finish on several worker threads
+        self._metricsLock = threading.Lock()
+        event.listen(
+            self.engine, "before_cursor_execute", self._beforeExecute)
+        event.listen(self.engine, "after_cursor_execute", self._afterExecute)
+
+        self.clock = clock
+        self.threadPool = ThreadPool(
+            minthreads=1, maxthreads=self.poolSize, name="db")
+        self._shutdownTrigger = None
+
     def __createEngineFromConfig(self, dbConfig):
         if dbConfig.databaseType == "sqlite":
-            return create_engine(
-                "sqlite:///%s" %
-                (dbConfig.databaseName), echo=True)
+            if dbConfig.databaseName in ("", ":memory:"):
+                # every connection to :memory: is a new database, so
+                # share one
+                engine = create_engine(
+                    "sqlite://",
+                    connect_args={'check_same_thread': False},
+                    poolclass=StaticPool)
+            else:
+                engine = create_engine(
+                    "sqlite:///%s" % (dbConfig.databaseName,),
+                    connect_args={'check_same_thread': False},
+                    poolclass=QueuePool, pool_size=1, max_overflow=0)
+                event.listen(engine, "connect", self._tuneSqlite)
+            return engine
         else:
             return create_engine(
                 "%s://%s:%s@%s/%s" %
@@ -30,7 +84,103 @@ class DatabaseAdapter(object):
                  dbConfig.userName,
                  dbConfig.password,
                  dbConfig.hostname,
-                 dbConfig.databaseName))
+                 dbConfig.databaseName),
+                poolclass=QueuePool, pool_size=self.poolSize, max_overflow=0,
+                pool_recycle=3600)
+
+    def _tuneSqlite(self, connection, record):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only risks the last transactions on power loss
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    def _beforeExecute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        # kept on the statement's context rather than a stack on the
+        # connection, so a statement which fails leaves nothing behind
+        context._queryStart = monotonic()
+
+    def _afterExecute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        elapsed = monotonic() - context._queryStart
+        kind = statement.lstrip()[:6].lower()
+        if kind not in self.queryHistograms:
+            kind = "other"
+        with self._metricsLock:
+            self.queryHistograms[kind].observe(elapsed)
+
+    def registerMetrics(self, metrics=registry):
+        for kind, histogram in sorted(self.queryHistograms.iteritems()):
+            metrics.addHistogram(
+                "terraria_db_query_seconds", "Time spent running queries",
+                histogram, kind=kind)
+        metrics.addHistogram(
+            "terraria_db_operation_seconds",
+            "Time from queueing database work until it was committed",
+            self.operationHistogram)
+        metrics.addGauge(
+            "terraria_db_operations_pending",
+            "Database operations queued or running", lambda: self.pending)
+
+    def start(self):
+        """
+        Starts the worker threads, which are stopped when the reactor
+        shuts down.
+        """
+        self.threadPool.start()
+        self._shutdownTrigger = self.clock.addSystemEventTrigger(
+            "during", "shutdown", self._shutdown)
+
+    def stop(self):
+        """
+        Waits for queued work to finish and stops the worker threads.
+        """
+        if self._shutdownTrigger is not None:
+            self.clock.removeSystemEventTrigger(self._shutdownTrigger)
+        self._shutdown()
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        self.threadPool.stop()
+
+    def runInSession(self, func, *args, **kwargs):
+        """
+        Calls C{func(session, *args, **kwargs)} in a worker thread with
+        that thread's session, committing afterwards or rolling back if
+        it raises.
+
+        @return: a L{Deferred} firing with what C{func} returned
+        """
+        queued = monotonic()
+        self.pending += 1
+        d = deferToThreadPool(
+            self.clock, self.threadPool, self._runInSession, func, args,
+            kwargs)
+        d.addBoth(self._finished, queued)
+        return d
+
+    def _runInSession(self, func, args, kwargs):
+        session = self.Session()
+        try:
+            result = func(session, *args, **kwargs)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return result
+
+    def _finished(self, result, queued):
+        self.pending -= 1
+        self.operationHistogram.observe(monotonic() - queued)
+        return result
+
+    @property
+    def session(self):
+        """
+        The calling thread's session
+        """
+        return self.Session()
 
     def query(self, *args):
         return self.session.query(*args)
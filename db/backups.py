@@ -0,0 +1,302 @@
+import json
+import os
+import time
+import zlib
+from hashlib import sha1
+
+from game.snapshots import HEADER_FIELDS
+from game.world import World
+
+MANIFEST_FORMAT = 1
+# Times a backup is read again when saves keep changing the world
+BACKUP_ATTEMPTS = 5
+
+
+class BackupStore(object):
+    """
+    Local store of world backups.
+
+    Backups are built on the tile sections stored in the database (see
+    L{WorldRepository.saveSections}): each section is already encoded
+    into a BLOB along with the sha1 of its content. The store keeps every
+    BLOB once, under C{objects/} and named by that hash, and a backup is
+    only a manifest under C{manifests/} listing the world's header and
+    the hash of each of its sections. A backup therefore writes only
+    the sections which changed since any earlier backup.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objectDirectory = os.path.join(directory, "objects")
+        self.manifestDirectory = os.path.join(directory, "manifests")
+        for path in (self.objectDirectory, self.manifestDirectory):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _objectPath(self, digest):
+        return os.path.join(self.objectDirectory, digest[:2], digest[2:])
+
+    def _writeFile(self, path, data):
+        """
+        Writes a file so that it either exists complete or not at all.
+        """
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        partial = path + ".partial"
+        with open(partial, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, path)
+
+    def hasObject(self, digest):
+        return os.path.exists(self._objectPath(digest))
+
+    def putObject(self, digest, blob):
+        """
+        Stores a section BLOB under its hash, unless it is stored already.
+
+        @return: the number of bytes written
+        """
+        if self.hasObject(digest):
+            return 0
+        self._writeFile(self._objectPath(digest), blob)
+        return len(blob)
+
+    def getObject(self, digest):
+        with open(self._objectPath(digest), "rb") as f:
+            return f.read()
+
+    def objects(self):
+        """
+        Returns the hashes of every stored object.
+        """
+        digests = []
+        for prefix in os.listdir(self.objectDirectory):
+            for rest in os.listdir(os.path.join(self.objectDirectory, prefix)):
+                if not rest.endswith(".partial"):
+                    digests.append(prefix + rest)
+        return digests
+
+    def checkObject(self, digest):
+        """
+        Whether a stored object is intact: its content must still hash to
+        its name.
+        """
+        decompressor = zlib.decompressobj()
+        try:
+            raw = decompressor.decompress(self.getObject(digest))
+            raw += decompressor.flush()
+        except (IOError, zlib.error):
+            return False
+        # decompressing ignores anything after the end of the stream
+        return not decompressor.unused_data and \
+            sha1(raw).hexdigest() == digest
+
+    def writeManifest(self, manifest):
+        """
+        Stores a manifest made by L{backupWorld}.
+
+        @return: the manifest's name
+        """
+        created = manifest['created']
+        name = "%s-%s%03d.json" % (
+            manifest['world']['name'].replace(os.sep, "_"),
+            time.strftime("%Y%m%d-%H%M%S", time.gmtime(created)),
+            int(created * 1000) % 1000)
+        self._writeFile(
+            os.path.join(self.manifestDirectory, name),
+            json.dumps(manifest, indent=1, sort_keys=True))
+        return name
+
+    def readManifest(self, name):
+        with open(os.path.join(self.manifestDirectory, name), "rb") as f:
+            return json.load(f)
+
+    def manifests(self, worldName=None):
+        """
+        Returns the names of the stored manifests, oldest first, only
+        those of the named world if C{worldName} is given.
+        """
+        names = []
+        for name in os.listdir(self.manifestDirectory):
+            if not name.endswith(".json"):
+                continue
+            if worldName is not None and \
+                    name.rsplit("-", 2)[0] != worldName.replace(os.sep, "_"):
+                continue
+            names.append(name)
+        names.sort(key=lambda name: name.rsplit("-", 2)[1:])
+        return names
+
+    def verify(self, name):
+        """
+        Checks that every section of a manifest is stored intact.
+
+        @return: a list of problems, empty if there are none
+        """
+        problems = []
+        checked = {}
+        for x, y, version, digest in self.readManifest(name)['sections']:
+            if digest not in checked:
+                checked[digest] = self.checkObject(digest)
+            if not checked[digest]:
+                problems.append("%s: section (%d, %d) object %s is %s" % (
+                    name, x, y, digest,
+                    "corrupt" if self.hasObject(digest) else "missing"))
+        return problems
+
+    def prune(self, keep):
+        """
+        Deletes all but the C{keep} newest manifests of each world, then
+        the objects no remaining manifest refers to.
+
+        @return: C{(manifests deleted, objects deleted, bytes freed)}
+        """
+        byWorld = {}
+        for name in self.manifests():
+            byWorld.setdefault(name.rsplit("-", 2)[0], []).append(name)
+        deleted = 0
+        for names in byWorld.itervalues():
+            for name in names[:max(0, len(names) - keep)]:
+                os.remove(os.path.join(self.manifestDirectory, name))
+                deleted += 1
+
+        referenced = set()
+        for name in self.manifests():
+            for x, y, version, digest in self.readManifest(name)['sections']:
+                referenced.add(digest)
+        objectsDeleted = 0
+        freed = 0
+        for digest in self.objects():
+            if digest not in referenced:
+                path = self._objectPath(digest)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                objectsDeleted += 1
+        return deleted, objectsDeleted, freed
+
+
+class BackupResult(object):
+    """
+    What a backup wrote.
+
+    @ivar manifest: The name of the manifest written.
+    @ivar sections: Sections in the backup.
+    @ivar objectsWritten: Sections whose content was not stored yet.
+    @ivar bytesWritten: Bytes of the objects written.
+    @ivar elapsed: Seconds the backup took.
+    """
+
+    def __init__(self, manifest, sections, objectsWritten, bytesWritten,
+                 elapsed):
+        self.manifest = manifest
+        self.sections = sections
+        self.objectsWritten = objectsWritten
+        self.bytesWritten = bytesWritten
+        self.elapsed = elapsed
+
+    def describe(self):
+        return "%s: %d sections, %d new objects, %d bytes in %.2fs" % (
+            self.manifest, self.sections, self.objectsWritten,
+            self.bytesWritten, self.elapsed)
+
+
+def _headerOf(world):
+    header = {}
+    for name in HEADER_FIELDS:
+        header[name] = getattr(world, name)
+    return header
+
+
+def backupWorld(repository, store, worldName):
+    """
+    Backs up the named world as it is stored in the database. Only the
+    hashes of its sections are read, plus the BLOBs of those which are
+    not in C{store} yet.
+
+    A save which lands between reading the hashes and the BLOBs can
+    replace a section whose BLOB was still to be read. The backup is
+    then read again, up to L{BACKUP_ATTEMPTS} times, so a manifest never
+    lists a section whose BLOB was not stored.
+
+    @return: a L{Deferred} firing with a L{BackupResult}
+    """
+    start = time.time()
+    d = repository.getWorldHeader(name=worldName)
+    d.addCallback(_gotWorldToBackUp, repository, worldName, store, start)
+    return d
+
+
+def _gotWorldToBackUp(header, repository, worldName, store, start):
+    if header is None:
+        raise ValueError("There is no world named %r" % (worldName,))
+    return _readSections(repository, store, header, start, 1)
+
+
+def _readSections(repository, store, world, start, attempt):
+    d = repository.sectionDigests(world, store.hasObject)
+    d.addCallback(_gotSections, repository, store, world, start, attempt)
+    return d
+
+
+def _gotSections(result, repository, store, world, start, attempt):
+    digests, missing, blobs = result
+    if missing.difference(blobs):
+        if attempt < BACKUP_ATTEMPTS:
+            return _readSections(repository, store, world, start,
+                                 attempt + 1)
+        raise ValueError(
+            "%r kept changing while being backed up, gave up after %d "
+            "attempts" % (world, attempt))
+
+    written = 0
+    for digest, blob in blobs.iteritems():
+        written += store.putObject(digest, blob)
+    # objects are written first, so a manifest never refers to a
+    # missing one
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'created': start,
+        'world': _headerOf(world),
+        'sections': [list(row) for row in digests],
+    }
+    name = store.writeManifest(manifest)
+    return BackupResult(
+        name, len(digests), len(blobs), written, time.time() - start)
+
+
+def restoreWorld(repository, store, manifestName):
+    """
+    Replaces the stored world named in a manifest, its header and all of
+    its sections, with the backed up copy. The server must not be running
+    on that world, or its next save would overwrite the restored copy.
+
+    @return: a L{Deferred} firing with C{(sections written, bytes
+        written)}
+    """
+    manifest = store.readManifest(manifestName)
+    if manifest['format'] != MANIFEST_FORMAT:
+        raise ValueError("Unknown manifest format %r" % (manifest['format'],))
+    encoded = [
+        (x, y, version, str(digest), store.getObject(digest))
+        for x, y, version, digest in manifest['sections']]
+
+    header = manifest['world']
+    world = World()
+    world.name = header['name'].encode("utf-8")
+    # the backup may come from another database, so look the world up
+    # by name
+    d = repository.getWorld(world)
+    d.addCallback(_gotWorldToRestore, repository, header)
+    d.addCallback(repository.replaceSections, encoded)
+    return d
+
+
+def _gotWorldToRestore(world, repository, header):
+    for name in HEADER_FIELDS:
+        if name not in ('worldId', 'name'):
+            setattr(world, name, header[name])
+    world.spawn = tuple(header['spawn'])
+    return repository.saveWorld(world)
@@ -1,5 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, Boolean
+from sqlalchemy import Column, Integer, String, Float, Boolean, \
+    LargeBinary, ForeignKey
 
 Base = declarative_base()
 
@@ -44,3 +45,51 @@ class WorldEntity(Base):
     def __repr__(self):
         return "<WorldEntity('%d', '%s', '%dx%d')>" % (
             self.id, self.name, self.width, self.height)
+
+
+class TileSectionEntity(Base):
+    """
+    Represents an entry in the TileSection table: the tiles of one
+    L{TileSection}, encoded as a single compressed BLOB by
+    L{TileSectionMapper}
+    """
+
+    __tablename__ = "TileSection"
+
+    worldId = Column(Integer, ForeignKey("World.id"), primary_key=True)
+    x = Column(Integer, primary_key=True, autoincrement=False)
+    y = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer)
+    # sha1 of the uncompressed encoding, to skip unchanged sections
+    hash = Column(String(40))
+    tiles = Column(LargeBinary)
+
+    def __repr__(self):
+        return "<TileSectionEntity('%d', '%d', '%d')>" % (
+            self.worldId, self.x, self.y)
+
+
+class ImportCheckpointEntity(Base):
+    """
+    Represents an entry in the ImportCheckpoint table: how far the import
+    of a world file into a world has got, so an interrupted import can
+    carry on from there. The row is deleted once the import completes.
+    """
+
+    __tablename__ = "ImportCheckpoint"
+
+    worldId = Column(Integer, ForeignKey("World.id"), primary_key=True)
+    fileName = Column(String)
+    # tell whether the file is still the one being imported
+    fileSize = Column(Integer)
+    # in whole seconds
+    fileModified = Column(Integer)
+    # sha1 of the file up to the tiles
+    headerHash = Column(String(40))
+    nextColumn = Column(Integer)
+    # where the next column starts in the file
+    fileOffset = Column(Integer)
+
+    def __repr__(self):
+        return "<ImportCheckpointEntity('%d', '%s', '%d')>" % (
+            self.worldId, self.fileName, self.nextColumn)
@@ -0,0 +1,288 @@
+import collections
+import logging
+import multiprocessing
+import os
+from cStringIO import StringIO
+from hashlib import sha1
+from itertools import chain
+
+from twisted.internet.defer import maybeDeferred
+
+from db.mappers import TileSectionMapper
+from game.tiles import airTile, SECTION_WIDTH, SECTION_HEIGHT
+from util.readers import WorldFileReader, TileColumnReader
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+# Section columns written per transaction, and so between checkpoints
+DEFAULT_BATCH_COLUMNS = 4
+
+sectionMapper = TileSectionMapper()
+
+
+def encodeSectionColumn(columns, sectionX, rows):
+    """
+    Turns up to L{SECTION_WIDTH} tile columns, left to right, into the
+    C{rows} sections of section column C{sectionX}, padding them with air
+    past the edge of the world.
+
+    @return: a list of C{(x, y, version, hash, blob)} rows, as written by
+        L{WorldRepository.importSections}
+    """
+    height = rows * SECTION_HEIGHT
+    # rows of tiles, as sections store them
+    tileRows = zip(*columns)
+    if len(columns) < SECTION_WIDTH:
+        padding = (airTile,) * (SECTION_WIDTH - len(columns))
+        tileRows = [row + padding for row in tileRows]
+    tileRows.extend([(airTile,) * SECTION_WIDTH] * (height - len(tileRows)))
+    encoded = []
+    for y in xrange(rows):
+        tiles = list(chain.from_iterable(
+            tileRows[y * SECTION_HEIGHT:(y + 1) * SECTION_HEIGHT]))
+        blob, digest = sectionMapper.encode(tiles)
+        encoded.append((sectionX, y, 0, digest, blob))
+    return encoded
+
+
+def decodeSectionColumn(version, height, sectionX, rows, count, data):
+    """
+    Reads C{count} columns from their bytes, as returned by
+    L{TileColumnReader.readColumnData}, and encodes them like
+    L{encodeSectionColumn}. Runs in the worker processes of a parallel
+    import.
+    """
+    reader = TileColumnReader(StringIO(data), version, height)
+    return encodeSectionColumn(reader.readColumns(count), sectionX, rows)
+
+
+class WorldImporter(object):
+    """
+    Imports a world file into the database: its header as a world, named
+    as in the file, and its tiles as the world's sections.
+
+    The file is streamed one section column at a time, which is encoded
+    and written with the next few ones as one batch (see
+    L{WorldRepository.importSections}). The next batch is decoded while
+    the database threads write the current one, so at most two batches
+    are held in memory. Decoding can also be spread over C{workers}
+    processes: the importer then only finds where each section column's
+    bytes are in the file, and the workers build and encode the tiles.
+
+    Each batch is committed along with a checkpoint of where the import
+    got. Importing the same file again after an interruption carries on
+    from the last checkpoint, and importing it once more after it
+    completed only rewrites the sections whose content differs. The
+    checkpoint records the file's name, size, modification time and the
+    sha1 of its header, and the import starts over if any differ.
+
+    @ivar columns: Tile columns imported, the resumed ones included.
+    @ivar resumedColumns: Tile columns imported before an interruption.
+    @ivar sectionsWritten: Sections written.
+    @ivar bytesWritten: Encoded section bytes written.
+    @ivar bytesRead: Bytes of tiles read from the file.
+    """
+
+    def __init__(self, repository, path, workers=0,
+                 batchColumns=DEFAULT_BATCH_COLUMNS, progress=None):
+        self.repository = repository
+        self.path = path
+        self.workers = workers
+        self.batchColumns = batchColumns
+        self.progress = progress
+        self.world = None
+        self.columns = 0
+        self.resumedColumns = 0
+        self.sectionsWritten = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self._file = None
+        self._tiles = None
+        self._rows = 0
+        self._start = None
+        self._startOffset = 0
+        self._fileStamp = None
+        self._bounds = None
+        self._pool = None
+        self._decoded = None
+        self._next = None
+
+    def run(self):
+        """
+        Runs the import.
+
+        @return: a L{Deferred} firing with the importer once the import
+            is complete
+        """
+        self._start = monotonic()
+        if self.workers:
+            # forked before any database work is queued, so no other
+            # thread holds a lock the workers would inherit
+            self._pool = multiprocessing.Pool(self.workers)
+        # a file which cannot be read fails the Deferred like anything
+        # else, so the pool is still cleaned up
+        d = maybeDeferred(self._open)
+        d.addCallback(self._opened)
+        d.addCallback(self._gotStoredWorld)
+        d.addCallback(self._gotCheckpoint)
+        d.addCallback(self._savedWorld)
+        d.addBoth(self._closed)
+        return d
+
+    def _open(self):
+        reader = WorldFileReader(self.path)
+        self.world = reader.readHeader()
+        self._file = reader
+        self._tiles = self._file.tileReader(self.world)
+        self._rows = -(-self.world.height // SECTION_HEIGHT)
+        self._startOffset = self._tiles.tell()
+        self._fileStamp = self._stampFile()
+
+    def _opened(self, ignored):
+        return self.repository.getWorldHeader(name=self.world.name)
+
+    def _stampFile(self):
+        """
+        Returns what tells whether the file is still the one a checkpoint
+        was made for: C{(file name, file size, modification time, header
+        hash)}.
+        """
+        with open(self.path, "rb") as f:
+            header = f.read(self._startOffset)
+        info = os.stat(self.path)
+        # unicode, like the name read back from the database
+        name = os.path.basename(self.path).decode("utf-8", "replace")
+        return (name, info.st_size,
+                int(info.st_mtime), sha1(header).hexdigest())
+
+    def _gotStoredWorld(self, stored):
+        # the world id in the file is not a database id
+        self.world.worldId = 0 if stored is None else stored.worldId
+        if stored is None:
+            return None
+        return self.repository.getImportCheckpoint(self.world)
+
+    def _gotCheckpoint(self, checkpoint):
+        if checkpoint is not None:
+            fileName, fileSize, modified, headerHash, column, offset = \
+                checkpoint
+            if (fileName, fileSize, modified, headerHash) == self._fileStamp:
+                logger.info("Resuming the import of %s at column %d",
+                            fileName, column)
+                self._tiles.seek(column, offset)
+                self.columns = self.resumedColumns = column
+                self._startOffset = offset
+                return self.repository.saveWorld(self.world)
+            logger.warning(
+                "%s is not the file whose import was interrupted (%s), "
+                "importing it from the start", self._fileStamp[0], fileName)
+        # the first batch deletes what a larger world left stored
+        self._bounds = (-(-self.world.width // SECTION_WIDTH), self._rows)
+        return self.repository.saveWorld(self.world)
+
+    def _savedWorld(self, world):
+        if self.workers:
+            self._decoded = self._decodeInWorkers()
+        else:
+            self._decoded = self._decode()
+        batch = self._readBatch()
+        if batch is None:
+            return self
+        return self._writeBatch(batch)
+
+    def _decode(self):
+        tiles = self._tiles
+        while tiles.column < self.world.width:
+            sectionX = tiles.column // SECTION_WIDTH
+            columns = tiles.readColumns(
+                min(SECTION_WIDTH, self.world.width - tiles.column))
+            yield (encodeSectionColumn(columns, sectionX, self._rows),
+                   tiles.column, tiles.tell())
+
+    def _decodeInWorkers(self):
+        tiles = self._tiles
+        pool = self._pool
+        pending = collections.deque()
+        while tiles.column < self.world.width or pending:
+            # keeps the workers busy without reading the whole file
+            # ahead
+            while tiles.column < self.world.width and \
+                    len(pending) < self.workers * 2:
+                sectionX = tiles.column // SECTION_WIDTH
+                count = min(SECTION_WIDTH, self.world.width - tiles.column)
+                data = tiles.readColumnData(count)
+                pending.append((pool.apply_async(
+                    decodeSectionColumn,
+                    (self.world.version, self.world.height, sectionX,
+                     self._rows, count, data)),
+                    tiles.column, tiles.tell()))
+            result, column, offset = pending.popleft()
+            yield result.get(), column, offset
+
+    def _readBatch(self):
+        """
+        Decodes up to L{batchColumns} section columns.
+
+        @return: C{(encoded rows, next column, its file offset)}, or
+            C{None} once every column was read
+        """
+        encoded = []
+        column = None
+        for i in xrange(self.batchColumns):
+            decoded = next(self._decoded, None)
+            if decoded is None:
+                break
+            rows, column, offset = decoded
+            encoded.extend(rows)
+        if column is None:
+            return None
+        return encoded, column, offset
+
+    def _writeBatch(self, batch):
+        encoded, column, offset = batch
+        if column < self.world.width:
+            checkpoint = self._fileStamp + (column, offset)
+        else:
+            checkpoint = None
+        d = self.repository.importSections(
+            self.world, encoded, checkpoint, self._bounds)
+        self._bounds = None
+        d.addCallback(self._batchWritten, column, offset)
+        # decodes the next batch while this one is written
+        self._next = self._readBatch()
+        return d
+
+    def _batchWritten(self, result, column, offset):
+        written, size = result
+        self.columns = column
+        self.sectionsWritten += written
+        self.bytesWritten += size
+        self.bytesRead = offset - self._startOffset
+        if self.progress is not None:
+            self.progress(self)
+        batch, self._next = self._next, None
+        if batch is None:
+            return self
+        return self._writeBatch(batch)
+
+    def _closed(self, result):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self._file is not None:
+            self._file.close()
+        return result
+
+    def elapsed(self):
+        return monotonic() - self._start
+
+    def describe(self):
+        elapsed = max(self.elapsed(), 1e-6)
+        return ("%s: %d/%d columns (%d%%), %d sections, %d bytes written "
+                "in %.1fs, %.0f columns/s, %.2f MB/s read" % (
+                    self.world.name, self.columns, self.world.width,
+                    100 * self.columns // max(self.world.width, 1),
+                    self.sectionsWritten, self.bytesWritten, elapsed,
+                    (self.columns - self.resumedColumns) / elapsed,
+                    self.bytesRead / elapsed / (1 << 20)))
@@ -0,0 +1,278 @@
+import collections
+import logging
+import os
+import re
+import threading
+import zlib
+from struct import Struct
+
+from db.mappers import TileSectionMapper
+from util.metrics import Histogram, registry
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+# Seconds between group commits
+DEFAULT_SYNC_INTERVAL = 1.0
+SEGMENT_NAME = "tiles-%08d.journal"
+SEGMENT_PATTERN = re.compile(r"^tiles-(\d{8})\.journal$")
+
+
+class _Rotate(object):
+    __slots__ = ('segment',)
+
+    def __init__(self, segment):
+        self.segment = segment
+
+
+class _Checkpoint(object):
+    __slots__ = ('segment',)
+
+    def __init__(self, segment):
+        self.segment = segment
+
+
+class TileJournal(object):
+    """
+    Append-only journal of tile edits, so edits made since the last save
+    survive a crash.
+
+    L{append} only queues the edit. A background thread writes whatever
+    was queued every C{syncInterval} seconds as one batch and fsyncs it
+    (a group commit), so a crash loses at most that much building. Each
+    batch is::
+
+        uint32: number of edits
+        uint32: crc32 of the edits
+        edits (L{EDIT}): world x and y, then the tile as stored in
+            section BLOBs (see L{TileSectionMapper.tileFields})
+
+    The journal is split into numbered segment files. A save calls
+    L{rotate} before taking its snapshot, so every edit in the earlier
+    segments is part of the save, and L{checkpoint} once it is written,
+    which deletes them. On startup, L{replay} applies the remaining
+    segments on top of the sections loaded from the database; a batch
+    torn by a crash ends the replay of its segment.
+
+    @ivar appends: Edits written.
+    @ivar batches: Batches written.
+    @ivar bytesWritten: Bytes written to segments.
+    @ivar syncHistogram: A L{Histogram} of the time taken to write and
+        fsync a batch.
+    """
+
+    BATCH = Struct("<II")
+    EDIT = Struct("<ii" + TileSectionMapper.PALETTE_ENTRY.format[1:])
+
+    tileMapper = TileSectionMapper()
+
+    def __init__(self, directory, syncInterval=DEFAULT_SYNC_INTERVAL):
+        self.directory = directory
+        self.syncInterval = syncInterval
+        self.appends = 0
+        self.batches = 0
+        self.bytesWritten = 0
+        self.syncHistogram = Histogram()
+        # deque appends and pops are atomic, so appending takes no lock
+        self._queue = collections.deque()
+        self._segment = None
+        self._lastSegment = 0
+        self._file = None
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def registerMetrics(self, metrics=registry):
+        metrics.addGauge(
+            "terraria_journal_appends_total", "Tile edits journaled",
+            lambda: self.appends, "counter")
+        metrics.addGauge(
+            "terraria_journal_batches_total", "Journal batches written",
+            lambda: self.batches, "counter")
+        metrics.addGauge(
+            "terraria_journal_bytes_total", "Bytes written to the journal",
+            lambda: self.bytesWritten, "counter")
+        metrics.addGauge(
+            "terraria_journal_pending", "Journal entries waiting to be written",
+            lambda: len(self._queue))
+        metrics.addHistogram(
+            "terraria_journal_sync_seconds",
+            "Time taken to write and fsync a journal batch",
+            self.syncHistogram)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME % (segment,))
+
+    def segments(self):
+        """
+        Returns the numbers of the segments on disk, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        numbers = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match is not None:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def replay(self, world):
+        """
+        Applies the edits of every segment on disk to C{world}. Must be
+        called before L{start}.
+
+        @return: the number of edits applied
+        """
+        edits = 0
+        for segment in self.segments():
+            edits += self._replaySegment(world, segment)
+        if edits:
+            logger.info("Replayed %d journaled tile edits", edits)
+        return edits
+
+    def _replaySegment(self, world, segment):
+        with open(self._path(segment), "rb") as f:
+            data = f.read()
+        edits = 0
+        pos = 0
+        while pos < len(data):
+            if pos + self.BATCH.size > len(data):
+                break
+            count, checksum = self.BATCH.unpack_from(data, pos)
+            start = pos + self.BATCH.size
+            end = start + count * self.EDIT.size
+            if end > len(data) or \
+                    zlib.crc32(data[start:end]) & 0xffffffff != checksum:
+                break
+            for offset in xrange(start, end, self.EDIT.size):
+                fields = self.EDIT.unpack_from(data, offset)
+                world.setTileAt(
+                    fields[:2], self.tileMapper.tileFromFields(*fields[2:]))
+            edits += count
+            pos = end
+        if pos < len(data):
+            logger.warning(
+                "Ignoring %d bytes of a torn batch at the end of %s",
+                len(data) - pos, self._path(segment))
+        return edits
+
+    def start(self):
+        """
+        Opens a new segment and starts the writer thread.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        existing = self.segments()
+        self._lastSegment = existing[-1] if existing else 0
+        self._openSegment(self.rotate())
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="TileJournal")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes what is queued and stops the writer thread.
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def append(self, x, y, tile):
+        """
+        Queues the edit of the tile at world coordinates C{(x, y)}. May be
+        called from any thread.
+        """
+        self._queue.append((x, y, tile))
+
+    def rotate(self):
+        """
+        Starts a new segment for the edits appended from now on.
+
+        @return: the new segment's number, for L{checkpoint}
+        """
+        # numbered here rather than by the writer, so the caller can
+        # checkpoint it right away
+        self._lastSegment += 1
+        segment = self._lastSegment
+        if self._segment is not None:
+            self._queue.append(_Rotate(segment))
+        return segment
+
+    def checkpoint(self, segment):
+        """
+        Deletes the segments before C{segment}, once their edits are all
+        saved.
+        """
+        self._queue.append(_Checkpoint(segment))
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.syncInterval)
+            self._wake.clear()
+            self._writeQueuedSafely()
+        self._writeQueuedSafely()
+        self._file.close()
+        self._file = None
+        self._segment = None
+
+    def _writeQueuedSafely(self):
+        try:
+            self._writeQueued()
+        except Exception:
+            logger.exception("Error writing to the tile journal")
+
+    def _writeQueued(self):
+        queue = self._queue
+        edits = []
+        for i in xrange(len(queue)):
+            entry = queue.popleft()
+            if type(entry) is tuple:
+                edits.append(entry)
+                continue
+            self._writeBatch(edits)
+            edits = []
+            if type(entry) is _Rotate:
+                self._file.close()
+                self._openSegment(entry.segment)
+            else:
+                self._deleteBefore(entry.segment)
+        self._writeBatch(edits)
+
+    def _openSegment(self, segment):
+        self._segment = segment
+        self._file = open(self._path(segment), "ab")
+
+    def _writeBatch(self, edits):
+        if not edits:
+            return
+        start = monotonic()
+        pack = self.EDIT.pack
+        tileFields = self.tileMapper.tileFields
+        payload = "".join(
+            [pack(x, y, *tileFields(tile)) for x, y, tile in edits])
+        self._file.write(self.BATCH.pack(
+            len(edits), zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.syncHistogram.observe(monotonic() - start)
+        self.appends += len(edits)
+        self.batches += 1
+        self.bytesWritten += self.BATCH.size + len(payload)
+
+    def _deleteBefore(self, segment):
+        for number in self.segments():
+            if number >= segment:
+                break
+            os.remove(self._path(number))
+
+    def report(self):
+        return ["journal: segment=%d appends=%d batches=%d bytes=%d "
+                "pending=%d sync: %s" % (
+                    self._segment or 0, self.appends, self.batches,
+                    self.bytesWritten, len(self._queue),
+                    self.syncHistogram.summary())]
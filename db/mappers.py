@@ -1,3 +1,16 @@
+from array import array
+from hashlib import sha1
+from struct import Struct
+import sys
+import zlib
+
+from game.snapshots import HEADER_FIELDS
+from game.tiles import Tile, SECTION_WIDTH, SECTION_HEIGHT
+from game.world import WorldHeader
+
+# Indices are stored little endian
+BIG_ENDIAN = sys.byteorder == "big"
+
 class WorldMapper(object):
     """
     Maps L{World} and L{WorldEntity} objects
@@ -43,7 +56,8 @@ class WorldMapper(object):
         """
         
         domain.worldId = entity.id
-        domain.name = entity.name
+        # the domain (and the protocol) use byte strings
+        domain.name = entity.name.encode("utf-8")
         domain.time = entity.time
         domain.width = entity.width
         domain.height = entity.height
@@ -70,3 +84,121 @@ class WorldMapper(object):
         domain.invasionSize = entity.invasionSize
         domain.invasionType = entity.invasionType
         domain.invasionX = entity.invasionX
+
+    def entityToHeader(self, entity):
+        """
+        Maps a L{WorldEntity} to a L{WorldHeader}
+        """
+
+        fields = {}
+        for name in HEADER_FIELDS:
+            if name not in ('worldId', 'name', 'spawn'):
+                fields[name] = getattr(entity, name)
+        fields['worldId'] = entity.id
+        fields['name'] = entity.name.encode("utf-8")
+        fields['spawn'] = (entity.spawnX, entity.spawnY)
+        return WorldHeader(**fields)
+
+    def headerToDomain(self, header, domain):
+        """
+        Maps a L{WorldHeader} to a L{World} object
+        """
+
+        for name in HEADER_FIELDS:
+            setattr(domain, name, getattr(header, name))
+
+
+class TileSectionMapper(object):
+    """
+    Encodes the tiles of a L{TileSection} into the BLOB stored in a
+    L{TileSectionEntity}, and back.
+
+    Sections hold a few distinct tiles many times over, so the encoding
+    is a palette of the distinct tiles followed by one palette index per
+    tile slot, row by row, all compressed with zlib::
+
+        byte: format (L{FORMAT})
+        uint16: palette size, 0 for a section which was never allocated
+        palette entries (L{PALETTE_ENTRY})
+        indices: a byte each, or a little endian uint16 each past 256
+            palette entries
+    """
+
+    FORMAT = 1
+    HEADER = Struct("<BH")
+    # tile type, frame x, frame y, wall, liquid, flags
+    PALETTE_ENTRY = Struct("<hhhhhB")
+    LAVA = 1
+    LIGHTED = 2
+    ACTIVE = 4
+    COMPRESSION_LEVEL = 6
+
+    def tileFields(self, tile):
+        """
+        Returns the values of a L{PALETTE_ENTRY} describing C{tile}.
+        """
+        return (tile.tileType, tile.frameX, tile.frameY, tile.wall,
+                tile.liquid,
+                (tile.isLava and self.LAVA) |
+                (tile.isLighted and self.LIGHTED) |
+                (tile.active and self.ACTIVE))
+
+    def tileFromFields(self, tileType, frameX, frameY, wall, liquid, flags):
+        """
+        Returns the tile described by the values of a L{PALETTE_ENTRY}.
+        """
+        return Tile(
+            tileType, frameX, frameY, wall, liquid, bool(flags & self.LAVA),
+            bool(flags & self.LIGHTED), bool(flags & self.ACTIVE))
+
+    def encode(self, tiles):
+        """
+        Encodes a section's tiles, C{None} for a section which was never
+        allocated.
+
+        @return: C{(blob, hash)}
+        """
+        if tiles is None:
+            raw = self.HEADER.pack(self.FORMAT, 0)
+        else:
+            # ordered, so equal sections always encode (and hash) the same
+            palette = sorted(set(tiles), key=Tile.sortKey)
+            lookup = dict((tile, i) for i, tile in enumerate(palette))
+            parts = [self.HEADER.pack(self.FORMAT, len(palette))]
+            for tile in palette:
+                parts.append(self.PALETTE_ENTRY.pack(*self.tileFields(tile)))
+            indices = array(
+                'B' if len(palette) <= 256 else 'H',
+                map(lookup.__getitem__, tiles))
+            if BIG_ENDIAN:
+                indices.byteswap()
+            parts.append(indices.tostring())
+            raw = "".join(parts)
+        return zlib.compress(raw, self.COMPRESSION_LEVEL), sha1(raw).hexdigest()
+
+    def decode(self, blob):
+        """
+        Decodes a BLOB made by L{encode}.
+
+        @return: the list of tiles, or C{None} for a section which was
+            never allocated
+        """
+        raw = zlib.decompress(blob)
+        version, paletteSize = self.HEADER.unpack_from(raw)
+        if version != self.FORMAT:
+            raise ValueError("Unknown tile section format %d" % (version,))
+        if not paletteSize:
+            return None
+        pos = self.HEADER.size
+        palette = []
+        for i in xrange(paletteSize):
+            palette.append(self.tileFromFields(
+                *self.PALETTE_ENTRY.unpack_from(raw, pos)))
+            pos += self.PALETTE_ENTRY.size
+        indices = array('B' if paletteSize <= 256 else 'H')
+        indices.fromstring(raw[pos:])
+        if BIG_ENDIAN:
+            indices.byteswap()
+        if len(indices) != SECTION_WIDTH * SECTION_HEIGHT:
+            raise ValueError("Tile section has %d tiles" % (len(indices),))
+        return map(palette.__getitem__, indices)
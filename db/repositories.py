@@ -1,25 +1,50 @@
-from sqlalchemy.orm.query import Query
+import threading
 
-from db.entities import WorldEntity
-from db.mappers import WorldMapper
+from sqlalchemy import and_, bindparam, or_
+from twisted.internet.defer import fail, succeed
+
+from db.entities import WorldEntity, TileSectionEntity, \
+    ImportCheckpointEntity
+from db.mappers import WorldMapper, TileSectionMapper
+from game.tiles import TileSection, SECTION_WIDTH, SECTION_HEIGHT
+from util.cache import LRUCache
+from util.metrics import registry
+
+# Sections written or read per database round-trip
+SECTION_BATCH_SIZE = 64
+# World headers kept by a CachingWorldRepository
+DEFAULT_CACHE_SIZE = 128
 
 
 class BaseRepository(object):
     """
     Base repository class for entity persistance
+
+    Repository methods never touch the database on the calling thread:
+    they return a L{Deferred} and do the work through
+    L{DatabaseAdapter.runInSession}. Domain objects are mapped to
+    entities before the work is queued, so what is saved is the state at
+    the time of the call, whatever the game does to them meanwhile.
     """
 
     def __init__(self, databaseAdapter):
         super(BaseRepository, self).__init__()
-        
+
         self.databaseAdapter = databaseAdapter
 
-    def _saveEntity(self, entity):
+    def _saveEntity(self, session, entity):
         """
-        Persists an entity object
+        Persists an entity object, inserting it or, if it has an id
+        already, updating the existing row.
+
+        @return: the id of the saved entity
         """
-        self.databaseAdapter.session.add(entity)
-        self.databaseAdapter.session.flush()
+        if entity.id is None:
+            session.add(entity)
+        else:
+            entity = session.merge(entity)
+        session.flush()
+        return entity.id
 
 
 class WorldRepository(BaseRepository):
@@ -28,23 +53,470 @@ class WorldRepository(BaseRepository):
     """
 
     worldMapper = WorldMapper()
+    sectionMapper = TileSectionMapper()
 
     def getWorld(self, world):
         """
-        Retrieves a L{World}
+        Retrieves a L{World}, filling in C{world} from the row matching its
+        id or name.
+
+        @return: a L{Deferred} firing with C{world}
         """
-        q = self.databaseAdapter.session.query(WorldEntity)
-        if world.worldId > 0:
-            q = q.filter_by(id=world.worldId)
-        if len(world.name) > 1:
-            q = q.filter_by(name=world.name)
+        d = self.getWorldHeader(world.worldId, world.name)
+        d.addCallback(self._gotWorld, world)
+        return d
+
+    def _gotWorld(self, header, world):
+        if header is not None:
+            self.worldMapper.headerToDomain(header, world)
+        return world
+
+    def getWorldHeader(self, worldId=0, name=""):
+        """
+        Retrieves the L{WorldHeader} of the world with the given id or
+        name, without building a L{World}.
+
+        @return: a L{Deferred} firing with the header, or C{None} if there
+            is no such world
+        """
+        d = self.databaseAdapter.runInSession(
+            self._findWorld, worldId, name)
+        d.addCallback(self._gotWorldEntity)
+        return d
+
+    def _findWorld(self, session, worldId, name):
+        q = session.query(WorldEntity)
+        if worldId > 0:
+            q = q.filter_by(id=worldId)
+        if len(name) > 1:
+            q = q.filter_by(name=name)
         entity = q.first()
-        self.worldMapper.entityToDomain(entity, world)
+        if entity is not None:
+            # the entity is used back on the calling thread
+            session.expunge(entity)
+        return entity
+
+    def _gotWorldEntity(self, entity):
+        if entity is None:
+            return None
+        return self.worldMapper.entityToHeader(entity)
 
     def saveWorld(self, world):
         """
-        Persists a L{World} domain object.
+        Persists a L{World} domain object, setting its C{worldId} when it
+        is saved for the first time.
+
+        @return: a L{Deferred} firing with C{world}
         """
         entity = WorldEntity()
         self.worldMapper.domainToEntity(world, entity)
-        BaseRepository._saveEntity(self, entity)
+        if world.worldId > 0:
+            entity.id = world.worldId
+        d = self.databaseAdapter.runInSession(self._saveEntity, entity)
+        d.addCallback(self._savedWorld, world)
+        return d
+
+    def _savedWorld(self, worldId, world):
+        world.worldId = worldId
+        return world
+
+    def saveSections(self, world, sections=None):
+        """
+        Persists the tiles of C{sections}, all of the world's sections by
+        default, skipping those whose stored content is the same. The
+        world must have been saved already.
+
+        C{world} may be a L{World} or a L{WorldSnapshot}. The sections are
+        saved as they are in a snapshot taken before returning, so the
+        game can keep changing them while the database thread encodes and
+        writes them, L{SECTION_BATCH_SIZE} sections per statement.
+
+        @return: a L{Deferred} firing with C{(sections written, bytes
+            written)}
+        """
+        if world.worldId <= 0:
+            return fail(ValueError("%r has not been saved" % (world,)))
+        snapshot = world.snapshot()
+        if sections is None:
+            views = snapshot.sections()
+        else:
+            views = [snapshot.viewOf(section) for section in sections]
+        rows = [(view.x, view.y, view.version, view.tiles) for view in views]
+        d = self.databaseAdapter.runInSession(
+            self._saveSections, world.worldId, rows)
+        d.addBoth(self._releaseSnapshot, snapshot)
+        return d
+
+    def _releaseSnapshot(self, result, snapshot):
+        snapshot.release()
+        return result
+
+    def _saveSections(self, session, worldId, snapshot):
+        encoded = []
+        for x, y, version, tiles in snapshot:
+            blob, digest = self.sectionMapper.encode(tiles)
+            encoded.append((x, y, version, digest, blob))
+        return self._writeSections(session, worldId, encoded)
+
+    def _writeSections(self, session, worldId, encoded):
+        """
+        Writes C{(x, y, version, hash, blob)} rows, skipping those whose
+        stored hash is the same.
+
+        @return: C{(sections written, bytes written)}
+        """
+        table = TileSectionEntity.__table__
+        stored = dict(
+            ((x, y), digest) for x, y, digest in session.query(
+                TileSectionEntity.x, TileSectionEntity.y,
+                TileSectionEntity.hash).filter_by(worldId=worldId))
+        inserts = []
+        updates = []
+        written = 0
+        size = 0
+        for x, y, version, digest, blob in encoded:
+            if stored.get((x, y)) == digest:
+                continue
+            row = {
+                'section_worldId': worldId, 'section_x': x, 'section_y': y,
+                'version': version, 'hash': digest, 'tiles': blob}
+            if (x, y) in stored:
+                updates.append(row)
+            else:
+                inserts.append(row)
+            written += 1
+            size += len(blob)
+            if len(inserts) >= SECTION_BATCH_SIZE:
+                self._insertSections(session, table, inserts)
+                inserts = []
+            if len(updates) >= SECTION_BATCH_SIZE:
+                self._updateSections(session, table, updates)
+                updates = []
+        if inserts:
+            self._insertSections(session, table, inserts)
+        if updates:
+            self._updateSections(session, table, updates)
+        return written, size
+
+    def _insertSections(self, session, table, rows):
+        session.execute(
+            table.insert().values(
+                worldId=bindparam('section_worldId'),
+                x=bindparam('section_x'), y=bindparam('section_y')),
+            rows)
+
+    def _updateSections(self, session, table, rows):
+        session.execute(
+            table.update().where(and_(
+                table.c.worldId == bindparam('section_worldId'),
+                table.c.x == bindparam('section_x'),
+                table.c.y == bindparam('section_y'))),
+            rows)
+
+    def sectionDigests(self, world, isStored):
+        """
+        Lists the stored sections of a world without reading their tiles,
+        and reads the BLOBs of those whose hash C{isStored} returns false
+        for, in the same transaction. C{isStored} is called on a database
+        thread.
+
+        @return: a L{Deferred} firing with C{(digests, missing, blobs)}: a
+            list of C{(x, y, version, hash)}, the set of hashes
+            C{isStored} returned false for and a dict of hash to BLOB.
+            Unless the database isolates reads from a save made meanwhile,
+            hashes in C{missing} can be absent from C{blobs}.
+        """
+        return self.databaseAdapter.runInSession(
+            self._sectionDigests, world.worldId, isStored)
+
+    def _sectionDigests(self, session, worldId, isStored):
+        digests = session.query(
+            TileSectionEntity.x, TileSectionEntity.y,
+            TileSectionEntity.version, TileSectionEntity.hash).filter_by(
+                worldId=worldId).order_by(
+                    TileSectionEntity.x, TileSectionEntity.y).all()
+        missing = set(digest for x, y, version, digest in digests
+                      if not isStored(digest))
+        return digests, missing, self._sectionBlobs(
+            session, worldId, list(missing))
+
+    def _sectionBlobs(self, session, worldId, digests):
+        blobs = {}
+        for i in xrange(0, len(digests), SECTION_BATCH_SIZE):
+            batch = digests[i:i + SECTION_BATCH_SIZE]
+            query = session.query(
+                TileSectionEntity.hash, TileSectionEntity.tiles).filter(
+                    TileSectionEntity.worldId == worldId,
+                    TileSectionEntity.hash.in_(batch))
+            for digest, blob in query:
+                blobs[digest] = blob
+        return blobs
+
+    def replaceSections(self, world, encoded):
+        """
+        Makes the world's stored sections exactly C{encoded}, a list of
+        C{(x, y, version, hash, blob)}: sections whose hash differs are
+        written and sections which are not listed are deleted.
+
+        @return: a L{Deferred} firing with C{(sections written, bytes
+            written)}
+        """
+        if world.worldId <= 0:
+            return fail(ValueError("%r has not been saved" % (world,)))
+        return self.databaseAdapter.runInSession(
+            self._replaceSections, world.worldId, list(encoded))
+
+    def _replaceSections(self, session, worldId, encoded):
+        keep = set((x, y) for x, y, version, digest, blob in encoded)
+        for x, y in session.query(
+                TileSectionEntity.x, TileSectionEntity.y).filter_by(
+                    worldId=worldId).all():
+            if (x, y) not in keep:
+                session.query(TileSectionEntity).filter_by(
+                    worldId=worldId, x=x, y=y).delete()
+        return self._writeSections(session, worldId, encoded)
+
+    def getImportCheckpoint(self, world):
+        """
+        Retrieves how far an interrupted import into the world got.
+
+        @return: a L{Deferred} firing with C{(file name, file size, file
+            modification time, header hash, next column, file offset)},
+            or C{None} if no import is in progress
+        """
+        return self.databaseAdapter.runInSession(
+            self._getImportCheckpoint, world.worldId)
+
+    def _getImportCheckpoint(self, session, worldId):
+        return session.query(
+            ImportCheckpointEntity.fileName, ImportCheckpointEntity.fileSize,
+            ImportCheckpointEntity.fileModified,
+            ImportCheckpointEntity.headerHash,
+            ImportCheckpointEntity.nextColumn,
+            ImportCheckpointEntity.fileOffset).filter_by(
+                worldId=worldId).first()
+
+    def importSections(self, world, encoded, checkpoint=None, bounds=None):
+        """
+        Writes a batch of imported C{(x, y, version, hash, blob)} rows,
+        skipping those whose stored hash is the same, and records
+        C{checkpoint} (see L{getImportCheckpoint}) in the same
+        transaction, so the stored checkpoint always matches the stored
+        sections. Without a checkpoint the import is complete and its
+        checkpoint is deleted.
+
+        Sections which are not in the batch are kept, since they belong
+        to the other batches. For the first batch, C{bounds} gives the
+        imported world's C{(section columns, section rows)}, and the
+        stored sections outside them, left over from a larger world, are
+        deleted.
+
+        @return: a L{Deferred} firing with C{(sections written, bytes
+            written)}
+        """
+        if world.worldId <= 0:
+            return fail(ValueError("%r has not been saved" % (world,)))
+        return self.databaseAdapter.runInSession(
+            self._importSections, world.worldId, encoded, checkpoint, bounds)
+
+    def _importSections(self, session, worldId, encoded, checkpoint,
+                        bounds):
+        if bounds is not None:
+            columns, rows = bounds
+            session.query(TileSectionEntity).filter(
+                TileSectionEntity.worldId == worldId,
+                or_(TileSectionEntity.x >= columns,
+                    TileSectionEntity.y >= rows)).delete(
+                        synchronize_session=False)
+        result = self._writeSections(session, worldId, encoded)
+        if checkpoint is None:
+            session.query(ImportCheckpointEntity).filter_by(
+                worldId=worldId).delete()
+        else:
+            entity = ImportCheckpointEntity()
+            entity.worldId = worldId
+            (entity.fileName, entity.fileSize, entity.fileModified,
+             entity.headerHash, entity.nextColumn,
+             entity.fileOffset) = checkpoint
+            session.merge(entity)
+        return result
+
+    def loadSections(self, world):
+        """
+        Replaces the world's sections with those stored for it. Sections
+        which were never saved are left empty.
+
+        @return: a L{Deferred} firing with C{world}
+        """
+        columns = -(-world.width // SECTION_WIDTH)
+        rows = -(-world.height // SECTION_HEIGHT)
+        d = self.databaseAdapter.runInSession(
+            self._loadSections, world.worldId, columns, rows)
+        d.addCallback(self._gotSections, world)
+        return d
+
+    def _loadSections(self, session, worldId, columns, rows):
+        tileSections = []
+        for x in xrange(columns):
+            column = []
+            for y in xrange(rows):
+                section = TileSection()
+                section.x = x
+                section.y = y
+                column.append(section)
+            tileSections.append(column)
+
+        query = session.query(
+            TileSectionEntity.x, TileSectionEntity.y,
+            TileSectionEntity.version, TileSectionEntity.tiles).filter_by(
+                worldId=worldId).yield_per(SECTION_BATCH_SIZE)
+        for x, y, version, blob in query:
+            if x >= columns or y >= rows:
+                continue
+            section = tileSections[x][y]
+            section.tiles = self.sectionMapper.decode(blob)
+            section.allocated = section.tiles is not None
+            section.version = version
+        return tileSections
+
+    def _gotSections(self, tileSections, world):
+        world.tileSections = tileSections
+        return world
+
+    def readSectionColumns(self, world, consume):
+        """
+        Calls C{consume(columns)} on a database thread, with an iterator
+        over the world's stored section columns, left to right. Each
+        column is read with a query of its own as the iterator gets to
+        it, so only one column of sections is in memory at a time
+        whatever the size of the world.
+
+        Each column is a list of the tiles of each of its sections, top
+        to bottom, or C{None} for sections which were never saved or
+        allocated.
+
+        @return: a L{Deferred} firing with what C{consume} returned
+        """
+        columns = -(-world.width // SECTION_WIDTH)
+        rows = -(-world.height // SECTION_HEIGHT)
+        return self.databaseAdapter.runInSession(
+            self._readSectionColumns, world.worldId, columns, rows, consume)
+
+    def _readSectionColumns(self, session, worldId, columns, rows, consume):
+        return consume(self._sectionColumns(session, worldId, columns, rows))
+
+    def _sectionColumns(self, session, worldId, columns, rows):
+        for x in xrange(columns):
+            column = [None] * rows
+            query = session.query(
+                TileSectionEntity.y, TileSectionEntity.tiles).filter_by(
+                    worldId=worldId, x=x).yield_per(SECTION_BATCH_SIZE)
+            for y, blob in query:
+                if y < rows:
+                    column[y] = self.sectionMapper.decode(blob)
+            yield column
+
+
+class CachingWorldRepository(WorldRepository):
+    """
+    A L{WorldRepository} which keeps the L{WorldHeader}s it looked up, the
+    L{DEFAULT_CACHE_SIZE} most recently used by default, so looking a
+    world up again by id or name does not query the database. Worlds
+    which were not found are not kept.
+
+    Saving a world drops its header, both when the save is queued and
+    once it is written, and a lookup which started before a save does not
+    store what it read.
+
+    @ivar headers: An L{LRUCache} of world id to L{WorldHeader}.
+    """
+
+    def __init__(self, databaseAdapter, cacheSize=DEFAULT_CACHE_SIZE):
+        super(CachingWorldRepository, self).__init__(databaseAdapter)
+
+        self.headers = LRUCache(cacheSize)
+        # world name to id, for the headers kept
+        self._ids = {}
+        # bumped by every invalidation
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def registerMetrics(self, metrics=registry):
+        metrics.addGauge(
+            "terraria_world_cache_hits_total", "World lookups found cached",
+            lambda: self.headers.hits, "counter")
+        metrics.addGauge(
+            "terraria_world_cache_misses_total",
+            "World lookups which queried the database",
+            lambda: self.headers.misses, "counter")
+        metrics.addGauge(
+            "terraria_world_cache_evictions_total",
+            "World headers dropped to make room",
+            lambda: self.headers.evictions, "counter")
+        metrics.addGauge(
+            "terraria_world_cache_entries", "World headers cached",
+            lambda: len(self.headers))
+
+    def getWorldHeader(self, worldId=0, name=""):
+        with self._lock:
+            if worldId > 0:
+                header = self.headers.get(worldId)
+            else:
+                header = self.headers.get(self._ids.get(name))
+            generation = self._generation
+        # the database would not find a world whose id and name differ
+        if header is not None and (len(name) <= 1 or header.name == name):
+            return succeed(header)
+        d = super(CachingWorldRepository, self).getWorldHeader(
+            worldId, name)
+        d.addCallback(self._cacheHeader, generation)
+        return d
+
+    def _cacheHeader(self, header, generation):
+        if header is None:
+            return None
+        with self._lock:
+            if generation == self._generation:
+                self._ids[header.name] = header.worldId
+                for worldId, evicted in self.headers.put(
+                        header.worldId, header):
+                    if self._ids.get(evicted.name) == worldId:
+                        del self._ids[evicted.name]
+        return header
+
+    def saveWorld(self, world):
+        self.invalidate(world.worldId, world.name)
+        d = super(CachingWorldRepository, self).saveWorld(world)
+        d.addCallback(self._invalidateSaved)
+        return d
+
+    def _invalidateSaved(self, world):
+        self.invalidate(world.worldId, world.name)
+        return world
+
+    def invalidate(self, worldId=0, name=""):
+        """
+        Drops the cached header of a world, by its id or name.
+        """
+        with self._lock:
+            self._generation += 1
+            if worldId <= 0:
+                worldId = self._ids.get(name)
+                if worldId is None:
+                    return
+            header = self.headers.pop(worldId)
+            names = [name]
+            if header is not None:
+                names.append(header.name)
+            for cachedName in names:
+                if self._ids.get(cachedName) == worldId:
+                    del self._ids[cachedName]
+
+    def report(self):
+        lookups = self.headers.hits + self.headers.misses
+        return ["world cache: entries=%d/%d hits=%d misses=%d "
+                "evictions=%d hit ratio=%.1f%%" % (
+                    len(self.headers), self.headers.maxSize,
+                    self.headers.hits, self.headers.misses,
+                    self.headers.evictions,
+                    100.0 * self.headers.hits / lookups if lookups else 0.0)]
@@ -0,0 +1,237 @@
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+
+from util.metrics import Histogram, registry
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+# Upper bounds (in seconds) of the save duration histogram buckets
+SAVE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Autosaver(object):
+    """
+    Periodically writes the world and the tile sections which changed
+    since they were last saved.
+
+    A section is dirty when its C{version} differs from the version it
+    had when it was last written. Each save takes a L{WorldSnapshot},
+    which is the only part of it done on the reactor thread, and writes
+    the dirty sections of the snapshot; encoding and writing happen on
+    the database threads (see L{WorldRepository.saveSections}). A save
+    requested while another is in flight is coalesced into a single save
+    started once the current one finishes. A failed save leaves its
+    sections dirty, so they are written by the next one.
+
+    If the autosaver has a L{TileJournal}, each save starts a new journal
+    segment just before its snapshot, and checkpoints the journal once
+    the snapshot's sections are written.
+
+    @ivar durationHistogram: A L{Histogram} of the time from starting a
+        save until it was written.
+    @ivar pauseHistogram: A L{Histogram} of the time the reactor spent
+        taking snapshots and queueing their dirty sections.
+    @ivar saves: Number of saves completed.
+    @ivar failures: Number of saves which failed.
+    @ivar sectionsWritten: Sections written by all saves.
+    @ivar bytesWritten: Compressed section bytes written by all saves.
+    """
+
+    def __init__(self, world, repository, interval, clock=reactor,
+                 journal=None):
+        self.world = world
+        self.repository = repository
+        self.journal = journal
+        self.interval = interval
+        self.clock = clock
+        self.durationHistogram = Histogram(SAVE_BUCKETS)
+        self.pauseHistogram = Histogram()
+        self.saves = 0
+        self.failures = 0
+        self.sectionsWritten = 0
+        self.bytesWritten = 0
+        self._savedVersions = {}
+        self._saving = None
+        self._queued = []
+        self._call = None
+
+    def registerMetrics(self, metrics=registry):
+        metrics.addHistogram(
+            "terraria_autosave_seconds",
+            "Time from starting an autosave until it was written",
+            self.durationHistogram)
+        metrics.addHistogram(
+            "terraria_autosave_pause_seconds",
+            "Time the reactor spent snapshotting sections for an autosave",
+            self.pauseHistogram)
+        metrics.addGauge(
+            "terraria_autosaves_total", "Autosaves completed",
+            lambda: self.saves, "counter")
+        metrics.addGauge(
+            "terraria_autosave_failures_total", "Autosaves which failed",
+            lambda: self.failures, "counter")
+        metrics.addGauge(
+            "terraria_autosave_sections_total", "Tile sections written",
+            lambda: self.sectionsWritten, "counter")
+        metrics.addGauge(
+            "terraria_autosave_bytes_total",
+            "Compressed tile section bytes written",
+            lambda: self.bytesWritten, "counter")
+        metrics.addGauge(
+            "terraria_autosave_dirty_sections",
+            "Tile sections changed since they were last saved",
+            lambda: len(self.dirtySections()))
+
+    def start(self):
+        """
+        Saves every C{interval} seconds until the reactor shuts down,
+        when the pending changes are saved one last time. With an
+        interval of 0 only that last save is made, which still
+        checkpoints the journal.
+        """
+
+        if self.interval:
+            self._call = LoopingCall(self.save)
+            self._call.clock = self.clock
+            self._call.start(self.interval, now=False)
+        self.clock.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        """
+        Stops saving periodically and saves what changed since the last
+        save.
+
+        @return: a L{Deferred} firing once that save is written
+        """
+
+        if self._call is not None and self._call.running:
+            self._call.stop()
+        return self.save()
+
+    def markSaved(self, sections=None):
+        """
+        Marks C{sections}, all of the world's sections by default, as
+        saved, e.g. after they were loaded from the database.
+        """
+
+        if sections is None:
+            sections = self._allSections()
+        for section in sections:
+            self._savedVersions[section.x, section.y] = section.version
+
+    def _allSections(self):
+        return [section for column in self.world.tileSections
+                for section in column if section is not None]
+
+    def _isDirty(self, section):
+        return self._savedVersions.get(
+            (section.x, section.y), -1) != section.version
+
+    def dirtySections(self):
+        """
+        Returns the sections which changed since they were last saved.
+        """
+
+        return filter(self._isDirty, self._allSections())
+
+    def save(self):
+        """
+        Saves the world and its dirty sections, or, if a save is in
+        flight, queues one to start when it finishes.
+
+        @return: a L{Deferred} firing with C{(sections written, bytes
+            written)} once the save is written, never with a failure
+        """
+
+        if self._saving is None:
+            return self._startSave()
+        d = Deferred()
+        self._queued.append(d)
+        return d
+
+    def _startSave(self):
+        start = monotonic()
+        if self.world.worldId > 0:
+            self.repository.saveWorld(self.world).addErrback(
+                self._failedWorldSave)
+            d = self._saveSections()
+        else:
+            # the sections need the world's id, so it is written first
+            d = self.repository.saveWorld(self.world)
+            d.addCallback(lambda world: self._saveSections())
+        # set before the callbacks, which may run right away
+        self._saving = d
+        d.addCallbacks(self._saved, self._failed, callbackArgs=(start,))
+        d.addBoth(self._finished)
+        return d
+
+    def _saveSections(self):
+        start = monotonic()
+        segment = None
+        if self.journal is not None:
+            # edits made from now on may be missing from the snapshot
+            segment = self.journal.rotate()
+        snapshot = self.world.snapshot()
+        sections = filter(self._isDirty, snapshot.sections())
+        if sections:
+            d = self.repository.saveSections(snapshot, sections)
+        else:
+            d = succeed((0, 0))
+        # the repository holds its own reference until it is done
+        snapshot.release()
+        self.pauseHistogram.observe(monotonic() - start)
+        d.addCallback(self._sectionsSaved, sections, segment)
+        return d
+
+    def _sectionsSaved(self, result, sections, segment):
+        self.markSaved(sections)
+        if segment is not None:
+            self.journal.checkpoint(segment)
+        return result
+
+    def _failedWorldSave(self, failure):
+        logger.error("Error autosaving %r: %s", self.world,
+                     failure.getTraceback())
+
+    def _saved(self, result, start):
+        written, size = result
+        elapsed = monotonic() - start
+        self.durationHistogram.observe(elapsed)
+        self.saves += 1
+        self.sectionsWritten += written
+        self.bytesWritten += size
+        log = logger.info if written else logger.debug
+        log("Autosaved %r: %d sections, %d bytes in %.3fs",
+            self.world, written, size, elapsed)
+        return result
+
+    def _failed(self, failure):
+        self.failures += 1
+        logger.error(
+            "Error autosaving %r, changes are kept for the next save: %s",
+            self.world, failure.getTraceback())
+        return (0, 0)
+
+    def _finished(self, result):
+        self._saving = None
+        queued, self._queued = self._queued, []
+        if queued:
+            self._startSave().addCallback(self._notify, queued)
+        return result
+
+    def _notify(self, result, waiting):
+        for d in waiting:
+            d.callback(result)
+        return result
+
+    def report(self):
+        return ["autosave: %s pause: %s saves=%d failures=%d sections=%d "
+                "bytes=%d dirty=%d" % (
+                    self.durationHistogram.summary(),
+                    self.pauseHistogram.summary(), self.saves,
+                    self.failures, self.sectionsWritten, self.bytesWritten,
+                    len(self.dirtySections()))]
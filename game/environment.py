@@ -1,7 +1,12 @@
-from twisted.internet.task import LoopingCall, Clock
+import math
 
+from zope.interface import implements
+from twisted.internet.interfaces import IReactorTime
 
-class SimulationTime(Clock):
+from util.wheel import TimingWheel
+
+
+class SimulationTime(object):
     """
     A mechanism for performing updates to simulations such that all
     updates occur at the same instant.
@@ -10,6 +15,12 @@ class SimulationTime(Clock):
     is called, it is guaranteed that no "time" (according to
     L{SimulationTime.seconds}) will pass until the function returns.
 
+    Model time is computed lazily from the platform clock instead of
+    being advanced every frame. Pending calls are kept on a
+    L{TimingWheel} with one tick per frame, and a single platform timer
+    is armed for the earliest frame which may have work, so an idle
+    simulation costs nothing between events.
+
     @ivar platformClock: A provider of
         L{twisted.internet.interfaces.IReactorTime} which will be used
         to update the model time.
@@ -20,32 +31,140 @@ class SimulationTime(Clock):
         return 0 for 0.5 seconds, then 0.5 for 0.5 seconds, then 1 for
         0.5 seconds, and so on. This number directly represents the
         B{model} frames per second.
+
+    @ivar driver: An object which runs pending calls itself every frame
+        through L{runPending} (e.g. a L{game.ticks.TickEngine}), or
+        C{None} to use the platform timer.
     """
 
+    implements(IReactorTime)
+
     def __init__(self, granularity, platformClock):
-        Clock.__init__(self)
         self.granularity = granularity
         self.platformClock = platformClock
+        self.rightNow = 0.0
+        self._wheel = TimingWheel(granularity, self.seconds, self._arm)
+        self._origin = None
+        self._call = None
+        self._armedAt = None
+        self._dispatching = False
+        self.driver = None
+
+    def _floorInstant(self, seconds):
+        """
+        Rounds C{seconds} down to the start of the frame containing it.
+        """
+
+        return math.floor(seconds * self.granularity) / self.granularity
+
+    def seconds(self):
+        """
+        The current model time, frozen while pending calls are dispatched.
+        """
+
+        if self._dispatching:
+            return max(
+                float(self._wheel.tick) / self.granularity, self.rightNow)
+        if self._origin is not None:
+            now = self._floorInstant(
+                self.platformClock.seconds() - self._origin)
+            if now > self.rightNow:
+                self.rightNow = now
+        return self.rightNow
+
+    def callLater(self, when, what, *a, **kw):
+        call = self._wheel.schedule(self.seconds() + when, what, a, kw)
+        self._arm()
+        return call
+
+    def getDelayedCalls(self):
+        return self._wheel.getDelayedCalls()
+
+    def advance(self, amount):
+        """
+        Moves model time forward by C{amount} seconds, running every call
+        which becomes due.
+        """
+
+        self._runUntil(self.seconds() + amount)
+
+    def setDriver(self, driver):
+        """
+        Hands the dispatching of pending calls over to C{driver}, or back
+        to the platform timer if C{driver} is C{None}.
+        """
+
+        self.driver = driver
+        if driver is None:
+            self._arm()
+        else:
+            self._disarm()
+
+    def runPending(self, instant):
+        """
+        Runs every call due on or before C{instant}.
+        """
+
+        self._runUntil(instant)
+
+    def _runUntil(self, instant):
+        self._dispatching = True
+        try:
+            self._wheel.runUntil(instant)
+        finally:
+            self._dispatching = False
+            self.rightNow = max(self.rightNow, instant)
+            self._arm()
 
-    def _update(self, frames):
+    def _arm(self):
         """
-        Advance the simulation time by one "tick", or one over granularity.
+        Makes sure the platform timer fires no later than the frame when
+        the earliest pending call is due.
         """
 
-        self.advance(1.0 * frames / self.granularity)
+        if self._origin is None or self._dispatching or \
+                self.driver is not None:
+            return
+
+        due = self._wheel.nextTime()
+        if due is None:
+            self._disarm()
+            return
+        if self._call is not None and self._armedAt <= due:
+            return
+
+        self._disarm()
+        delay = self._origin + due - self.platformClock.seconds()
+        self._armedAt = due
+        self._call = self.platformClock.callLater(max(0, delay), self._fire)
+
+    def _disarm(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+            self._armedAt = None
+
+    def _fire(self):
+        instant = max(self.seconds(), self._armedAt)
+        self._call = None
+        self._armedAt = None
+        self._runUntil(instant)
 
     def start(self):
         """
         Start the simulated advancement of time.
         """
 
-        self._call = LoopingCall.withCount(self._update)
-        self._call.clock = self.platformClock
-        self._call.start(1.0 / self.granularity, now=False)
+        self._origin = self.platformClock.seconds() - self.rightNow
+        self._arm()
 
     def stop(self):
         """
-        Stop the simulated advancement of time. Clean up all pending calls.
+        Stop the simulated advancement of time. Pending calls are kept and
+        will resume when the simulation is started again.
         """
 
-        self._call.stop()
+        self.seconds()
+        self._disarm()
+        self._origin = None
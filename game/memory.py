@@ -0,0 +1,159 @@
+import gc
+import sys
+
+from game.tiles import Tile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Section storage modes
+UNIFORM = "uniform"
+LIST = "list"
+
+
+def objectBytes(obj):
+    """
+    Estimates the memory used by C{obj} itself, including its instance
+    dictionary but not the objects it refers to.
+    """
+
+    size = sys.getsizeof(obj)
+    instanceDict = getattr(obj, '__dict__', None)
+    if instanceDict is not None:
+        size += sys.getsizeof(instanceDict)
+    return size
+
+
+class SectionMemory(object):
+    """
+    Memory used by one L{game.tiles.TileSection}.
+
+    @ivar bytes: Estimated bytes used by the section and its tile
+        storage, not counting the tiles, which are usually shared with
+        other sections.
+    @ivar caches: A dict of cache name to C{(entries, bytes)}.
+    """
+
+    __slots__ = ('x', 'y', 'mode', 'tileSlots', 'distinctTiles', 'bytes',
+                 'caches')
+
+    def __init__(self, section):
+        self.x = section.x
+        self.y = section.y
+        self.bytes = objectBytes(section)
+        if section.tiles is None:
+            self.mode = UNIFORM
+            self.tileSlots = 0
+            self.distinctTiles = 1
+        else:
+            self.mode = LIST
+            self.tileSlots = len(section.tiles)
+            self.distinctTiles = len(set(map(id, section.tiles)))
+            self.bytes += sys.getsizeof(section.tiles)
+        self.caches = section.cacheSizes()
+
+    def cacheBytes(self):
+        return sum(size for entries, size in self.caches.itervalues())
+
+    def describe(self):
+        caches = " ".join(
+            "%s=%d/%dB" % (name, entries, size)
+            for name, (entries, size) in sorted(self.caches.iteritems()))
+        return "(%d, %d) %-7s tiles=%d distinct=%d bytes=%d %s" % (
+            self.x, self.y, self.mode, self.tileSlots, self.distinctTiles,
+            self.bytes + self.cacheBytes(), caches)
+
+
+class WorldMemoryReport(object):
+    """
+    Walks the sections of a L{World} and estimates the memory they use.
+
+    Tiles are counted once however many sections refer to them, so the
+    tile total reflects how well tiles are being shared.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.sections = []
+        tiles = {}
+        for column in world.tileSections:
+            for section in column:
+                if section is None:
+                    continue
+                self.sections.append(SectionMemory(section))
+                if section.tiles is not None:
+                    for tile in section.tiles:
+                        tiles[id(tile)] = tile
+        self.distinctTiles = len(tiles)
+        self.tileBytes = sum(objectBytes(tile) for tile in tiles.itervalues())
+        self.sectionBytes = sum(s.bytes for s in self.sections)
+        self.cacheBytes = sum(s.cacheBytes() for s in self.sections)
+        snapshots = list(world.snapshots)
+        self.snapshotCount = len(snapshots)
+        self.snapshotBytes = sum(
+            snapshot.extraBytes() for snapshot in snapshots)
+        self.sections.sort(key=lambda s: s.bytes + s.cacheBytes(), reverse=True)
+
+    def totalBytes(self):
+        return (self.sectionBytes + self.tileBytes + self.cacheBytes +
+                self.snapshotBytes)
+
+    def lines(self, limit=10):
+        """
+        Returns the world totals followed by the C{limit} most expensive
+        sections (all of them if C{limit} is C{None}).
+        """
+
+        modes = {}
+        for s in self.sections:
+            modes[s.mode] = modes.get(s.mode, 0) + 1
+        lines = [
+            "%r: %d sections (%s), ~%.1f MB" % (
+                self.world, len(self.sections),
+                ", ".join("%d %s" % (count, mode)
+                          for mode, count in sorted(modes.iteritems())),
+                self.totalBytes() / 1048576.0),
+            "sections and tile storage: %d bytes" % (self.sectionBytes,),
+            "tiles: %d distinct objects, %d bytes, %d interned" % (
+                self.distinctTiles, self.tileBytes, Tile.internedCount()),
+            "caches: %d bytes" % (self.cacheBytes,),
+            "snapshots: %d live, %d bytes of views and copied tiles" % (
+                self.snapshotCount, self.snapshotBytes),
+        ]
+        if limit != 0:
+            lines.append("largest sections:")
+            for s in self.sections[:limit]:
+                lines.append("  " + s.describe())
+        return lines
+
+
+def topAllocators(limit=10):
+    """
+    Returns lines describing where memory is allocated: the top source
+    lines from tracemalloc when it is tracing, otherwise the object types
+    with the most instances known to the garbage collector.
+    """
+
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        lines = ["top allocators (tracemalloc):"]
+        for stat in snapshot.statistics('lineno')[:limit]:
+            lines.append("  %s" % (stat,))
+        return lines
+
+    counts = {}
+    sizes = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+        sizes[name] = sizes.get(name, 0) + sys.getsizeof(obj)
+    if tracemalloc is None:
+        lines = ["top object types (tracemalloc is not available):"]
+    else:
+        lines = ["top object types (tracemalloc is not tracing):"]
+    for name in sorted(counts, key=counts.get, reverse=True)[:limit]:
+        lines.append("  %-28s %9d objects %11d bytes" % (
+            name, counts[name], sizes[name]))
+    return lines
@@ -1,9 +1,20 @@
+# Number of buff slots a player has
+BUFF_SLOTS = 10
+
 
 class Player(object):
     """
     Represents a player in Terraria
     """
 
+    __slots__ = (
+        'skinVarient', 'hair', 'name', 'hairDye', 'hideVisuals',
+        'hideVisuals2', 'hideMisc', 'hairColor', 'eyeColor', 'shoeColor',
+        'life', 'lifeMax', 'isMale', 'skinColor', 'shirtColor',
+        'underShirtColor', 'pantsColor', 'difficulty', 'mana', 'manaMax',
+        'spawn', 'playerId', 'buffs', 'control', 'selectedItem', 'position',
+        'velocity')
+
     def __init__(self):
         super(Player, self).__init__()
 
@@ -28,3 +39,9 @@ class Player(object):
         self.mana = 0
         self.manaMax = 0
         self.spawn = (-1, -1)
+        self.playerId = 0
+        self.buffs = [0] * BUFF_SLOTS
+        self.control = 0
+        self.selectedItem = 0
+        self.position = (0.0, 0.0)
+        self.velocity = (0.0, 0.0)
@@ -15,16 +15,30 @@ class WorldService(object):
     def getWorldByName(self, worldName):
         """
         Gets a L{World} domain object by its name
+
+        @return: a L{Deferred} firing with the L{World}
         """
 
         w = World()
         w.name = worldName
-        self.worldRepository.getWorld(w)
-        return w
+        return self.worldRepository.getWorld(w)
+
+    def getWorldHeaderByName(self, worldName):
+        """
+        Gets the L{WorldHeader} of a world by its name, for callers which
+        only need to know about the world.
+
+        @return: a L{Deferred} firing with the header, or C{None} if there
+            is no such world
+        """
+
+        return self.worldRepository.getWorldHeader(name=worldName)
 
     def saveWorld(self, world):
         """
         Persists a L{World} domain object.
+
+        @return: a L{Deferred} firing with the L{World} once it is saved
         """
 
-        self.worldRepository.saveWorld(world)
+        return self.worldRepository.saveWorld(world)
@@ -0,0 +1,111 @@
+import sys
+import threading
+
+from game.tiles import SECTION_WIDTH, SECTION_HEIGHT
+
+# World attributes copied into a snapshot
+HEADER_FIELDS = (
+    'worldId', 'name', 'time', 'width', 'height', 'spawn', 'worldSurface',
+    'rockLayer', 'isDay', 'isBloodMoon', 'moonPhase', 'shadowOrbSmashed',
+    'bossOneDowned', 'bossTwoDowned', 'bossThreeDowned', 'leftWorld',
+    'rightWorld', 'bottomWorld', 'topWorld', 'version', 'dungeonX',
+    'dungeonY', 'spawnMeteor', 'shadowOrbCount', 'invasionDelay',
+    'invasionSize', 'invasionType', 'invasionX')
+
+
+class WorldSnapshot(object):
+    """
+    A consistent, read-only view of a L{World}: its header fields and a
+    L{SectionSnapshot} of every section, laid out like
+    C{World.tileSections}.
+
+    Taking a snapshot only records a reference to each section's tile
+    list, so it costs O(sections); a section's tiles are copied by the
+    section itself when it is next written to. The snapshot can then be
+    read from any thread while the game carries on.
+
+    Snapshots are reference counted: they start with one reference,
+    L{acquire} adds one and L{release} drops one. Once the last is
+    dropped the sections are told they no longer need to copy on write
+    for this snapshot, which must not be read afterwards.
+
+    @ivar world: The world the snapshot was taken of.
+    @ivar tileSections: Columns of L{SectionSnapshot}s (or C{None} where
+        the world has no section).
+    """
+
+    def __init__(self, world):
+        self.world = world
+        for name in HEADER_FIELDS:
+            setattr(self, name, getattr(world, name))
+        self.tileSections = [
+            [None if section is None else section.share()
+             for section in column]
+            for column in world.tileSections]
+        self._views = dict(
+            (view.section, view) for view in self.sections())
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<WorldSnapshot of %r refs=%d>" % (self.world, self._refs)
+
+    def sections(self):
+        """
+        Returns the L{SectionSnapshot} of every section.
+        """
+        return [view for column in self.tileSections
+                for view in column if view is not None]
+
+    def viewOf(self, section):
+        """
+        Returns this snapshot's view of C{section}, which may also be a
+        view already.
+        """
+        return self._views.get(section, section)
+
+    def getSectionAt(self, coords):
+        return self.tileSections[coords[0] // SECTION_WIDTH][
+            coords[1] // SECTION_HEIGHT]
+
+    def snapshot(self):
+        """
+        A snapshot's snapshot is itself, with one more reference, so code
+        taking one works on a L{World} or a L{WorldSnapshot}.
+        """
+        self.acquire()
+        return self
+
+    def acquire(self):
+        with self._lock:
+            if self._refs <= 0:
+                raise ValueError("%r was already released" % (self,))
+            self._refs += 1
+
+    def release(self):
+        """
+        Drops a reference to the snapshot, freeing it after the last one.
+        May be called from any thread.
+        """
+        with self._lock:
+            self._refs -= 1
+            if self._refs:
+                return
+        for view in self.sections():
+            view.section.unshare(view.tiles)
+        self.tileSections = []
+        self._views = {}
+        self.world.snapshots.discard(self)
+
+    def extraBytes(self):
+        """
+        Estimates the memory the snapshot costs on top of the world: its
+        views, and the tile lists sections have copied since it was
+        taken.
+        """
+        size = 0
+        for view in self.sections():
+            size += sys.getsizeof(view)
+            if view.tiles is not None and not view.isShared():
+                size += sys.getsizeof(view.tiles)
+        return size
@@ -0,0 +1,217 @@
+import logging
+
+from twisted.internet.task import LoopingCall
+
+from util import activity
+from util.metrics import Histogram
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+INPUT = "input"
+SIMULATION = "simulation"
+REPLICATION = "replication"
+PERSISTENCE = "persistence"
+
+
+class Phase(object):
+    """
+    A named, ordered group of tasks which run once per frame.
+
+    @ivar essential: Essential phases run on every frame. Other phases
+        only run on the last frame of a catch-up burst, and are skipped
+        when the frame is already over budget, but never for more than
+        C{maxSkipped} frames in a row.
+    @ivar histogram: A L{Histogram} of how long the phase takes to run.
+    @ivar skipped: Number of frames on which the phase was skipped.
+    """
+
+    def __init__(self, name, essential=True, maxSkipped=0):
+        self.name = name
+        self.label = "tick:%s" % name
+        self.essential = essential
+        self.maxSkipped = maxSkipped
+        self.tasks = []
+        self.histogram = Histogram()
+        self.skipped = 0
+        self._skippedInARow = 0
+
+    def run(self, frame):
+        for task in self.tasks:
+            try:
+                task(frame)
+            except Exception:
+                logger.exception(
+                    "Error running %s task %r on frame %d",
+                    self.name, task, frame)
+
+
+class TickEngine(object):
+    """
+    Runs per-frame work for a L{SimulationTime} on a fixed timestep.
+
+    Each frame runs the phases in order: input, simulation (which also
+    runs the simulation's pending calls for that frame), replication and
+    persistence. When the reactor falls behind, up to C{maxCatchUp}
+    frames are run back to back and any further frames are dropped.
+
+    The frame loop only runs while the engine is started and at least
+    one task is registered, so an idle server does not wake up every
+    frame.
+
+    @ivar simulation: The L{SimulationTime} being driven.
+    @ivar budget: The time in seconds a frame may take before
+        non-essential phases are skipped. Defaults to one frame.
+    @ivar frame: The last frame which was run.
+    @ivar frameHistogram: A L{Histogram} of how long whole frames take.
+    """
+
+    def __init__(self, simulation, platformClock, budget=None, maxCatchUp=5):
+        self.simulation = simulation
+        self.platformClock = platformClock
+        self.frameLength = 1.0 / simulation.granularity
+        if budget is None:
+            budget = self.frameLength
+        self.budget = budget
+        self.maxCatchUp = maxCatchUp
+        self.phases = [
+            Phase(INPUT),
+            Phase(SIMULATION),
+            Phase(REPLICATION, essential=False, maxSkipped=2),
+            Phase(PERSISTENCE, essential=False, maxSkipped=30)]
+        self._phaseLookup = dict((phase.name, phase) for phase in self.phases)
+        self.frame = None
+        self.frameHistogram = Histogram()
+        self.droppedFrames = 0
+        self.overBudgetFrames = 0
+        self._running = False
+        self._call = None
+
+    def getPhase(self, name):
+        return self._phaseLookup[name]
+
+    def addTask(self, phaseName, task):
+        """
+        Registers C{task} to be called with the frame number on every
+        frame, as part of the named phase.
+        """
+
+        self._phaseLookup[phaseName].tasks.append(task)
+        self._update()
+
+    def removeTask(self, phaseName, task):
+        tasks = self._phaseLookup[phaseName].tasks
+        if task in tasks:
+            tasks.remove(task)
+        self._update()
+
+    def start(self):
+        self._running = True
+        self._update()
+
+    def stop(self):
+        self._running = False
+        self._update()
+
+    def _update(self):
+        """
+        Starts or stops the frame loop depending on whether there is
+        anything to run.
+        """
+
+        wanted = self._running and \
+            any(phase.tasks for phase in self.phases)
+        if wanted and self._call is None:
+            self.frame = self._currentFrame()
+            self.simulation.setDriver(self)
+            self._call = LoopingCall(self._tick)
+            self._call.clock = self.platformClock
+            self._call.start(self.frameLength, now=False).addErrback(
+                self._failed)
+        elif not wanted and self._call is not None:
+            self._call.stop()
+            self._call = None
+            self.simulation.setDriver(None)
+
+    def _failed(self, failure):
+        # hands the simulation's calls back to the platform timer rather
+        # than leaving them with a frame loop which no longer runs
+        logger.error("Tick engine stopped: %s", failure.getTraceback())
+        self._call = None
+        self._running = False
+        self.simulation.setDriver(None)
+
+    def _runPending(self, frame):
+        """
+        Runs the simulation's calls due by C{frame}. A call which raises
+        is logged and the calls after it still run.
+        """
+
+        instant = float(frame) / self.simulation.granularity
+        while True:
+            try:
+                self.simulation.runPending(instant)
+                return
+            except Exception:
+                logger.exception(
+                    "Error running a simulation call on frame %d", frame)
+
+    def _currentFrame(self):
+        return int(round(
+            self.simulation.seconds() * self.simulation.granularity))
+
+    def _tick(self):
+        behind = self._currentFrame() - self.frame
+        if behind <= 0:
+            return
+
+        if behind > self.maxCatchUp:
+            dropped = behind - self.maxCatchUp
+            self.droppedFrames += dropped
+            logger.warning(
+                "Tick engine is %d frames behind, dropping %d",
+                behind, dropped)
+            self.frame += dropped
+            behind = self.maxCatchUp
+
+        for i in xrange(behind):
+            self.frame += 1
+            self._runFrame(self.frame, i == behind - 1)
+
+    def _runFrame(self, frame, lastInBurst):
+        start = monotonic()
+        for phase in self.phases:
+            if not phase.essential and phase._skippedInARow < phase.maxSkipped:
+                if not lastInBurst or monotonic() - start > self.budget:
+                    phase.skipped += 1
+                    phase._skippedInARow += 1
+                    continue
+
+            phaseStart = monotonic()
+            previous = activity.enter(phase.label)
+            try:
+                if phase.name == SIMULATION:
+                    self._runPending(frame)
+                phase.run(frame)
+            finally:
+                activity.leave(previous)
+            phase.histogram.observe(monotonic() - phaseStart)
+            phase._skippedInARow = 0
+
+        elapsed = monotonic() - start
+        self.frameHistogram.observe(elapsed)
+        if elapsed > self.budget:
+            self.overBudgetFrames += 1
+
+    def report(self):
+        """
+        Returns a list of lines describing where frame time goes.
+        """
+
+        lines = ["frame: %s over budget=%d dropped=%d" % (
+            self.frameHistogram.summary(), self.overBudgetFrames,
+            self.droppedFrames)]
+        for phase in self.phases:
+            lines.append("%s: %s skipped=%d" % (
+                phase.name, phase.histogram.summary(), phase.skipped))
+        return lines
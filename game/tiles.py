@@ -1,3 +1,6 @@
+from struct import pack
+import threading
+
 IMPORTANT_TILES = [
     3,
     5,
@@ -62,13 +65,29 @@ class TileType:
     Silver = 9
 
 
-class Tile:
+class Tile(object):
     """
     The basic building blocks of life!
+
+    Tiles are immutable values interned in a flyweight table: creating a
+    tile with the same properties as an existing one returns the existing
+    object, so a world holds a few thousand distinct tiles however many
+    tile slots it has. Use L{replace} to get the tile with some
+    properties changed.
+
+    @ivar flags: The L{TileFlags} of the tile.
+    @ivar important: Whether the tile type has frame coordinates.
+    @ivar encoded: The tile as sent in a L{TileSectionMessage}.
     """
 
-    def __init__(
-            self,
+    __slots__ = (
+        'tileType', 'frameX', 'frameY', 'wall', 'liquid', 'isLava',
+        'isLighted', 'active', 'flags', 'important', 'encoded', '_key')
+
+    _interned = {}
+
+    def __new__(
+            cls,
             tileType=TileType.Air,
             frameX=-1,
             frameY=-1,
@@ -77,18 +96,63 @@ class Tile:
             isLava=False,
             isLighted=False,
             active=False):
-        self.tileType = tileType
-        self.frameX = frameX
-        self.frameY = frameY
-        self.wall = wall
-        self.isLava = isLava
-        self.liquid = liquid
-        self.isLighted = isLighted
-        self.active = active
-        #self.x = -1
-        #self.y = -1
+        key = (tileType, frameX, frameY, wall, liquid, bool(isLava),
+               bool(isLighted), bool(active))
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
 
-    def getFlags(self):
+        tile = object.__new__(cls)
+        init = object.__setattr__
+        for name, value in zip(cls.__slots__[:8], key):
+            init(tile, name, value)
+        init(tile, '_key', key)
+        init(tile, 'flags', tile._computeFlags())
+        init(tile, 'important', tileType in IMPORTANT_TILES)
+        init(tile, 'encoded', tile._encode())
+        # another thread may have interned the same tile meanwhile
+        return cls._interned.setdefault(key, tile)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Tiles are immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("Tiles are immutable, use replace()")
+
+    def __reduce__(self):
+        return (Tile, self._key)
+
+    def sortKey(self):
+        """
+        Returns a key ordering tiles by their fields, the same in every
+        process, unlike their ids.
+        """
+        return self._key
+
+    def __repr__(self):
+        return "<Tile type=%d frame=(%d, %d) wall=%d liquid=%d%s%s%s>" % (
+            self.tileType, self.frameX, self.frameY, self.wall, self.liquid,
+            " lava" if self.isLava else "", " lighted" if self.isLighted else "",
+            " active" if self.active else "")
+
+    @classmethod
+    def internedCount(cls):
+        """
+        Returns the number of distinct tiles created so far.
+        """
+        return len(cls._interned)
+
+    def replace(self, **changes):
+        """
+        Returns the tile with the given properties changed, e.g.
+        C{tile.replace(wall=4)}.
+        """
+        properties = dict(zip(self.__slots__[:8], self._key))
+        properties.update(changes)
+        return Tile(**properties)
+
+    def _computeFlags(self):
         flag = 0
         if self.active:
             flag = flag | TileFlags.Active
@@ -100,8 +164,23 @@ class Tile:
             flag = flag | TileFlags.Liquid
         return flag
 
+    def _encode(self):
+        encoded = pack("<B", self.flags)
+        if self.active:
+            encoded += pack("<B", self.tileType)
+            if self.important:
+                encoded += pack("<hh", self.frameX, self.frameY)
+        if self.wall > 0:
+            encoded += pack("<B", self.wall)
+        if self.liquid > 0:
+            encoded += pack("<B?", self.liquid, self.isLava)
+        return encoded
+
+    def getFlags(self):
+        return self.flags
+
     def isImportant(self):
-        return self.tileType in IMPORTANT_TILES
+        return self.important
 
 airTile = Tile(
     TileType.Air,
@@ -117,6 +196,13 @@ ironTile = Tile(TileType.Iron, isLighted=True, wall=0, liquid=0, active=True)
 class TileSection:
     """
     A section of 200x150 tiles
+
+    @ivar version: Bumped by every L{setTile}, to tell whether the section
+        changed since it was loaded or saved.
+
+    The tile list is shared copy-on-write with the L{SectionSnapshot}s
+    taken by L{share}: the first L{setTile} after a snapshot writes to a
+    copy, leaving the list the snapshots see untouched.
     """
 
     def __init__(self):
@@ -126,6 +212,10 @@ class TileSection:
         self.y = -1  # the y section
         self.worldWidth = 0
         self.tileType = -1
+        self.version = 0
+        # live snapshots sharing the current tile list
+        self._sharers = 0
+        self._lock = threading.Lock()
 
     def setTile(self, x, y, tile):
         """
@@ -134,17 +224,28 @@ class TileSection:
 
         Example: 10, 10 would mean row 10 column 10 of this section.
         The tile's x and y would be offset from the section
+
+        This does not record the edit in the world's L{TileJournal}, so
+        an edit made here is lost if the server crashes before the next
+        save. Edits made while the server runs should go through
+        L{World.setTileAt}; this is for building sections, e.g. when
+        generating or loading a world.
         """
 #    tile.x = self.x * SECTION_WIDTH + x
 #    tile.y = self.y * SECTION_HEIGHT + y
-        if self.allocated:
-            self.tiles[y * SECTION_WIDTH + x] = tile
-        elif tile.tileType != self.tileType:
-            self.allocated = True
-            self.tiles = []
-            for i in range(SECTION_WIDTH * SECTION_HEIGHT):
-                self.tiles.append(airTile)
-            self.tiles[y * SECTION_WIDTH + x] = tile
+        with self._lock:
+            self.version += 1
+            if self.allocated:
+                if self._sharers:
+                    self.tiles = list(self.tiles)
+                    self._sharers = 0
+                self.tiles[y * SECTION_WIDTH + x] = tile
+            elif tile.tileType != self.tileType:
+                self.allocated = True
+                self.tiles = []
+                for i in range(SECTION_WIDTH * SECTION_HEIGHT):
+                    self.tiles.append(airTile)
+                self.tiles[y * SECTION_WIDTH + x] = tile
 
     def getTileAt(self, coord):
         """
@@ -160,3 +261,66 @@ class TileSection:
                 self.tiles):
             return self.tiles[coord[1] * SECTION_WIDTH + coord[0]]
         return None
+
+    def cacheSizes(self):
+        """
+        Returns the caches kept for this section, as a dict of cache name
+        to C{(entries, bytes)}, for memory reports.
+        """
+        return {}
+
+    def share(self):
+        """
+        Returns a L{SectionSnapshot} of the section as it is now. Call
+        L{unshare} with its tiles once it is no longer needed.
+        """
+        with self._lock:
+            if self.tiles is not None:
+                self._sharers += 1
+            return SectionSnapshot(self)
+
+    def unshare(self, tiles):
+        """
+        Releases a snapshot's share of C{tiles}, so the section can write
+        to them again without copying if no other snapshot shares them.
+        """
+        with self._lock:
+            if tiles is not None and tiles is self.tiles and self._sharers:
+                self._sharers -= 1
+
+
+class SectionSnapshot(object):
+    """
+    A frozen view of a L{TileSection}, see L{TileSection.share}. Its tile
+    list is never written to, so it can be read from any thread.
+
+    @ivar section: The section the view was taken of.
+    """
+
+    __slots__ = ('section', 'x', 'y', 'version', 'allocated', 'tileType',
+                 'tiles')
+
+    def __init__(self, section):
+        self.section = section
+        self.x = section.x
+        self.y = section.y
+        self.version = section.version
+        self.allocated = section.allocated
+        self.tileType = section.tileType
+        self.tiles = section.tiles
+
+    def getTileAt(self, coord):
+        """
+        Gets a tile at a specified x, y coordinate within the section, or
+        C{None} if the section was never allocated.
+        """
+        if self.tiles is None:
+            return None
+        return self.tiles[coord[1] * SECTION_WIDTH + coord[0]]
+
+    def isShared(self):
+        """
+        Whether the section still uses the tiles of this view, in which
+        case they cost no memory of their own.
+        """
+        return self.section.tiles is self.tiles
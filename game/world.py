@@ -1,14 +1,27 @@
 import logging
+import random
 
 from environment import SimulationTime
+from snapshots import WorldSnapshot, HEADER_FIELDS
+from tiles import SECTION_WIDTH, SECTION_HEIGHT
 
 logger = logging.getLogger()
 
+MOON_PHASES = 8
+NEW_MOON_PHASE = 4
+# One in this many nights is a blood moon
+BLOOD_MOON_CHANCE = 9
+
 
 class World(SimulationTime):
     """
     Game world for Terraria. Handles things like daylight,
     bloodmoon, etc.
+
+    Time of day, moon phase and blood moon are derived on demand from the
+    model time elapsed since they were last set, so nothing needs to run
+    per frame. Once started, a single call is scheduled for the next
+    dawn or dusk to notify C{cycleObservers}.
     """
 
     def __init__(
@@ -18,19 +31,22 @@ class World(SimulationTime):
             nightLength=32400,
             dayLength=52400):
         SimulationTime.__init__(self, granularity, platformClock)
+        self.nightLength = nightLength
+        self.dayLength = dayLength
+        self._epoch = 0
+        self._timeAnchor = 0
+        self._isDayAnchor = True
+        self._moonPhaseAnchor = 0
+        self._bloodMoonAnchor = False
+        self._transitionCall = None
+        self.cycleObservers = []
+        self.worldId = 0
         self.width = 1024  # maxTilesXf
         self.height = 1024  # maxTilesY
-        self.time = 0
         self.spawn = ()
         self.worldSurface = 0
         self.rockLayer = 0
-        self.worldId = 0
         self.name = ""
-        self.isDay = True
-        self.nightLength = nightLength
-        self.isBloodMoon = False
-        self.moonPhase = 0
-        self.dayLength = dayLength
         self.shadowOrbSmashed = False
         self.bossOneDowned = False
         self.bossTwoDowned = False
@@ -49,37 +65,175 @@ class World(SimulationTime):
         self.invasionType = 0
         self.invasionX = 0.0
         self.tileSections = []
+        # live L{WorldSnapshot}s
+        self.snapshots = set()
+        # a L{TileJournal} recording tile edits, if any
+        self.journal = None
+
+    def snapshot(self):
+        """
+        Takes a consistent, read-only view of the world which other
+        threads can read while the game carries on. Release it once done.
+
+        @rtype: L{WorldSnapshot}
+        """
+        snapshot = WorldSnapshot(self)
+        self.snapshots.add(snapshot)
+        return snapshot
 
     def getSectionAt(self, coords):
         sectionCoords = self._getSectionCoords(coords)
-        print "getting section at (%d, %d)" % (sectionCoords)
+        logger.debug("getting section at (%d, %d)", *sectionCoords)
         return self.tileSections[sectionCoords[0]][sectionCoords[1]]
 
+    def setTileAt(self, coords, tile):
+        """
+        Sets the tile at the given world coordinates, recording the edit
+        in the world's journal.
+        """
+        self.getSectionAt(coords).setTile(
+            coords[0] % SECTION_WIDTH, coords[1] % SECTION_HEIGHT, tile)
+        journal = self.journal
+        if journal is not None:
+            journal.append(coords[0], coords[1], tile)
+
     def getSectionsInBlockAround(self, section):
         maxSections = self._getSectionCoords((self.width, self.height))
         for x in xrange(section.x - 2, section.x + 3):
             for y in xrange(section.y - 1, section.y + 2):
                 if x >= 0 and y >= 0 and x < maxSections[
                         0] and y < maxSections[1]:
-                    print "section: (%d, %d)" % (x, y)
+                    logger.debug("section: (%d, %d)", x, y)
                     yield self.tileSections[x][y]
                 else:
                     yield None
 
-    def _update(self, frames):
-        SimulationTime._update(self, frames)
-        self.time += 1.0
-        if not self.isDay:
-            if self.time > self.nightLength:
-                # it should now turn to day time
-                self.time = 0.0
-                self.isDay = True
-                self.isBloodMoon = False
+    @property
+    def time(self):
+        return self._cycleState()[0]
+
+    @time.setter
+    def time(self, value):
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        self._anchor(value, isDay, moonPhase, isBloodMoon)
+
+    @property
+    def isDay(self):
+        return self._cycleState()[1]
+
+    @isDay.setter
+    def isDay(self, value):
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        self._anchor(time, value, moonPhase, isBloodMoon)
+
+    @property
+    def moonPhase(self):
+        return self._cycleState()[2]
+
+    @moonPhase.setter
+    def moonPhase(self, value):
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        self._anchor(time, isDay, value, isBloodMoon)
+
+    @property
+    def isBloodMoon(self):
+        return self._cycleState()[3]
+
+    @isBloodMoon.setter
+    def isBloodMoon(self, value):
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        self._anchor(time, isDay, moonPhase, value)
+
+    def _anchor(self, time, isDay, moonPhase, isBloodMoon):
+        """
+        Pins the day/night cycle to the given state at the current
+        model time.
+        """
+
+        self._epoch = self.seconds()
+        self._timeAnchor = time
+        self._isDayAnchor = isDay
+        self._moonPhaseAnchor = moonPhase
+        self._bloodMoonAnchor = isBloodMoon and not isDay
+        if self._transitionCall is not None:
+            self._scheduleTransition()
+
+    def _cycleState(self):
+        """
+        Works out the time of day, day/night, moon phase and blood moon
+        for the current model time.
+
+        @return: tuple of (time, isDay, moonPhase, isBloodMoon)
+        """
+
+        frames = (self.seconds() - self._epoch) * self.granularity
+        # position within a cycle that starts at dawn
+        position = self._timeAnchor + frames
+        if not self._isDayAnchor:
+            position += self.dayLength
+
+        dawns, offset = divmod(position, self.dayLength + self.nightLength)
+        dawns = int(dawns)
+        moonPhase = (self._moonPhaseAnchor + dawns) % MOON_PHASES
+        if offset < self.dayLength:
+            return (offset, True, moonPhase, False)
+
+        if dawns == 0 and not self._isDayAnchor:
+            isBloodMoon = self._bloodMoonAnchor
         else:
-            # its day time!
-            if self.time > self.dayLength:
-                self.time = 0.0
-                self.isDay = False
+            isBloodMoon = self._rollBloodMoon(dawns, moonPhase)
+        return (offset - self.dayLength, False, moonPhase, isBloodMoon)
+
+    def _rollBloodMoon(self, night, moonPhase):
+        """
+        Decides whether the given night (counted from the anchor) is a
+        blood moon. The roll is seeded so every query agrees.
+        """
+
+        if moonPhase == NEW_MOON_PHASE:
+            return False
+        roll = random.Random(hash((self.worldId, self._epoch, night)))
+        return roll.randrange(BLOOD_MOON_CHANCE) == 0
+
+    def _scheduleTransition(self):
+        """
+        Schedules a single call for the next dawn or dusk.
+        """
+
+        if self._transitionCall is not None and self._transitionCall.active():
+            self._transitionCall.cancel()
+
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        length = self.dayLength if isDay else self.nightLength
+        delay = (length - time) / float(self.granularity)
+        self._transitionCall = self.callLater(delay, self._transition)
+
+    def _transition(self):
+        time, isDay, moonPhase, isBloodMoon = self._cycleState()
+        logger.debug(
+            "%s: %s has begun (moon phase %d, blood moon %s)",
+            self.name, "day" if isDay else "night", moonPhase, isBloodMoon)
+
+        # scheduled first, so an observer which raises cannot stop the
+        # cycle
+        self._scheduleTransition()
+        for observer in self.cycleObservers:
+            try:
+                observer(self)
+            except Exception:
+                logger.exception(
+                    "Error notifying %r of a day/night transition", observer)
+
+    def start(self):
+        SimulationTime.start(self)
+        self._scheduleTransition()
+
+    def stop(self):
+        if self._transitionCall is not None:
+            if self._transitionCall.active():
+                self._transitionCall.cancel()
+            self._transitionCall = None
+        SimulationTime.stop(self)
 
     def getBossFlag(self):
         return 0
@@ -92,3 +246,25 @@ class World(SimulationTime):
 
     def _getSectionCoords(self, coords):
         return (coords[0] / 200, coords[1] / 150)
+
+
+class WorldHeader(object):
+    """
+    The stored attributes of a world (see L{HEADER_FIELDS}) and nothing
+    else, for lookups which only need to know about a world rather than
+    simulate it. Headers are shared by the cache of
+    L{CachingWorldRepository}, so they are read-only.
+    """
+
+    __slots__ = HEADER_FIELDS
+
+    def __init__(self, **fields):
+        for name in HEADER_FIELDS:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("World headers are read-only")
+
+    def __repr__(self):
+        return "<WorldHeader('%s', '%dx%d')>" % (
+            self.name, self.width, self.height)
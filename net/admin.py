@@ -0,0 +1,103 @@
+import logging
+import shlex
+
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.web.resource import Resource
+
+logger = logging.getLogger()
+
+# The admin console only ever listens on the loopback interface
+ADMIN_INTERFACE = "127.0.0.1"
+
+
+class AdminProtocol(LineReceiver):
+    """
+    A line based console for operating a running server.
+
+    Each line is a command name followed by its arguments. Commands
+    return a list of lines (or a L{Deferred} firing with one) which are
+    written back to the client.
+    """
+
+    delimiter = "\n"
+
+    def connectionMade(self):
+        self.sendLine("Terraria server admin console. Type 'help'.")
+
+    def lineReceived(self, line):
+        try:
+            words = shlex.split(line.strip())
+        except ValueError, e:
+            self.sendLine("error: %s" % (e,))
+            return
+        if not words:
+            return
+
+        name, args = words[0], words[1:]
+        if name == "quit":
+            self.transport.loseConnection()
+            return
+
+        d = maybeDeferred(self.factory.runCommand, name, args)
+        d.addCallbacks(self._sendLines, self._sendError)
+
+    def _sendLines(self, lines):
+        for line in lines or []:
+            self.sendLine(str(line))
+
+    def _sendError(self, failure):
+        logger.error("Admin command failed: %s",
+                     failure.getTraceback())
+        self.sendLine("error: %s" % (failure.getErrorMessage(),))
+
+
+class AdminFactory(ServerFactory):
+    """
+    Builds L{AdminProtocol}s and holds the registered commands.
+    """
+
+    protocol = AdminProtocol
+
+    def __init__(self):
+        self.commands = {}
+        self.addCommand("help", self._help, "List the available commands")
+
+    def addCommand(self, name, func, description):
+        """
+        Registers C{func(*args)} to be run for the command C{name}.
+        """
+
+        self.commands[name] = (func, description)
+
+    def runCommand(self, name, args):
+        try:
+            func, description = self.commands[name]
+        except KeyError:
+            return ["unknown command '%s'" % (name,)]
+        return func(*args)
+
+    def _help(self):
+        lines = []
+        for name in sorted(self.commands):
+            lines.append("%-12s %s" % (name, self.commands[name][1]))
+        lines.append("%-12s %s" % ("quit", "Close this console"))
+        return lines
+
+
+class MetricsResource(Resource):
+    """
+    Serves a L{MetricsRegistry} in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(
+            "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render()
@@ -0,0 +1,93 @@
+import struct
+
+from util.timer import monotonic
+
+# First bytes of every capture file
+MAGIC = "TPSCAP\x01\n"
+
+# Record header: seconds since the capture started, session id, record
+# kind and the number of data bytes which follow
+RECORD_FORMAT = "<dIBI"
+RECORD_FORMAT_LEN = struct.calcsize(RECORD_FORMAT)
+
+# Record kinds
+OPENED = 0
+DATA = 1
+CLOSED = 2
+
+
+class CaptureError(Exception):
+    """
+    A capture file is malformed.
+    """
+
+
+class CaptureWriter(object):
+    """
+    Writes the bytes received on each connection, exactly as they were
+    chunked by the transport, to a capture file which can be replayed
+    with L{bench.replay}.
+
+    A capture is a L{MAGIC} header followed by records of
+    L{RECORD_FORMAT}, each followed by its data.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sessions = 0
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._start = monotonic()
+
+    def _write(self, session, kind, data="", when=None):
+        if when is None:
+            when = monotonic() - self._start
+        self._file.write(
+            struct.pack(RECORD_FORMAT, when, session, kind, len(data)))
+        if data:
+            self._file.write(data)
+
+    def opened(self, when=None):
+        """
+        Starts a new session.
+
+        @param when: Seconds since the capture started, now by default.
+        @return: the session id
+        """
+
+        self.sessions += 1
+        self._write(self.sessions, OPENED, when=when)
+        return self.sessions
+
+    def data(self, session, data, when=None):
+        self._write(session, DATA, bytes(data), when)
+
+    def closed(self, session, when=None):
+        self._write(session, CLOSED, when=when)
+
+    def close(self):
+        self._file.close()
+
+
+def readCapture(path):
+    """
+    Reads a capture written by L{CaptureWriter}.
+
+    @return: an iterator of C{(time, session, kind, data)} tuples in the
+        order they were written.
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError("%s is not a capture file" % (path,))
+        while True:
+            header = f.read(RECORD_FORMAT_LEN)
+            if not header:
+                return
+            if len(header) < RECORD_FORMAT_LEN:
+                raise CaptureError("truncated record header in %s" % (path,))
+            when, session, kind, length = struct.unpack(RECORD_FORMAT, header)
+            data = f.read(length)
+            if len(data) < length:
+                raise CaptureError("truncated record data in %s" % (path,))
+            yield when, session, kind, data
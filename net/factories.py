@@ -3,6 +3,8 @@ from twisted.internet.protocol import ServerFactory
 from protocols import TerrariaProtocol, ProtocolManager
 from parsers import BinaryMessageParser
 from handlers import MessageHandlerLocator
+from tracing import JoinTracer
+from capture import CaptureWriter
 
 
 class TerrariaFactory(ServerFactory):
@@ -18,6 +20,10 @@ class TerrariaFactory(ServerFactory):
         self.parser = BinaryMessageParser()
         self.messageHandlerLocator = MessageHandlerLocator()
         self.protocolManager = ProtocolManager()
+        self.joinTracer = JoinTracer(config.slowJoinThreshold)
+        self.capture = None
+        if config.capturePath:
+            self.capture = CaptureWriter(config.capturePath)
 
     def buildProtocol(self, ignored):
         p = TerrariaProtocol(
@@ -25,6 +31,8 @@ class TerrariaFactory(ServerFactory):
             self.messageHandlerLocator,
             self.world,
             self.config,
-            self.protocolManager)
+            self.protocolManager,
+            joinTracer=self.joinTracer,
+            capture=self.capture)
         p.factory = self
         return p
@@ -13,12 +13,14 @@ class MessageHandlerLocator:
     handlerLookup = {}
     messageHandler = None
 
-    def locateHandler(self, message):
+    def locateHandler(self, message, messageHandler=None):
         #    logger.debug("Locating handler for message %r" % (message,))
+        if messageHandler is None:
+            messageHandler = self.messageHandler
         messageClass = message.__class__
         try:
             handlerFunc = self.handlerLookup[messageClass]
         except KeyError:
             return None
-        handlerMethod = types.MethodType(handlerFunc, self.messageHandler)
+        handlerMethod = types.MethodType(handlerFunc, messageHandler)
         return deferToThread(handlerMethod, message)
@@ -1,19 +1,30 @@
-from struct import calcsize, pack, unpack
+from struct import Struct, calcsize, unpack
 import logging
+import threading
 
 from net.handlers import MessageHandlerLocator
-from game.player import Player
+from game.player import Player, BUFF_SLOTS
 from game import tiles
 
 logger = logging.getLogger()
 
+# Length and message type which start every frame
+FRAME_HEADER = Struct("<HB")
+BYTE = Struct("<B")
+
 
 class Message(object):
     """
-    Base message class for Terraria messages
+    Base message class for Terraria messages.
+
+    Messages are slotted: a parsed message holds only the fields decoded
+    from it. Subclass L{InboundMessage} for messages parsed from clients
+    and L{OutboundMessage} for messages sent to them, or both.
     """
 
-    headerFormat = "<h"
+    __slots__ = ()
+
+    headerFormat = "<H"
     headerFormatLen = calcsize(headerFormat)
     int16Format = "<h"
     int16FormatLen = calcsize(int16Format)
@@ -30,23 +41,7 @@ class Message(object):
     color24Format = "<BBB"
     color24FormatLen = calcsize(color24Format)
 
-    def __init__(self, messageType):
-        super(Message, self).__init__()
-
-        self.messageType = messageType
-        self._messageLen = 0
-        self._messageBuf = bytearray()
-        self._currentPos = 0
-
-    def serialize(self):
-        """
-        Convert me into a wire-encoded bytearray
-        """
-        messageLen = len(self._messageBuf) + 1  # 1 byte for the message type
-        header = pack(self.headerFormat, messageLen)
-        msgType = pack(self.messageTypeFormat, self.messageType)
-        payload = bytes(self._messageBuf)
-        return header + msgType + payload
+    MESSAGE_TYPE = None
 
     @classmethod
     def handler(cls, methodfunc):
@@ -54,43 +49,6 @@ class Message(object):
         # logger.debug(MessageHandlerLocator.handlerLookup)
         return methodfunc
 
-    def deserialize(self, rawBinaryData):
-        self._messageLen, = unpack(
-            self.headerFormat, rawBinaryData[
-                self._currentPos:self._currentPos + self.headerFormatLen])
-        
-        self._currentPos += self.headerFormatLen
-
-    def __writeValue(self, valFormat, val):
-        """
-        Writes a value with a specific format into internal message buffer
-        """
-        self._messageBuf.extend(pack(valFormat, val))
-
-    def _writeByte(self, val):
-        """
-        Writes a byte value into the internal message buffer
-        """
-        self.__writeValue(self.byteFormat, val)
-
-    def _writeInt32(self, val):
-        """
-        Writes a 32 bit signed integer into the internal message buffer
-        """
-        self.__writeValue(self.int32Format, val)
-
-    def _writeInt16(self, val):
-        """
-        Writes a 16 bit signed integer into the internal message buffer
-        """
-        self.__writeValue(self.int16Format, val)
-
-    def _writeBool(self, val):
-        """
-        Writes a boolean value into the internal message buffer
-        """
-        self.__writeValue(self.boolFormat, val)
-
     def _readByte(self, rawData, offset=0):
         """
         Reads a byte from rawData starting at offset
@@ -163,57 +121,176 @@ class Message(object):
         return rawData[self.byteFormatLen:][:strLen]
 
 
-class ConnectionRequestMessage(Message):
+class InboundMessage(Message):
+    """
+    A message sent by a client, built by L{BinaryMessageParser}
+    """
+
+    __slots__ = ()
+
+    def deserialize(self, rawData):
+        """
+        Reads my fields from rawData, the message without its header and
+        type.
+
+        @return: self
+        """
+        # nothing to deserialize...
+        return self
+
+
+class MessageWriter(object):
+    """
+    Encodes outbound messages straight into a reusable buffer.
+
+    The frame header is reserved up front and backpatched once the fields
+    are written, so a frame is built without any intermediate strings.
+    The buffer grows to fit the largest frame written and is then reused,
+    so a writer must only be used by one thread; L{threadWriter} returns
+    the current thread's.
+
+    @ivar buffer: The C{bytearray} frames are written into.
+    @ivar pos: Where the next field will be written.
+    """
+
+    __slots__ = ('buffer', 'pos')
+
+    INITIAL_SIZE = 4096
+
+    def __init__(self, size=INITIAL_SIZE):
+        self.buffer = bytearray(size)
+        self.pos = 0
+
+    def frame(self, message):
+        """
+        Encodes C{message}, header included.
+
+        @return: a C{memoryview} of the frame, only valid until the next
+            frame is written
+        """
+        self.pos = FRAME_HEADER.size
+        message.writeFields(self)
+        FRAME_HEADER.pack_into(
+            self.buffer, 0, self.pos - Message.headerFormatLen,
+            message.MESSAGE_TYPE)
+        return memoryview(self.buffer)[:self.pos]
+
+    def _grow(self, size):
+        needed = self.pos + size - len(self.buffer)
+        self.buffer.extend(bytearray(max(needed, len(self.buffer))))
+
+    def writePacked(self, packer, *values):
+        """
+        Writes C{values} with a precompiled C{Struct}
+        """
+        pos = self.pos
+        if pos + packer.size > len(self.buffer):
+            self._grow(packer.size)
+        packer.pack_into(self.buffer, pos, *values)
+        self.pos = pos + packer.size
+
+    def writeBytes(self, val):
+        """
+        Writes a string or bytearray as it is
+        """
+        pos = self.pos
+        end = pos + len(val)
+        if end > len(self.buffer):
+            self._grow(len(val))
+        self.buffer[pos:end] = val
+        self.pos = end
+
+    def writeString(self, val):
+        """
+        Writes a string prefixed with its length as a byte
+        """
+        self.writePacked(BYTE, len(val))
+        self.writeBytes(val)
+
+
+_writers = threading.local()
+
+
+def threadWriter():
+    """
+    Returns the L{MessageWriter} of the calling thread.
+    """
+    try:
+        return _writers.writer
+    except AttributeError:
+        _writers.writer = MessageWriter()
+        return _writers.writer
+
+
+class OutboundMessage(Message):
+    """
+    A message sent to clients, encoded by L{serialize}
+    """
+
+    __slots__ = ()
+
+    def writeFields(self, writer):
+        """
+        Writes everything after the message type with the given
+        L{MessageWriter}. Messages without a body write nothing.
+        """
+
+    def serialize(self):
+        """
+        Convert me into a wire-encoded string
+        """
+        return threadWriter().frame(self).tobytes()
+
+
+class ConnectionRequestMessage(InboundMessage, OutboundMessage):
     """
     Represents a connection request message
     """
 
     MESSAGE_TYPE = 0x01
 
+    __slots__ = ('clientVersion',)
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.clientVersion = ""
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._messageBuf.extend(self.clientVersion)
-        return Message.serialize(self)
+    def writeFields(self, writer):
+        writer.writeString(self.clientVersion)
 
     def __repr__(self):
         return repr(self.serialize())
 
 
-class DisconnectMessage(Message):
+class DisconnectMessage(OutboundMessage):
     """
     A message to disconnect the client with a reason (text)
     """
 
     MESSAGE_TYPE = 0x02
 
+    __slots__ = ('text',)
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.text = ""
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._messageBuf.extend(self.text)
-        return Message.serialize(self)
+    def writeFields(self, writer):
+        writer.writeBytes(self.text)
 
     def __repr__(self):
         return repr(self.serialize())
 
 
-class PasswordRequestMessage(Message):
+class PasswordRequestMessage(OutboundMessage):
     """
     A message to request a password from the client
     """
 
     MESSAGE_TYPE = 0x25
 
-    def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
+    __slots__ = ()
 
-class LoginWithPassword(Message):
+
+class LoginWithPassword(InboundMessage):
     """
     A message to respond with success or failure, depending on the password
     in which the client tried to enter with.
@@ -221,8 +298,10 @@ class LoginWithPassword(Message):
 
     MESSAGE_TYPE = 0x26
 
+    __slots__ = ()
+
     def __init__(self, session):
-        Message.__init__(self, self.MESSAGE_TYPE)
+        pass
 
     def serialize(self):
         pass
@@ -234,7 +313,7 @@ class LoginWithPassword(Message):
         return repr(self.serialize())
 
 
-class RequestPlayerDataMessage(Message):
+class RequestPlayerDataMessage(OutboundMessage):
     """
     A message to request that the client sends
     the player data
@@ -242,28 +321,40 @@ class RequestPlayerDataMessage(Message):
 
     MESSAGE_TYPE = 0x03
 
+    __slots__ = ('clientNumber',)
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.clientNumber = None
 
 
-class PlayerMessage(Message):
+class PlayerMessage(InboundMessage, OutboundMessage):
     """
     Represents common player messages
+
+    Player messages decode straight into the session's L{Player}, which
+    is created by the first one received, and hold nothing else.
     """
 
-    def __init__(self, messageType, session):
-        Message.__init__(self, messageType)
+    __slots__ = ('player',)
+
+    def __init__(self, session):
+        if session.player is None:
+            session.player = Player()
         self.player = session.player
-        
-        if self.player is None:
-            self.player = Player()
 
     def deserialize(self, rawData):
-        self.player.playerId = self._readByte(rawData, self._currentPos)
-        self._currentPos += self.byteFormatLen
+        self._readPlayerId(rawData)
         return self
 
+    def _readPlayerId(self, rawData):
+        """
+        Reads the player id which starts every player message
+
+        @return: the offset of the rest of the message
+        """
+        self.player.playerId = self._readByte(rawData)
+        return self.byteFormatLen
+
 
 class PlayerInfoMessage(PlayerMessage):
     """
@@ -273,59 +364,71 @@ class PlayerInfoMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x04
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
-        self.playerId = None
-        self.hair = None
-        self.isMale = False
+    __slots__ = ()
+
+    # fields before and after the name
+    HEAD = Struct("<BBB")
+    FIELDS = Struct("<BBBB" + "BBB" * 7 + "B")
 
     def deserialize(self, rawBinaryData):
         """
         Turns a wire encoded (i.e. binary) object into a PlayerInfoMessage object
         """
 
-        PlayerMessage.deserialize(self, rawBinaryData)
-        self.player.skinVarient = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen  
-        self.player.hair = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
+        pos = self._readPlayerId(rawBinaryData)
+        self.player.skinVarient = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen  
+        self.player.hair = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen
         self.player.isMale = True if self.player.skinVarient < 4 else False
-        self.player.name = self._readString(rawBinaryData[self._currentPos:])
-        self._currentPos += len(self.player.name)
-        self.player.hairDye = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
-        self.player.hideVisuals = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
-        self.player.hideVisuals2 = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
-        self.player.hideMisc = self._readByte(rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
+        self.player.name = self._readString(rawBinaryData[pos:])
+        pos += len(self.player.name)
+        self.player.hairDye = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen
+        self.player.hideVisuals = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen
+        self.player.hideVisuals2 = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen
+        self.player.hideMisc = self._readByte(rawBinaryData, pos)
+        pos += self.byteFormatLen
         self.player.hairColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.skinColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.eyeColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.shirtColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.underShirtColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen  
+            rawBinaryData, pos)
+        pos += self.color24FormatLen  
         self.player.pantsColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.shoeColor = self._readColor24(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.color24FormatLen
+            rawBinaryData, pos)
+        pos += self.color24FormatLen
         self.player.difficulty = self._readByte(
-            rawBinaryData, self._currentPos)
-        self._currentPos += self.byteFormatLen
+            rawBinaryData, pos)
         return self
 
+    def writeFields(self, writer):
+        player = self.player
+        writer.writePacked(
+            self.HEAD, player.playerId, player.skinVarient, player.hair)
+        writer.writeString(player.name)
+        writer.writePacked(
+            self.FIELDS, player.hairDye, player.hideVisuals,
+            player.hideVisuals2, player.hideMisc,
+            *(player.hairColor + player.skinColor + player.eyeColor +
+              player.shirtColor + player.underShirtColor +
+              player.pantsColor + player.shoeColor +
+              (player.difficulty,)))
+
 
 class PlayerHpMessage(PlayerMessage):
     """
@@ -334,17 +437,22 @@ class PlayerHpMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x10
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+    __slots__ = ()
+
+    FIELDS = Struct("<Bhh")
 
     def deserialize(self, rawData):
-        PlayerMessage.deserialize(self, rawData)
-        self.player.life = self._readInt16(rawData, self._currentPos)
-        self._currentPos += self.int16FormatLen
-        self.player.lifeMax = self._readInt16(rawData, self._currentPos)
-        self._currentPos += self.int16FormatLen
+        pos = self._readPlayerId(rawData)
+        self.player.life = self._readInt16(rawData, pos)
+        pos += self.int16FormatLen
+        self.player.lifeMax = self._readInt16(rawData, pos)
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.player.playerId, self.player.life,
+            self.player.lifeMax)
+
 
 class PlayerManaMessage(PlayerMessage):
     """
@@ -360,17 +468,22 @@ class PlayerManaMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x2A  # 42
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+    __slots__ = ()
+
+    FIELDS = Struct("<Bhh")
 
     def deserialize(self, rawData):
-        PlayerMessage.deserialize(self, rawData)
-        self.player.mana = self._readInt16(rawData, self._currentPos)
-        self._currentPos += self.int16FormatLen
-        self.player.manaMax = self._readInt16(rawData, self._currentPos)
-        self._currentPos += self.int16FormatLen
+        pos = self._readPlayerId(rawData)
+        self.player.mana = self._readInt16(rawData, pos)
+        pos += self.int16FormatLen
+        self.player.manaMax = self._readInt16(rawData, pos)
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.player.playerId, self.player.mana,
+            self.player.manaMax)
+
 
 class PlayerBuffMessage(PlayerMessage):
     """
@@ -394,14 +507,19 @@ class PlayerBuffMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x32
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+    __slots__ = ()
+
+    FIELDS = Struct("<B%dB" % (BUFF_SLOTS,))
 
     def deserialize(self, rawData):
-        PlayerMessage.deserialize(self, rawData)
+        self._readPlayerId(rawData)
         # TODO
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.player.playerId, *self.player.buffs)
+
 
 class PlayerInventoryMessage(PlayerMessage):
     """
@@ -418,31 +536,39 @@ class PlayerInventoryMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x05
 
+    __slots__ = ('slot', 'stack', 'prefix', 'itemId')
+
+    FIELDS = Struct("<BBBBh")
+
     def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+        PlayerMessage.__init__(self, session)
+        self.slot = 0
+        self.stack = 0
+        self.prefix = 0
+        self.itemId = 0
 
     def deserialize(self, rawData):
-        PlayerMessage.deserialize(self, rawData)
+        self._readPlayerId(rawData)
         # TODO
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.player.playerId, self.slot, self.stack,
+            self.prefix, self.itemId)
+
 
-class RequestWorldDataMessage(Message):
+class RequestWorldDataMessage(InboundMessage, OutboundMessage):
     """
     The client sends this message after sending all player info. It doesnt contain any other data though...
     """
 
     MESSAGE_TYPE = 0x06
 
-    def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
+    __slots__ = ()
 
-    def deserialize(self, rawData):
-        # nothing to deserialize...
-        return self
 
-
-class WorldDataMessage(Message):
+class WorldDataMessage(OutboundMessage):
     """
     Sent to the client in response to a L{RequestWorldDataMessage}
 
@@ -466,33 +592,25 @@ class WorldDataMessage(Message):
 
     MESSAGE_TYPE = 0x07
 
+    __slots__ = ('world',)
+
+    FIELDS = Struct("<i?B?iiiiiiiB")
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.world = None
 
-    def serialize(self):
-        """
-        Serializes this instance into a binary format
-        """
-        self._messageBuf = bytearray()
-        self._writeInt32(self.world.time)
-        self._writeBool(self.world.isDay)
-        self._writeByte(self.world.moonPhase)
-        self._writeBool(self.world.isBloodMoon)
-        self._writeInt32(self.world.width)
-        self._writeInt32(self.world.height)
-        self._writeInt32(self.world.spawn[0])
-        self._writeInt32(self.world.spawn[1])
-        self._writeInt32(self.world.worldSurface)
-        self._writeInt32(self.world.rockLayer)
-        self._writeInt32(self.world.worldId)
-        self._writeByte(self.world.getBossFlag())
+    def writeFields(self, writer):
+        world = self.world
+        writer.writePacked(
+            self.FIELDS, world.time, world.isDay, world.moonPhase,
+            world.isBloodMoon, world.width, world.height, world.spawn[0],
+            world.spawn[1], world.worldSurface, world.rockLayer,
+            world.worldId, world.getBossFlag())
         # write the raw name
-        self._messageBuf.extend(self.world.name)
-        return Message.serialize(self)
+        writer.writeBytes(self.world.name)
 
 
-class TileBlockRequestMessage(Message):
+class TileBlockRequestMessage(InboundMessage, OutboundMessage):
     """
     Sent from client to request a section of tiles
 
@@ -505,20 +623,24 @@ class TileBlockRequestMessage(Message):
 
     MESSAGE_TYPE = 0x08
 
+    __slots__ = ('tileX', 'tileY')
+
+    FIELDS = Struct("<ii")
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.tileX = -1
         self.tileY = -1
 
     def deserialize(self, rawData):
-        self.tileX = self._readInt32(rawData, self._currentPos)
-        self._currentPos += self.int32FormatLen
-        self.tileY = self._readInt32(rawData, self._currentPos)
-        self._currentPos += self.int32FormatLen
+        self.tileX = self._readInt32(rawData)
+        self.tileY = self._readInt32(rawData, self.int32FormatLen)
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(self.FIELDS, self.tileX, self.tileY)
 
-class TileLoadingMessage(Message):
+
+class TileLoadingMessage(OutboundMessage):
     """
     Tells the client tiles are about to be sent
 
@@ -531,19 +653,20 @@ class TileLoadingMessage(Message):
 
     MESSAGE_TYPE = 0x09
 
+    __slots__ = ('text', 'unknownNumber')
+
+    FIELDS = Struct("<i")
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.text = "Receiving tile data"
         self.unknownNumber = 0
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._writeInt32(self.unknownNumber)
-        self._messageBuf.extend(self.text)
-        return Message.serialize(self)
+    def writeFields(self, writer):
+        writer.writePacked(self.FIELDS, self.unknownNumber)
+        writer.writeBytes(self.text)
 
 
-class TileSectionMessage(Message):
+class TileSectionMessage(OutboundMessage):
     """
 
     MessageType: 0x0A
@@ -557,47 +680,30 @@ class TileSectionMessage(Message):
 
     MESSAGE_TYPE = 0x0A
 
+    __slots__ = ('x', 'y', 'tiles')
+
+    FIELDS = Struct("<hii")
+    EMPTY_ROW = "\0\0\0\0" * 200
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.x = -1
         self.y = -1
         self.tiles = None
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._writeInt16(200)  # Always 200
-        self._writeInt32(self.x)
-        self._writeInt32(self.y)
+    def writeFields(self, writer):
+        writer.writePacked(self.FIELDS, 200, self.x, self.y)  # Always 200
         
         if self.tiles:
-            for tile in self.tiles:
-                self._writeByte(tile.getFlags())
-                
-                if tile.active:
-                    self._writeByte(tile.tileType)
-                    
-                    if tile.isImportant():
-                        self._writeInt16(tile.frameX)
-                        self._writeInt16(tile.frameY)
-                
-                if tile.wall > 0:
-                    self._writeByte(tile.wall)
-                
-                if tile.liquid > 0:
-                    self._writeByte(tile.liquid)
-                    self._writeByte(tile.isLava)
+            # tiles carry their own encoding
+            writer.writeBytes(
+                "".join([tile.encoded for tile in self.tiles]))
         else:
-            # No "active" tiles in this section so send all of that
-            for x in range(200):
-                self._writeByte(0)  # no flags
-                self._writeByte(0)  # not a wall
-                self._writeByte(0)  # not a liquid
-                self._writeByte(0)  # not lava
-        
-        return Message.serialize(self)
+            # No "active" tiles in this section so send all of that:
+            # no flags, not a wall, not a liquid, not lava
+            writer.writeBytes(self.EMPTY_ROW)
 
 
-class TileConfirmMessage(Message):
+class TileConfirmMessage(OutboundMessage):
     """
 
     MessageType: 0x0B
@@ -611,20 +717,19 @@ class TileConfirmMessage(Message):
 
     MESSAGE_TYPE = 0x0B
 
+    __slots__ = ('startX', 'startY', 'endX', 'endY')
+
+    FIELDS = Struct("<iiii")
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         self.startX = -1
         self.startY = -1
         self.endX = -1
         self.endY = -1
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._writeInt32(self.startX)
-        self._writeInt32(self.startY)
-        self._writeInt32(self.endX)
-        self._writeInt32(self.endY)
-        return Message.serialize(self)
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.startX, self.startY, self.endX, self.endY)
 
 
 class SpawnMessage(PlayerMessage):
@@ -638,21 +743,27 @@ class SpawnMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x0C
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+    __slots__ = ()
+
+    FIELDS = Struct("<Bii")
 
     def deserialize(self, rawBinaryData):
         """
         Turns a wire encoded (i.e. binary) object into a PlayerInfoMessage object
         """
-        PlayerMessage.deserialize(self, rawBinaryData)
-        spawnX = self._readInt32(rawBinaryData, self._currentPos)
-        self._currentPos += self.int32FormatLen
-        spawnY = self._readInt32(rawBinaryData, self._currentPos)
-        self._currentPos += self.int32FormatLen
+        pos = self._readPlayerId(rawBinaryData)
+        spawnX = self._readInt32(rawBinaryData, pos)
+        pos += self.int32FormatLen
+        spawnY = self._readInt32(rawBinaryData, pos)
+        pos += self.int32FormatLen
         self.player.spawn = (spawnX, spawnY)
         return self
 
+    def writeFields(self, writer):
+        writer.writePacked(
+            self.FIELDS, self.player.playerId, self.player.spawn[0],
+            self.player.spawn[1])
+
 
 class PlayerUpdateMessage(PlayerMessage):
     """
@@ -672,46 +783,58 @@ class PlayerUpdateMessage(PlayerMessage):
 
     MESSAGE_TYPE = 0x0D
 
-    def __init__(self, session):
-        PlayerMessage.__init__(self, self.MESSAGE_TYPE, session)
+    __slots__ = ()
+
+    FIELDS = Struct("<BBBffff")
 
     def deserialize(self, rawData):
-        PlayerMessage.deserialize(self, rawData)
-        control = self._readByte(rawData, self._currentPos)
-        self._currentPos += self.byteFormatLen
-        selectedItem = self._readByte(rawData, self._currentPos)
-        self._currentPos += self.byteFormatLen
-        positionX = self._readFloat(rawData, self._currentPos)
-        self._currentPos += self.floatFormatLen
-        positionY = self._readFloat(rawData, self._currentPos)
-        self._currentPos += self.floatFormatLen
-        velocityX = self._readFloat(rawData, self._currentPos)
-        self._currentPos += self.floatFormatLen
-        velocityY = self._readFloat(rawData, self._currentPos)
-        self._currentPos += self.floatFormatLen
+        pos = self._readPlayerId(rawData)
+        self.player.control = self._readByte(rawData, pos)
+        pos += self.byteFormatLen
+        self.player.selectedItem = self._readByte(rawData, pos)
+        pos += self.byteFormatLen
+        positionX = self._readFloat(rawData, pos)
+        pos += self.floatFormatLen
+        positionY = self._readFloat(rawData, pos)
+        pos += self.floatFormatLen
+        velocityX = self._readFloat(rawData, pos)
+        pos += self.floatFormatLen
+        velocityY = self._readFloat(rawData, pos)
+        pos += self.floatFormatLen
+        self.player.position = (positionX, positionY)
+        self.player.velocity = (velocityX, velocityY)
         return self
 
+    def writeFields(self, writer):
+        player = self.player
+        writer.writePacked(
+            self.FIELDS, player.playerId, player.control,
+            player.selectedItem, player.position[0], player.position[1],
+            player.velocity[0], player.velocity[1])
+
 
-class SendSpawnMessage(Message):
+class SendSpawnMessage(OutboundMessage):
     """
     A message to indicate spawn player
     """
 
     MESSAGE_TYPE = 0x31
 
-    def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
+    __slots__ = ()
 
 
-class ChatMessage(Message):
+class ChatMessage(OutboundMessage):
     """
     A Chat message with colors
     """
 
     MESSAGE_TYPE = 0x19
 
+    __slots__ = ('sentFromId', 'color', 'text')
+
+    FIELDS = Struct("<BBBB")
+
     def __init__(self):
-        Message.__init__(self, self.MESSAGE_TYPE)
         # default to the server sent it
         # this is going to be the id of the
         # player that sent the message
@@ -722,11 +845,6 @@ class ChatMessage(Message):
         self.color = (0x00, 0x00, 0x00)
         self.text = ""
 
-    def serialize(self):
-        self._messageBuf = bytearray()
-        self._writeByte(self.sentFromId)
-        self._writeByte(self.color[0])
-        self._writeByte(self.color[1])
-        self._writeByte(self.color[2])
-        self._messageBuf.extend(self.text)
-        return Message.serialize(self)
+    def writeFields(self, writer):
+        writer.writePacked(self.FIELDS, self.sentFromId, *self.color)
+        writer.writeBytes(self.text)
@@ -4,6 +4,8 @@ import logging
 from messages import ConnectionRequestMessage, PlayerInfoMessage, PlayerHpMessage, PlayerManaMessage, \
     PlayerBuffMessage, PlayerInventoryMessage, RequestWorldDataMessage, TileBlockRequestMessage, SpawnMessage, \
     PlayerUpdateMessage, LoginWithPassword, Message
+from util.metrics import registry
+from util.timer import monotonic
 
 logger = logging.getLogger()
 
@@ -21,6 +23,23 @@ def parseConnectionRequest(rawMessage, session):
     message.clientVersion = rawMessage
     return message
 
+def reusedPerSession(messageClass):
+    """
+    Returns a parser which deserializes every message of C{messageClass}
+    from a session into the same message object, kept in the session's
+    C{reusableMessages}. Only for messages which decode into the session's
+    player and hold nothing of their own, so that a handler still running
+    for the previous message is not affected.
+    """
+
+    def parse(rawMessage, session):
+        message = session.reusableMessages.get(messageClass)
+        if message is None:
+            message = messageClass(session)
+            session.reusableMessages[messageClass] = message
+        return message.deserialize(rawMessage)
+    return parse
+
 messageLookup = {
     ConnectionRequestMessage.MESSAGE_TYPE: parseConnectionRequest,
     LoginWithPassword.MESSAGE_TYPE: (lambda m, s: LoginWithPassword(s).deserialize(m)),
@@ -31,7 +50,7 @@ messageLookup = {
     PlayerInventoryMessage.MESSAGE_TYPE: (lambda m, s: PlayerInventoryMessage(s).deserialize(m)),
     RequestWorldDataMessage.MESSAGE_TYPE: (lambda m, s: RequestWorldDataMessage().deserialize(m)),
     TileBlockRequestMessage.MESSAGE_TYPE: (lambda m, s: TileBlockRequestMessage().deserialize(m)),
-    PlayerUpdateMessage.MESSAGE_TYPE: (lambda m, s: PlayerUpdateMessage(s).deserialize(m)),
+    PlayerUpdateMessage.MESSAGE_TYPE: reusedPerSession(PlayerUpdateMessage),
     SpawnMessage.MESSAGE_TYPE: (lambda m, s: SpawnMessage(s).deserialize(m))
 }
 
@@ -52,6 +71,7 @@ class BinaryMessageParser(object):
         """
 
         #logger.debug("Parsing raw message: %r" % (message,))
+        start = monotonic()
         messageStr = bytes(message)
         messagePos = 0
         messageType, = unpack(
@@ -63,9 +83,13 @@ class BinaryMessageParser(object):
         try:
             # dont include message type...
             parser = messageLookup[messageType](messageStr[1:], session)
-            return parser
         except KeyError:
             logger.error(
-                "Need to implement parser for message type: %d" % messageType)
-        
-        return None
+                "Need to implement parser for message type: %d", messageType)
+            return None
+
+        stats = registry.messageStats(parser.__class__)
+        stats.received += 1
+        stats.bytesIn += len(messageStr) + Message.headerFormatLen
+        stats.parse.observe(monotonic() - start)
+        return parser
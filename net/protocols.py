@@ -1,9 +1,10 @@
+import os
 import struct
 import logging
 import time
 
 from zope.interface import Interface, implements
-from twisted.internet.error import ConnectionLost, ConnectionClosed
+from twisted.internet.error import ConnectionLost, ConnectionClosed, ConnectionDone
 from twisted.internet.defer import Deferred, maybeDeferred, fail
 from twisted.internet.protocol import Protocol
 from twisted.python.failure import Failure
@@ -13,10 +14,17 @@ from twisted.internet.threads import deferToThread
 from messages import ConnectionRequestMessage, DisconnectMessage, RequestPlayerDataMessage, PlayerInfoMessage, \
   PlayerHpMessage, PlayerManaMessage, PlayerBuffMessage, PlayerInventoryMessage, RequestWorldDataMessage, \
   WorldDataMessage, TileBlockRequestMessage, TileLoadingMessage, TileSectionMessage, TileConfirmMessage, \
-  SendSpawnMessage, SpawnMessage, PlayerUpdateMessage, ChatMessage, PasswordRequestMessage
+  SendSpawnMessage, SpawnMessage, PlayerUpdateMessage, ChatMessage, PasswordRequestMessage, \
+  threadWriter
 
 from resources.strings import Strings
 from game.tiles import SECTION_WIDTH, SECTION_HEIGHT
+from tracing import JoinTracer, CONNECTION_REQUEST, PLAYER_INFO, WORLD_REQUEST, \
+  TILE_BLOCK_REQUEST, SPAWN
+from recorder import FlightRecorder, INBOUND, OUTBOUND
+from util import activity
+from util.metrics import registry
+from util.timer import monotonic
 
 
 logger = logging.getLogger()
@@ -24,6 +32,9 @@ logger = logging.getLogger()
 
 UNHANDLED_ERROR_CODE = 'UNHANDLED'
 
+# Activity label used while a raw message is being parsed
+PARSING_ACTIVITY = 'parsing'
+
 
 class IMessageSender(Interface):
     """
@@ -77,6 +88,23 @@ class IMessageHandler(Interface):
         """
 
 
+def encodeMessage(message):
+    """
+    Encodes C{message} into the frame sent to clients, and records how long
+    that took.
+
+    The frame is written into the calling thread's L{MessageWriter}, whose
+    buffer is reused for the next message, while the transport may hold on
+    to what it is given until the reactor gets round to writing it. So the
+    transport is handed one immutable copy of the finished frame.
+    """
+    start = monotonic()
+    data = threadWriter().frame(message).tobytes()
+    registry.messageStats(message.__class__).serialize.observe(
+        monotonic() - start)
+    return data
+
+
 class ProtocolManager:
     """
     Class to manage all connected protocols
@@ -104,16 +132,18 @@ class ProtocolManager:
         """
         Sends a message to all connected protocols
         """
+        data = encodeMessage(message)
         for protocol in self.protocols:
-            protocol.sendMessage(message)
+            protocol.sendEncodedMessage(message, data)
 
     def sendMessageToAllOtherProtocols(self, message, ignoredProtocols):
         """
         Sends a message to all protocols that are not in the ignoredProtocols list
         """
+        data = encodeMessage(message)
         for protocol in self.protocols:
             if protocol not in ignoredProtocols:
-                protocol.sendMessage(message)
+                protocol.sendEncodedMessage(message, data)
 
 
 class MessageHandler:
@@ -164,8 +194,9 @@ class MessageDispatcher:
     
     implements(IMessageReceiver)
 
-    def __init__(self, messageHandlerLocator):
+    def __init__(self, messageHandlerLocator, messageHandler=None):
         self.messageHandlerLocator = messageHandlerLocator
+        self.messageHandler = messageHandler
 
     def startReceivingMessages(self, messageSender):
         self.messageSender = messageSender
@@ -185,15 +216,28 @@ class MessageDispatcher:
       
       # logger.debug("Dispatching message")
       # logger.debug(message)
-        handler = self.messageHandlerLocator.locateHandler(message)
+        start = monotonic()
+        handler = self.messageHandlerLocator.locateHandler(
+            message, self.messageHandler)
         if handler is None:
             return fail(RemoteMessageError(
                 UNHANDLED_ERROR_CODE,
                 "Unhandled Message: %r" % (message,),
                 False,
                 local=Failure(UnhandledMessage())))
+        stats = registry.messageStats(message.__class__)
+        if handler.called and not isinstance(handler.result, Deferred):
+            # the handler ran inline, so it is timed now, without
+            # chaining a callback
+            stats.handle.observe(monotonic() - start)
+        else:
+            handler.addBoth(self._handled, stats, start)
         return handler
 
+    def _handled(self, result, stats, start):
+        stats.handle.observe(monotonic() - start)
+        return result
+
 
 class BinaryMessageProtocol(Protocol):
     """
@@ -206,14 +250,34 @@ class BinaryMessageProtocol(Protocol):
     headerFormatLen = struct.calcsize(headerFormat)
     MAX_LENGTH = 9999
 
+    # A FlightRecorder remembering recent frames, or None
+    flightRecorder = None
+    # A CaptureWriter recording received bytes, or None
+    capture = None
+    captureSession = None
+
     def __init__(self, messageParser, messageReceiver):
         self.messageReceiver = messageReceiver
         self.messageParser = messageParser
+        self.bytesSent = 0
 
     def sendMessage(self, message):
         # logger.debug("Sending message %s" % (message))
         # logger.debug(self.address)
-        self.transport.write(message.serialize())
+        self.sendEncodedMessage(message, encodeMessage(message))
+
+    def sendEncodedMessage(self, message, data):
+        """
+        Sends C{data}, C{message} as returned by L{encodeMessage}, so that
+        a message sent to many protocols is only encoded once.
+        """
+        stats = registry.messageStats(message.__class__)
+        stats.sent += 1
+        stats.bytesOut += len(data)
+        self.bytesSent += len(data)
+        if self.flightRecorder is not None:
+            self.flightRecorder.record(OUTBOUND, data, len(data))
+        self.transport.write(data)
 
     def connectionMade(self):
         self._messageBuffer = bytearray()
@@ -230,6 +294,8 @@ class BinaryMessageProtocol(Protocol):
         Called whenever data is received
         """
         
+        if self.capture is not None:
+            self.capture.data(self.captureSession, data)
         self._messageBuffer.extend(data)
         
         while len(self._messageBuffer) >= self.headerFormatLen:
@@ -242,16 +308,29 @@ class BinaryMessageProtocol(Protocol):
                 self.lengthLimitExceeded(length)
                 break
             
-            if len(self._messageBuffer) < length:
+            if len(self._messageBuffer) < length + self.headerFormatLen:
                 break
             
+            if self.flightRecorder is not None:
+                self.flightRecorder.record(
+                    INBOUND, self._messageBuffer,
+                    length + self.headerFormatLen)
             messageRaw = self._messageBuffer[
                 self.headerFormatLen:length + self.headerFormatLen]
             #logger.debug("Got raw message %s" % (repr(messageRaw)))
             self._messageBuffer = self._messageBuffer[
                 length + self.headerFormatLen:]
-            message = self.messageParser.parse(messageRaw, self)
-            self.messageReceived(message)
+            previous = activity.enter(PARSING_ACTIVITY)
+            try:
+                try:
+                    message = self.messageParser.parse(messageRaw, self)
+                except Exception:
+                    self.parseFailed(messageRaw)
+                    raise
+                activity.enter(type(message).__name__)
+                self.messageReceived(message)
+            finally:
+                activity.leave(previous)
 
     def lengthLimitExceeded(self, length):
         """
@@ -264,6 +343,17 @@ class BinaryMessageProtocol(Protocol):
         # TODO: handle this better
         self.transport.loseConnection()
 
+    def parseFailed(self, messageRaw):
+        """
+        Callback invoked when parsing a message raises an exception, before
+        the exception is propagated. The default implementation does
+        nothing.
+
+        @param messageRaw: The message which failed to parse, starting with
+            its type.
+        @type messageRaw: C{bytearray}
+        """
+
 
 class TerrariaSession(object):
     """
@@ -279,6 +369,8 @@ class TerrariaSession(object):
         """
         self.address = address
         self.player = None
+        # message class -> message object reused for each one received
+        self.reusableMessages = {}
         self.clientNumber = TerrariaSession.getNextAvailableClientNumber()
         self.isAuthed = False
 
@@ -292,6 +384,15 @@ class TerrariaSession(object):
 
 PROTOCOL_VERSION = "Terraria173"
 
+# Join stage which finishes once a message of each class has been handled
+JOIN_STAGE_MESSAGES = {
+    ConnectionRequestMessage: CONNECTION_REQUEST,
+    PlayerInfoMessage: PLAYER_INFO,
+    RequestWorldDataMessage: WORLD_REQUEST,
+    TileBlockRequestMessage: TILE_BLOCK_REQUEST,
+    SpawnMessage: SPAWN,
+}
+
 
 class TerrariaProtocol(
         BinaryMessageProtocol,
@@ -309,17 +410,27 @@ class TerrariaProtocol(
             world,
             config,
             protocolManager,
-            messageReceiver=None):
+            messageReceiver=None,
+            joinTracer=None,
+            capture=None):
         
         if messageReceiver is None:
             messageReceiver = self
+        if joinTracer is None:
+            joinTracer = JoinTracer()
         
-        messageHandlerLocator.messageHandler = self
-        MessageDispatcher.__init__(self, messageHandlerLocator)
+        MessageDispatcher.__init__(self, messageHandlerLocator, self)
         BinaryMessageProtocol.__init__(self, messageParser, messageReceiver)
         self.world = world
         self.config = config
         self.protocolManager = protocolManager
+        self.joinTracer = joinTracer
+        self.joinTrace = None
+        self.capture = capture
+        self._flightDump = (None, None)
+        if config.flightRecorderFrames:
+            self.flightRecorder = FlightRecorder(
+                config.flightRecorderFrames, config.flightRecorderBytes)
 
     def connectionMade(self):
         """
@@ -327,13 +438,78 @@ class TerrariaProtocol(
         """
         # tell the protocol manager that a new connection has arrived
         self.protocolManager.connectionMade(self)
+        self.joinTrace = self.joinTracer.begin()
+        if self.capture is not None:
+            self.captureSession = self.capture.opened()
         self.sessionConnect(self.transport.client)
         logger.debug(
-            "New connection with client number %d" %
-            (self.clientNumber))
+            "New connection with client number %d", self.clientNumber)
         
         BinaryMessageProtocol.connectionMade(self)
 
+    def connectionLost(self, reason):
+        if not reason.check(ConnectionDone):
+            self.dumpFlightRecorder(
+                "connection lost: %s" % (reason.getErrorMessage(),))
+        if self.capture is not None:
+            self.capture.closed(self.captureSession)
+        BinaryMessageProtocol.connectionLost(self, reason)
+
+    def parseFailed(self, messageRaw):
+        self.dumpFlightRecorder("failed to parse message type %d" % (
+            messageRaw[0] if messageRaw else -1,))
+
+    def dumpFlightRecorder(self, reason):
+        """
+        Writes the frames remembered for this connection to a file in the
+        configured directory, unless nothing has been recorded since the
+        last time (e.g. a parse failure followed by the connection being
+        dropped because of it).
+
+        @return: the path written to, or C{None} if nothing was written
+        """
+
+        if self.flightRecorder is None:
+            return None
+        recorded = self.flightRecorder.recorded
+        if self._flightDump[0] == recorded:
+            return self._flightDump[1]
+        path = os.path.join(
+            self.config.flightRecorderDirectory,
+            "flight-%d-%s-%d.txt" % (
+                self.clientNumber, time.strftime("%Y%m%d-%H%M%S"), recorded))
+        try:
+            self.flightRecorder.dump(path, "client %d (%s): %s" % (
+                self.clientNumber, self.address, reason))
+        except (IOError, OSError), e:
+            logger.error("Could not write flight recorder to %s: %s", path, e)
+            return None
+        self._flightDump = (recorded, path)
+        logger.warning(
+            "Flight recorder for client %d written to %s (%s)",
+            self.clientNumber, path, reason)
+        return path
+
+    def messageReceived(self, message):
+        d = self._dispatchMessage(message)
+        stage = JOIN_STAGE_MESSAGES.get(message.__class__)
+        if stage is not None and not self.joinTrace.finished:
+            self.joinTracer.dispatched(self.joinTrace, stage)
+            d.addCallbacks(self._joinStageDone, self._joinStageFailed,
+                           callbackArgs=(stage,), errbackArgs=(stage,))
+
+    def _joinStageDone(self, result, stage):
+        self.joinTracer.mark(
+            self.joinTrace, stage, self.bytesSent,
+            "client %d (%s)" % (self.clientNumber, self.address))
+        return result
+
+    def _joinStageFailed(self, failure, stage):
+        self.joinTracer.failed(
+            self.joinTrace, stage,
+            "client %d (%s)" % (self.clientNumber, self.address))
+        return failure
+
     def _disconnect(self, reason=None):
         if reason:
             message = DisconnectMessage()
@@ -364,7 +540,7 @@ class TerrariaProtocol(
     def newPlayer(self, playerInfoMessage):
         self.player = playerInfoMessage.player
 
-        logger.debug("%s has joined!" % (self.player.name))
+        logger.debug("%s has joined!", self.player.name)
 
     PlayerInfoMessage.handler(newPlayer)
 
@@ -445,14 +621,13 @@ class TerrariaProtocol(
     TileBlockRequestMessage.handler(gotTileBlockRequest)
 
     def gotSpawnPlayer(self, spawnPlayerMessage):
-        logger.debug("Got %s spawn!" % (spawnPlayerMessage.player.name))
+        logger.debug("Got %s spawn!", spawnPlayerMessage.player.name)
 
     SpawnMessage.handler(gotSpawnPlayer)
 
     def gotPlayerUpdateMessage(self, playerUpdateMessage):
         logger.debug(
-            "Got %s player update" %
-            (playerUpdateMessage.player.name))
+            "Got %s player update", playerUpdateMessage.player.name)
 
     PlayerUpdateMessage.handler(gotPlayerUpdateMessage)
 
@@ -0,0 +1,138 @@
+import threading
+import time
+from array import array
+
+from util.formatters import ByteToHex
+
+# Frame directions
+INBOUND = 0
+OUTBOUND = 1
+DIRECTION_NAMES = ("in", "out")
+
+# Bytes of length prefix before the message type of every frame
+FRAME_HEADER_LENGTH = 2
+
+
+class FlightRecorder(object):
+    """
+    Remembers the last few frames sent and received on a connection so
+    they can be written out when something goes wrong.
+
+    Frames are kept in a ring of preallocated arrays, and up to
+    C{prefixLength} bytes of each frame (starting with its length
+    header) are copied through a buffer straight into a preallocated
+    bytearray, without slicing the frame, so recording keeps no objects
+    alive per frame and costs about the same as a couple of array
+    stores. Frames are stamped with C{time.time()}: the monotonic clock
+    costs a ctypes call, twenty times as much, and dumps are read next to
+    logs stamped with wall clock time anyway.
+
+    @ivar capacity: Number of frames remembered.
+    @ivar prefixLength: Number of bytes kept from the start of each frame.
+    @ivar recorded: Total number of frames recorded.
+    """
+
+    def __init__(self, capacity=256, prefixLength=64):
+        self.capacity = capacity
+        self.prefixLength = max(prefixLength, FRAME_HEADER_LENGTH + 1)
+        self.recorded = 0
+        self._times = array('d', [0.0]) * capacity
+        self._directions = array('B', [0]) * capacity
+        self._lengths = array('L', [0]) * capacity
+        self._kept = array('H', [0]) * capacity
+        self._prefixes = bytearray(capacity * self.prefixLength)
+        self._prefixView = memoryview(self._prefixes)
+        self._lock = threading.Lock()
+
+    def record(self, direction, data, length):
+        """
+        Records a frame.
+
+        @param direction: L{INBOUND} or L{OUTBOUND}
+        @param data: A string or bytearray starting with the frame,
+            length header included. Anything after C{length} bytes is
+            ignored.
+        @param length: Length of the whole frame.
+        """
+
+        kept = min(length, self.prefixLength)
+        with self._lock:
+            slot = self.recorded % self.capacity
+            self.recorded += 1
+            self._times[slot] = time.time()
+            self._directions[slot] = direction
+            self._lengths[slot] = length
+            self._kept[slot] = kept
+            start = slot * self.prefixLength
+            self._prefixView[start:start + kept] = buffer(data, 0, kept)
+
+    def frames(self):
+        """
+        Returns the remembered frames, oldest first, as tuples of
+        C{(time, direction, messageType, length, prefix)}. The message
+        type is C{None} for frames too short to have one.
+        """
+
+        with self._lock:
+            count = min(self.recorded, self.capacity)
+            first = self.recorded - count
+            frames = []
+            for i in xrange(first, self.recorded):
+                slot = i % self.capacity
+                start = slot * self.prefixLength
+                prefix = bytes(
+                    self._prefixes[start:start + self._kept[slot]])
+                if len(prefix) > FRAME_HEADER_LENGTH:
+                    messageType = ord(prefix[FRAME_HEADER_LENGTH])
+                else:
+                    messageType = None
+                frames.append((
+                    self._times[slot], self._directions[slot],
+                    messageType, self._lengths[slot], prefix))
+            return frames
+
+    def dump(self, path, description=""):
+        """
+        Writes the remembered frames to C{path}, one per line:
+        time, direction, message type, frame length and the kept bytes
+        formatted by L{ByteToHex}. Lines starting with C{#} are comments.
+        See L{readDump}.
+        """
+
+        frames = self.frames()
+        with open(path, "w") as f:
+            f.write("# flight recorder: %s\n" % (description,))
+            f.write("# %d frames recorded, last %d kept, %d bytes each\n" % (
+                self.recorded, len(frames), self.prefixLength))
+            f.write("# time direction type length bytes\n")
+            for when, direction, messageType, length, prefix in frames:
+                f.write("%.6f %s %s %d %s\n" % (
+                    when, DIRECTION_NAMES[direction],
+                    "-" if messageType is None else messageType, length,
+                    ByteToHex(prefix)))
+        return path
+
+
+def readDump(path):
+    """
+    Reads a file written by L{FlightRecorder.dump}.
+
+    @return: a list of C{(time, direction, messageType, length, data)}
+        tuples. C{data} holds the whole frame only when
+        C{len(data) == length}.
+    """
+
+    frames = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split(" ", 4)
+            when, direction, messageType, length = fields[:4]
+            hexBytes = fields[4] if len(fields) > 4 else ""
+            frames.append((
+                float(when), DIRECTION_NAMES.index(direction),
+                None if messageType == "-" else int(messageType),
+                int(length), bytes(bytearray.fromhex(hexBytes))))
+    return frames
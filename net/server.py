@@ -1,10 +1,29 @@
 import logging
+import os
+import signal
+import threading
+import time
 
 from twisted.internet import reactor
 from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
 from factories import TerrariaFactory
+from admin import AdminFactory, MetricsResource, ADMIN_INTERFACE
 from game.world import World
+from game.ticks import TickEngine
+from game.autosave import Autosaver
+from db.adapters import DatabaseAdapter
+from db.repositories import CachingWorldRepository
+from db.journal import TileJournal
+from game import memory
+from util.watchdog import Watchdog
+from util.profiler import SamplingProfiler
+from util.metrics import registry
+from util.writers import WorldFileWriter
 from game.tiles import TileSection, Tile, dirtTile, airTile, ironTile, SECTION_WIDTH, SECTION_HEIGHT
 
 
@@ -23,16 +42,16 @@ def tmpDebugWorldRemoveMe():
     w.worldSurface = 200
     w.rockLayer = 400
     topLeftTs = TileSection()
-    for y in range(4):
+    for x in range(w.width / SECTION_WIDTH):
         w.tileSections.append([])
-        for x in range(6):
+        for y in range(w.height / SECTION_HEIGHT):
             ts = TileSection()
             ts.x = x
             ts.y = y
             for ty in range(50, SECTION_HEIGHT):
                 for tx in range(SECTION_WIDTH):
                     ts.setTile(tx, ty, ironTile)
-            w.tileSections[y].append(ts)
+            w.tileSections[x].append(ts)
     return w
 
 
@@ -44,19 +63,338 @@ class TerrariaServer:
     def __init__(self, config):
         self.config = config
         self.world = tmpDebugWorldRemoveMe()
+        self.tickEngine = TickEngine(self.world, reactor)
+        self.databaseAdapter = DatabaseAdapter(self.config.databaseConfig)
+        self.worldRepository = CachingWorldRepository(self.databaseAdapter)
+        self.journal = None
+        if self.config.journalDirectory:
+            self.journal = TileJournal(
+                self.config.journalDirectory,
+                self.config.journalSyncInterval)
+        self.autosaver = Autosaver(
+            self.world, self.worldRepository, self.config.autosaveInterval,
+            journal=self.journal)
+        self.watchdog = Watchdog(reactor, self.config.watchdogThreshold)
         self.factory = TerrariaFactory(self.world, config)
         serverEndpoint = "tcp:%d:interface=%s" % (
             self.config.listenPort, self.config.listenAddress)
         
         self.endpoint = serverFromString(reactor, serverEndpoint)
+        self.profiler = None
+        self.adminFactory = AdminFactory()
+        self.adminFactory.addCommand(
+            "profile", self.profileCommand,
+            "profile start [rate] | stop | status")
+        self.adminFactory.addCommand(
+            "stats", self.statsCommand, "Show message and tick statistics")
+        self.adminFactory.addCommand(
+            "memory", self.memoryCommand,
+            "memory [all] | trace start|stop - world memory report")
+        self.adminFactory.addCommand(
+            "flight", self.flightCommand,
+            "flight [client] - write recent frames of connections to disk")
+        self.adminFactory.addCommand(
+            "save", self.saveCommand, "Save the changed parts of the world")
+        self.adminFactory.addCommand(
+            "export", self.exportCommand,
+            "export <file> - write the world to a Terraria world file")
+        self._registerMetrics()
+
+    def _registerMetrics(self):
+        registry.addHistogram(
+            "terraria_tick_seconds", "Time spent running a whole frame",
+            self.tickEngine.frameHistogram)
+        for phase in self.tickEngine.phases:
+            registry.addHistogram(
+                "terraria_tick_phase_seconds", "Time spent in a tick phase",
+                phase.histogram, phase=phase.name)
+            registry.addGauge(
+                "terraria_tick_phase_skipped_total",
+                "Frames on which a tick phase was skipped",
+                lambda phase=phase: phase.skipped, "counter",
+                phase=phase.name)
+        registry.addGauge(
+            "terraria_tick_dropped_frames_total",
+            "Frames dropped while catching up",
+            lambda: self.tickEngine.droppedFrames, "counter")
+        registry.addHistogram(
+            "terraria_reactor_lag_seconds", "How late the reactor heartbeat ran",
+            self.watchdog.lagHistogram)
+        registry.addGauge(
+            "terraria_reactor_stalls_total", "Reactor stalls detected",
+            lambda: self.watchdog.stalls, "counter")
+        registry.addGauge(
+            "terraria_reactor_longest_stall_seconds",
+            "Longest delay of the reactor heartbeat",
+            lambda: self.watchdog.longestStall)
+        tracer = self.factory.joinTracer
+        registry.addHistogram(
+            "terraria_join_seconds", "Time from connecting to spawning",
+            tracer.joinHistogram)
+        for stage, histogram in tracer.stageHistograms.iteritems():
+            registry.addHistogram(
+                "terraria_join_stage_seconds",
+                "Time from the end of the previous join stage until this "
+                "stage's handler finished",
+                histogram, stage=stage)
+        registry.addGauge(
+            "terraria_slow_joins_total", "Joins slower than the threshold",
+            lambda: tracer.slowJoins, "counter")
+        registry.addGauge(
+            "terraria_failed_joins_total",
+            "Joins whose handler failed for a stage",
+            lambda: tracer.failedJoins, "counter")
+        registry.addGauge(
+            "terraria_connections", "Connected clients",
+            lambda: len(self.factory.protocolManager.protocols))
+        registry.addGauge(
+            "terraria_world_snapshots", "Live world snapshots",
+            lambda: len(self.world.snapshots))
+        registry.addGauge(
+            "terraria_world_snapshot_bytes",
+            "Memory held by world snapshots on top of the world",
+            lambda: sum(snapshot.extraBytes()
+                        for snapshot in list(self.world.snapshots)))
+        self.databaseAdapter.registerMetrics(registry)
+        self.worldRepository.registerMetrics(registry)
+        self.autosaver.registerMetrics(registry)
+        if self.journal is not None:
+            self.journal.registerMetrics(registry)
+
+    def statsCommand(self):
+        return (registry.summary() + self.factory.joinTracer.report() +
+                self.tickEngine.report() + self.watchdog.report() +
+                self.autosaver.report() + self.worldRepository.report() +
+                (self.journal.report() if self.journal is not None else []))
+
+    def saveCommand(self):
+        d = self.autosaver.save()
+        d.addCallback(
+            lambda result: ["%d sections, %d bytes written" % result])
+        return d
+
+    def exportCommand(self, path=None):
+        if path is None:
+            return ["usage: export <file>"]
+        # the game carries on while a thread writes the snapshot
+        snapshot = self.world.snapshot()
+        d = deferToThread(WorldFileWriter(path).writeWorld, snapshot)
+        d.addBoth(self._exported, snapshot)
+        d.addCallback(lambda size: ["%s: %d bytes written" % (path, size)])
+        return d
+
+    def _exported(self, result, snapshot):
+        snapshot.release()
+        return result
+
+    def memoryCommand(self, action=None, traceAction=None):
+        if action == "trace":
+            if memory.tracemalloc is None:
+                return ["tracemalloc is not available"]
+            if traceAction == "start":
+                memory.tracemalloc.start()
+                return ["tracemalloc started"]
+            elif traceAction == "stop":
+                memory.tracemalloc.stop()
+                return ["tracemalloc stopped"]
+            return ["usage: memory trace start|stop"]
+        limit = None if action == "all" else 10
+        # walking every tile takes a while on a big world
+        return deferToThread(self._memoryReport, limit)
+
+    def _memoryReport(self, limit):
+        return (memory.WorldMemoryReport(self.world).lines(limit) +
+                memory.topAllocators())
+
+    def flightCommand(self, clientNumber=None):
+        lines = []
+        for protocol in list(self.factory.protocolManager.protocols):
+            if clientNumber is not None and \
+                    protocol.clientNumber != int(clientNumber):
+                continue
+            path = protocol.dumpFlightRecorder("admin request")
+            if path is not None:
+                lines.append("client %d: %s" % (protocol.clientNumber, path))
+        return lines or ["no flight recorders written"]
+
+    def _logStats(self):
+        for line in self.statsCommand():
+            logger.info("stats: %s", line)
+
+    def startProfiler(self, rate=None):
+        """
+        Starts sampling the reactor thread's stack.
+        """
+
+        if self.profiler is not None:
+            return
+        self.profiler = SamplingProfiler(
+            self._reactorThreadId, rate or self.config.profilerRate)
+        self.profiler.start()
+        logger.info(
+            "Profiler started at %d samples/s", self.profiler.rate)
+
+    def stopProfiler(self):
+        """
+        Stops the profiler and writes its samples to a collapsed stack
+        file in the configured directory.
+
+        @return: the path written to
+        """
+
+        if self.profiler is None:
+            return None
+        profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        path = os.path.join(
+            self.config.profileDirectory,
+            time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+        profiler.writeCollapsed(path)
+        logger.info(
+            "Profiler stopped after %d samples, written to %s",
+            profiler.samples, path)
+        return path
+
+    def toggleProfiler(self):
+        if self.profiler is None:
+            self.startProfiler()
+        else:
+            self.stopProfiler()
+
+    def profileCommand(self, action="status", rate=None):
+        if action == "start":
+            if self.profiler is not None:
+                return ["profiler already running"]
+            self.startProfiler(int(rate) if rate else None)
+            return ["profiler started at %d samples/s" % self.profiler.rate]
+        elif action == "stop":
+            if self.profiler is None:
+                return ["profiler is not running"]
+            profiler = self.profiler
+            path = self.stopProfiler()
+            lines = ["%d samples written to %s" % (profiler.samples, path)]
+            for name, count in profiler.topFunctions(10):
+                lines.append("%6d  %s" % (count, name))
+            return lines
+        elif action == "status":
+            if self.profiler is None:
+                return ["profiler is not running"]
+            return ["profiler running, %d samples" % self.profiler.samples]
+        return ["usage: profile start [rate] | stop | status"]
+
+    def _installSignalHandlers(self):
+        """
+        SIGUSR1 toggles the profiler.
+        """
+
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(
+                signal.SIGUSR1,
+                lambda signum, frame: reactor.callFromThread(
+                    self.toggleProfiler))
+
+    def _loadWorld(self):
+        """
+        Replaces the world's state with its saved copy, if there is one,
+        and replays the tile edits journaled since it was saved.
+
+        @return: a L{Deferred} firing once the world is loaded
+        """
+
+        d = self.worldRepository.getWorld(self.world)
+        d.addCallback(self._gotWorld)
+        if self.journal is not None:
+            d.addCallback(self._replayJournal)
+        return d
+
+    def _gotWorld(self, world):
+        if world.worldId <= 0:
+            logger.info("%r has not been saved yet", world)
+            return world
+        d = self.worldRepository.loadSections(world)
+        d.addCallback(self._loadedWorld)
+        return d
+
+    def _loadedWorld(self, world):
+        self.autosaver.markSaved()
+        logger.info("Loaded %r", world)
+        return world
+
+    def _replayJournal(self, world):
+        # replayed edits are not saved, so they leave their sections dirty
+        self.journal.replay(world)
+        self.journal.start()
+        world.journal = self.journal
+        reactor.addSystemEventTrigger("during", "shutdown", self.journal.stop)
+        return world
+
+    def _startAutosave(self, world):
+        # the journal is only truncated by saves, so with it on the world
+        # is saved at shutdown even if autosave is off
+        if self.config.autosaveInterval or self.journal is not None:
+            self.autosaver.start()
+
+    def start(self):
+        """
+        Starts listening and ticking without running the reactor, for
+        running the server alongside other code in the same process.
+        Must be called from the reactor thread.
+
+        Players are only let in, and the world only starts ticking, once
+        the world is loaded (or failed to load, in which case the server
+        runs on the world from the config without autosaving it).
+
+        @return: a L{Deferred} firing once the server is listening
+        """
 
-    def run(self):
         logger.debug("Starting Server")
-        self.endpoint.listen(self.factory)
-        logger.debug(
-            "Listening. %s:%d" %
-            (self.config.listenAddress,
-             self.config.listenPort))
-        
+        self._reactorThreadId = threading.current_thread().ident
+        self.databaseAdapter.start()
+        d = self._loadWorld()
+        d.addCallbacks(
+            self._startAutosave,
+            lambda failure: logger.error(
+                "Error loading %r, autosave is disabled: %s",
+                self.world, failure.getTraceback()))
+        d.addCallback(self._startServing)
+        self._installSignalHandlers()
+        if self.config.adminPort:
+            reactor.listenTCP(
+                self.config.adminPort, self.adminFactory,
+                interface=ADMIN_INTERFACE)
+        if self.config.metricsPort:
+            root = Resource()
+            root.putChild("metrics", MetricsResource(registry))
+            reactor.listenTCP(
+                self.config.metricsPort, Site(root),
+                interface=ADMIN_INTERFACE)
+        if self.config.statsLogInterval:
+            LoopingCall(self._logStats).start(
+                self.config.statsLogInterval, now=False)
+        self.watchdog.start()
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", self.watchdog.stop)
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stopProfiler)
+        if self.factory.capture is not None:
+            reactor.addSystemEventTrigger(
+                "before", "shutdown", self.factory.capture.close)
+        return d
+
+    def _startServing(self, ignored):
         self.world.start()
-        reactor.run()
\ No newline at end of file
+        self.tickEngine.start()
+        d = self.endpoint.listen(self.factory)
+        d.addCallback(self._listening)
+        return d
+
+    def _listening(self, port):
+        logger.debug(
+            "Listening. %s:%d",
+            self.config.listenAddress,
+            self.config.listenPort)
+        return port
+
+    def run(self):
+        self.start()
+        reactor.run()
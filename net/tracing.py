@@ -0,0 +1,131 @@
+import logging
+
+from util.metrics import Histogram
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+CONNECTION_REQUEST = "connectionRequest"
+PLAYER_INFO = "playerInfo"
+WORLD_REQUEST = "worldRequest"
+TILE_BLOCK_REQUEST = "tileBlockRequest"
+SPAWN = "spawn"
+
+# The stages of a join, in the order a client goes through them
+JOIN_STAGES = (
+    CONNECTION_REQUEST, PLAYER_INFO, WORLD_REQUEST, TILE_BLOCK_REQUEST, SPAWN)
+
+
+class JoinTrace(object):
+    """
+    When each join stage of one session finished, and how many bytes
+    had been sent to the client by then.
+
+    @ivar marks: (stage, time, bytesSent) tuples in the order the stages
+        finished. Handlers run on a thread pool, so this need not be the
+        order the client sent them in.
+    @ivar pending: Stages whose message has been dispatched but whose
+        handler has not finished.
+    """
+
+    __slots__ = ('started', 'marks', 'pending', 'finished')
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = []
+        self.pending = set()
+        self.finished = False
+
+    def hasFinished(self, stage):
+        for mark in self.marks:
+            if mark[0] == stage:
+                return True
+        return False
+
+
+class JoinTracer(object):
+    """
+    Aggregates L{JoinTrace}s into a latency histogram per stage, where
+    a stage lasts from the end of the previous one until its handler
+    has finished, and one for the whole join. A join is complete once
+    L{SPAWN} and every stage dispatched before it have finished. Joins
+    slower than C{slowThreshold} seconds are logged with their
+    breakdown. A join whose handler fails for a stage is counted as
+    failed instead, and left out of the histograms.
+    """
+
+    def __init__(self, slowThreshold=5.0):
+        self.slowThreshold = slowThreshold
+        self.stageHistograms = dict(
+            (stage, Histogram()) for stage in JOIN_STAGES)
+        self.joinHistogram = Histogram()
+        self.joins = 0
+        self.slowJoins = 0
+        self.failedJoins = 0
+
+    def begin(self):
+        return JoinTrace(monotonic())
+
+    def dispatched(self, trace, stage):
+        """
+        Records that the message for C{stage} has been dispatched.
+        """
+
+        if not trace.finished and not trace.hasFinished(stage):
+            trace.pending.add(stage)
+
+    def mark(self, trace, stage, bytesSent, description):
+        """
+        Records that C{stage} has finished. Only the first time a stage
+        finishes counts.
+        """
+
+        if trace.finished or stage not in trace.pending:
+            return
+        trace.pending.discard(stage)
+        trace.marks.append((stage, monotonic(), bytesSent))
+        if not trace.pending and trace.hasFinished(SPAWN):
+            self._finish(trace, description)
+
+    def failed(self, trace, stage, description):
+        """
+        Records that the handler for C{stage} failed, which ends the
+        join.
+        """
+
+        if trace.finished or stage not in trace.pending:
+            return
+        trace.finished = True
+        self.failedJoins += 1
+        logger.info("Join for %s failed in %s after %.1fms", description,
+                    stage, (monotonic() - trace.started) * 1000)
+
+    def _finish(self, trace, description):
+        trace.finished = True
+        self.joins += 1
+
+        breakdown = []
+        previous = trace.started
+        previousBytes = 0
+        for stage, at, bytesSent in trace.marks:
+            self.stageHistograms[stage].observe(at - previous)
+            breakdown.append("%s %.1fms %dB" % (
+                stage, (at - previous) * 1000, bytesSent - previousBytes))
+            previous, previousBytes = at, bytesSent
+
+        total = previous - trace.started
+        self.joinHistogram.observe(total)
+        if total > self.slowThreshold:
+            self.slowJoins += 1
+            logger.warning(
+                "Slow join for %s: %.1fms, %dB sent (%s)",
+                description, total * 1000, previousBytes,
+                ", ".join(breakdown))
+
+    def report(self):
+        lines = ["join: %s slow=%d failed=%d" % (
+            self.joinHistogram.summary(), self.slowJoins, self.failedJoins)]
+        for stage in JOIN_STAGES:
+            lines.append("join %s: %s" % (
+                stage, self.stageHistograms[stage].summary()))
+        return lines
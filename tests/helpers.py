@@ -0,0 +1,43 @@
+from twisted.internet.task import Clock
+
+from game.tiles import TileSection, airTile, SECTION_WIDTH, SECTION_HEIGHT
+from game.world import World
+
+
+def makeWorld(columns=2, rows=2):
+    """
+    Returns a world of C{columns} by C{rows} unallocated air sections.
+    """
+    world = World(platformClock=Clock())
+    world.width = columns * SECTION_WIDTH
+    world.height = rows * SECTION_HEIGHT
+    for x in xrange(columns):
+        world.tileSections.append([])
+        for y in xrange(rows):
+            section = TileSection()
+            section.x = x
+            section.y = y
+            section.tileType = airTile.tileType
+            world.tileSections[x].append(section)
+    return world
+
+
+def setTile(world, x, y, tile):
+    """
+    Sets the tile at C{(x, y)} in C{world}, straight in its section.
+    """
+    world.getSectionAt((x, y)).setTile(
+        x % SECTION_WIDTH, y % SECTION_HEIGHT, tile)
+
+
+def tileAt(world, x, y):
+    """
+    Returns the tile at C{(x, y)} in C{world}, air in sections which
+    were never allocated.
+    """
+    section = world.getSectionAt((x, y))
+    if section.tiles is None:
+        return airTile
+    return section.tiles[(y % SECTION_HEIGHT) * SECTION_WIDTH +
+                         x % SECTION_WIDTH]
+
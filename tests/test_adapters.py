@@ -0,0 +1,37 @@
+from sqlalchemy.exc import OperationalError
+from twisted.trial import unittest
+
+from config.database import SimpleDatabaseConfig
+from db.adapters import DatabaseAdapter
+
+
+class DatabaseAdapterTests(unittest.TestCase):
+    """
+    Tests for L{DatabaseAdapter}.
+    """
+
+    def setUp(self):
+        self.adapter = DatabaseAdapter(SimpleDatabaseConfig(
+            "sqlite", ":memory:", None, None, None, None))
+        self.connection = self.adapter.engine.connect()
+        self.addCleanup(self.connection.close)
+
+    def test_queryTimed(self):
+        """
+        Each statement's latency is observed under its kind.
+        """
+        self.connection.execute("SELECT 1").fetchall()
+        self.assertEqual(self.adapter.queryHistograms["select"].count, 1)
+
+    def test_failedStatement(self):
+        """
+        A statement which fails leaves no timing state behind on its
+        connection, and the statements after it are still timed.
+        """
+        for i in xrange(3):
+            self.assertRaises(
+                OperationalError, self.connection.execute,
+                "SELECT * FROM NoSuchTable")
+        self.connection.execute("SELECT 1").fetchall()
+        self.assertNotIn('queryStart', self.connection.info)
+        self.assertEqual(self.adapter.queryHistograms["select"].count, 1)
@@ -0,0 +1,95 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from db.journal import TileJournal
+from game.autosave import Autosaver
+from game.tiles import ironTile
+from tests.helpers import makeWorld
+
+
+class ShutdownClock(Clock):
+    """
+    A L{Clock} which runs the system event triggers added to it when
+    told to shut down.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, eventType, f, *args, **kw):
+        self.triggers.append((phase, eventType, f, args, kw))
+        return len(self.triggers)
+
+    def shutDown(self):
+        for phase, eventType, f, args, kw in self.triggers:
+            if eventType == "shutdown":
+                f(*args, **kw)
+
+
+class FakeRepository(object):
+    """
+    Records the sections saved instead of writing them anywhere.
+    """
+
+    def __init__(self):
+        self.saved = []
+
+    def saveWorld(self, world):
+        world.worldId = 1
+        return succeed(world)
+
+    def saveSections(self, snapshot, sections):
+        self.saved.extend((section.x, section.y) for section in sections)
+        return succeed((len(sections), 0))
+
+
+class AutosaverTests(unittest.TestCase):
+    """
+    Tests for L{Autosaver}.
+    """
+
+    def setUp(self):
+        self.clock = ShutdownClock()
+        self.world = makeWorld()
+        self.repository = FakeRepository()
+
+    def test_periodic(self):
+        """
+        Sections changed since the last save are saved every interval.
+        """
+        autosaver = Autosaver(
+            self.world, self.repository, 30, clock=self.clock)
+        autosaver.markSaved()
+        autosaver.start()
+        self.world.setTileAt((1, 1), ironTile)
+        self.clock.advance(30)
+        self.assertEqual(self.repository.saved, [(0, 0)])
+        self.clock.advance(30)
+        self.assertEqual(self.repository.saved, [(0, 0)])
+
+    def test_shutdownWithoutInterval(self):
+        """
+        With an interval of 0 nothing is saved periodically, but changes
+        are still saved, and the journal checkpointed, at shutdown.
+        """
+        journal = TileJournal(self.mktemp(), syncInterval=3600)
+        journal.start()
+        self.addCleanup(journal.stop)
+        self.world.journal = journal
+        autosaver = Autosaver(
+            self.world, self.repository, 0, clock=self.clock,
+            journal=journal)
+        autosaver.markSaved()
+        autosaver.start()
+        self.world.setTileAt((1, 1), ironTile)
+        self.clock.advance(3600)
+        self.assertEqual(self.repository.saved, [])
+
+        self.clock.shutDown()
+        journal.stop()
+        self.assertEqual(self.repository.saved, [(0, 0)])
+        self.assertEqual(len(journal.segments()), 1)
+        self.assertEqual(TileJournal(journal.directory).replay(
+            makeWorld()), 0)
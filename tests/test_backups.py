@@ -0,0 +1,77 @@
+from twisted.internet.defer import succeed
+from twisted.trial import unittest
+
+from db.backups import BACKUP_ATTEMPTS, BackupStore, backupWorld
+from tests.helpers import makeWorld
+
+
+class RacingRepository(object):
+    """
+    A repository whose world is saved again between reading its section
+    hashes and their BLOBs for the first C{races} backup reads.
+    """
+
+    def __init__(self, races):
+        self.races = races
+        self.reads = 0
+        self.world = makeWorld()
+        self.world.name = "Racing"
+        self.world.worldId = 1
+
+    def getWorldHeader(self, worldId=0, name=""):
+        return succeed(self.world if name == self.world.name else None)
+
+    def sectionDigests(self, world, isStored):
+        self.reads += 1
+        if self.reads <= self.races:
+            # "old" was replaced by "new" before its BLOB was read
+            digests = [(0, 0, 1, "old")]
+            blobs = {}
+        else:
+            digests = [(0, 0, 2, "new")]
+            blobs = {"new": "blob"}
+        missing = set(digest for x, y, version, digest in digests
+                      if not isStored(digest))
+        return succeed((digests, missing, dict(
+            (digest, blobs[digest]) for digest in missing
+            if digest in blobs)))
+
+
+class BackupWorldTests(unittest.TestCase):
+    """
+    Tests for L{backupWorld}.
+    """
+
+    def setUp(self):
+        self.store = BackupStore(self.mktemp())
+
+    def test_retriedWhenSectionsChange(self):
+        """
+        A backup whose sections were replaced before their BLOBs were
+        read is read again, and the manifest only lists stored objects.
+        """
+        repository = RacingRepository(races=2)
+        d = backupWorld(repository, self.store, "Racing")
+
+        def check(result):
+            self.assertEqual(repository.reads, 3)
+            self.assertEqual(result.sections, 1)
+            manifest = self.store.readManifest(result.manifest)
+            self.assertEqual(manifest['sections'], [[0, 0, 2, "new"]])
+            self.assertTrue(self.store.hasObject("new"))
+            self.assertFalse(self.store.hasObject("old"))
+        return d.addCallback(check)
+
+    def test_givesUp(self):
+        """
+        A backup of a world which changes on every read fails without
+        writing a manifest.
+        """
+        repository = RacingRepository(races=BACKUP_ATTEMPTS)
+        d = backupWorld(repository, self.store, "Racing")
+        self.assertFailure(d, ValueError)
+
+        def check(ignored):
+            self.assertEqual(repository.reads, BACKUP_ATTEMPTS)
+            self.assertEqual(self.store.manifests(), [])
+        return d.addCallback(check)
@@ -0,0 +1,111 @@
+import random
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from game.environment import SimulationTime
+
+
+class SimulationTimeTests(unittest.TestCase):
+    """
+    Tests for L{SimulationTime} and the L{util.wheel.TimingWheel} holding
+    its pending calls.
+    """
+
+    def setUp(self):
+        self.platform = Clock()
+        self.simulation = SimulationTime(30, self.platform)
+        self.simulation.start()
+
+    def test_orderingMatchesClock(self):
+        """
+        Calls run in the same order as they do on a L{Clock}, from calls
+        due within a frame to ones far enough away to overflow the top
+        level of the wheel.
+        """
+        rand = random.Random(4)
+        reference = Clock()
+        expected, ran = [], []
+        for i in xrange(2000):
+            delay = rand.choice([
+                0, rand.randint(0, 10) / 30.0, rand.uniform(0, 100),
+                rand.uniform(0, 1000000)])
+            reference.callLater(delay, expected.append, i)
+            self.simulation.callLater(delay, ran.append, i)
+        reference.advance(1000001)
+        self.platform.advance(1000001)
+        self.assertEqual(len(ran), 2000)
+        self.assertEqual(ran, expected)
+
+    def test_raisingCall(self):
+        """
+        A call which raises does not lose the calls due in the same frame
+        after it: like on a L{Clock}, they stay pending and run on the
+        next advance.
+        """
+        def boom():
+            raise ZeroDivisionError()
+
+        reference = Clock()
+        expected, ran = [], []
+        for clock, record in ((reference, expected),
+                              (self.simulation, ran)):
+            clock.callLater(1, boom)
+            calls = [clock.callLater(1, record.append, i)
+                     for i in xrange(3)]
+            self.assertRaises(ZeroDivisionError, clock.advance, 2)
+            self.assertEqual(record, [])
+            self.assertTrue(calls[0].active())
+            self.assertEqual(len(clock.getDelayedCalls()), 3)
+            clock.advance(0)
+        self.assertEqual(ran, [0, 1, 2])
+        self.assertEqual(ran, expected)
+
+    def test_cancelled(self):
+        """
+        A cancelled call does not run.
+        """
+        ran = []
+        call = self.simulation.callLater(1, ran.append, 1)
+        call.cancel()
+        self.platform.advance(2)
+        self.assertEqual(ran, [])
+        self.assertEqual(self.simulation.getDelayedCalls(), [])
+
+    def test_resetEarlier(self):
+        """
+        A call reset to run earlier runs at its new time, not when the
+        platform timer was armed for its old one.
+        """
+        ran = []
+        call = self.simulation.callLater(10, ran.append, 1)
+        call.reset(1)
+        self.platform.advance(1.5)
+        self.assertEqual(ran, [1])
+
+    def test_delayLater(self):
+        """
+        A delayed call runs at its new time, and the platform timer is
+        still armed for it.
+        """
+        ran = []
+        call = self.simulation.callLater(1, ran.append, 1)
+        call.delay(4)
+        self.platform.advance(2)
+        self.assertEqual(ran, [])
+        self.platform.advance(3.5)
+        self.assertEqual(ran, [1])
+
+    def test_stoppedKeepsCalls(self):
+        """
+        Calls pending when the simulation is stopped run once it is
+        started again.
+        """
+        ran = []
+        self.simulation.callLater(1, ran.append, 1)
+        self.simulation.stop()
+        self.platform.advance(5)
+        self.assertEqual(ran, [])
+        self.simulation.start()
+        self.platform.advance(1.5)
+        self.assertEqual(ran, [1])
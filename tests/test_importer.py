@@ -0,0 +1,144 @@
+import os
+import shutil
+
+from twisted.internet.defer import fail
+from twisted.trial import unittest
+
+from config.database import SimpleDatabaseConfig
+from db.adapters import DatabaseAdapter
+from db.importer import WorldImporter
+from db.repositories import WorldRepository
+from game.tiles import dirtTile, ironTile
+from tests.helpers import makeWorld
+from util.writers import WorldFileWriter
+
+
+class InterruptedRepository(WorldRepository):
+    """
+    A repository which fails every import batch after the first
+    C{batches}, as if the import was killed.
+    """
+
+    def __init__(self, databaseAdapter, batches):
+        WorldRepository.__init__(self, databaseAdapter)
+        self.batches = batches
+
+    def importSections(self, world, encoded, checkpoint=None, bounds=None):
+        if self.batches <= 0:
+            return fail(RuntimeError("Interrupted"))
+        self.batches -= 1
+        return WorldRepository.importSections(
+            self, world, encoded, checkpoint, bounds)
+
+
+class WorldImporterTests(unittest.TestCase):
+    """
+    Tests for resuming interrupted imports with L{WorldImporter}.
+    """
+
+    def setUp(self):
+        self.adapter = DatabaseAdapter(SimpleDatabaseConfig(
+            "sqlite", ":memory:", None, None, None, None))
+        self.adapter.start()
+        self.addCleanup(self.adapter.stop)
+        self.repository = WorldRepository(self.adapter)
+
+        world = makeWorld(columns=3, rows=1)
+        world.name = "Imported"
+        world.spawn = (10, 10)
+        for x in xrange(0, world.width, 3):
+            world.setTileAt((x, 20), ironTile)
+            world.setTileAt((x, 30), dirtTile)
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, "imported.wld")
+        WorldFileWriter(self.path).writeWorld(world)
+
+    def interrupt(self, path):
+        """
+        Imports C{path} until the second batch.
+        """
+        importer = WorldImporter(
+            InterruptedRepository(self.adapter, 1), path, batchColumns=1)
+        return self.assertFailure(importer.run(), RuntimeError)
+
+    def resume(self, path, resumedColumns):
+        """
+        Imports C{path} again, checking how many columns were resumed.
+        """
+        importer = WorldImporter(self.repository, path, batchColumns=1)
+
+        def check(importer):
+            self.assertEqual(importer.resumedColumns, resumedColumns)
+            self.assertEqual(importer.columns, importer.world.width)
+            return self.repository.getImportCheckpoint(importer.world)
+        d = importer.run().addCallback(check)
+        return d.addCallback(self.assertIdentical, None)
+
+    def test_resume(self):
+        """
+        Importing the same file after an interruption carries on from the
+        last batch written.
+        """
+        d = self.interrupt(self.path)
+        d.addCallback(lambda ignored: self.resume(self.path, 200))
+        return d
+
+    def test_modified(self):
+        """
+        A file modified since its import was interrupted, even if its
+        size did not change, is imported from the start.
+        """
+        def touch(ignored):
+            info = os.stat(self.path)
+            os.utime(self.path, (info.st_atime, info.st_mtime + 10))
+        d = self.interrupt(self.path)
+        d.addCallback(touch)
+        d.addCallback(lambda ignored: self.resume(self.path, 0))
+        return d
+
+    def test_otherFile(self):
+        """
+        Another file of the same world is imported from the start.
+        """
+        other = os.path.join(self.directory, "other.wld")
+        shutil.copy2(self.path, other)
+        d = self.interrupt(self.path)
+        d.addCallback(lambda ignored: self.resume(other, 0))
+        return d
+
+    def test_smallerWorld(self):
+        """
+        Importing a smaller world of the same name deletes the stored
+        sections outside of it, even when the import was interrupted and
+        resumed.
+        """
+        smaller = makeWorld(columns=2, rows=1)
+        smaller.name = "Imported"
+        smaller.spawn = (10, 10)
+        smaller.setTileAt((10, 20), ironTile)
+        path = os.path.join(self.directory, "smaller.wld")
+        WorldFileWriter(path).writeWorld(smaller)
+
+        imported = []
+
+        def sections(ignored):
+            d = self.repository.sectionDigests(imported[0], lambda h: True)
+            return d.addCallback(
+                lambda result: [(x, y) for x, y, v, h in result[0]])
+        d = WorldImporter(self.repository, self.path).run()
+        d.addCallback(lambda importer: imported.append(importer.world))
+        d.addCallback(sections)
+        d.addCallback(self.assertEqual, [(0, 0), (1, 0), (2, 0)])
+        d.addCallback(lambda ignored: self.interrupt(path))
+        d.addCallback(lambda ignored: self.resume(path, 200))
+        d.addCallback(sections)
+        return d.addCallback(self.assertEqual, [(0, 0), (1, 0)])
+
+    def test_missingFile(self):
+        """
+        Importing a file which cannot be read fails the L{Deferred}.
+        """
+        importer = WorldImporter(
+            self.repository, os.path.join(self.directory, "missing.wld"))
+        return self.assertFailure(importer.run(), IOError)
@@ -0,0 +1,101 @@
+import os
+
+from twisted.trial import unittest
+
+from db.journal import TileJournal
+from game.tiles import airTile, dirtTile, ironTile
+from tests.helpers import makeWorld, tileAt
+
+
+class TileJournalTests(unittest.TestCase):
+    """
+    Tests for L{TileJournal}.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+
+    def journal(self):
+        journal = TileJournal(self.directory, syncInterval=3600)
+        journal.start()
+        self.addCleanup(journal.stop)
+        return journal
+
+    def writeSegment(self, edits):
+        """
+        Journals C{edits} in a segment of their own, one batch.
+
+        @return: the segment's path
+        """
+        world = makeWorld()
+        journal = self.journal()
+        world.journal = journal
+        for coords, tile in edits:
+            world.setTileAt(coords, tile)
+        journal.stop()
+        return journal._path(journal.segments()[-1])
+
+    def test_replay(self):
+        """
+        Edits journaled by L{World.setTileAt} are applied again by
+        L{TileJournal.replay}, in order.
+        """
+        self.writeSegment([((3, 4), ironTile), ((250, 160), dirtTile),
+                           ((3, 4), dirtTile)])
+        world = makeWorld()
+        self.assertEqual(TileJournal(self.directory).replay(world), 3)
+        self.assertIdentical(tileAt(world, 3, 4), dirtTile)
+        self.assertIdentical(tileAt(world, 250, 160), dirtTile)
+
+    def test_tornBatch(self):
+        """
+        A batch cut short by a crash, and anything after it, is ignored,
+        while the batches before it are replayed.
+        """
+        self.writeSegment([((1, 1), ironTile)])
+        path = self.writeSegment([((2, 2), ironTile)])
+        with open(path, "ab") as f:
+            f.write(TileJournal.BATCH.pack(3, 0))
+            f.write("\0" * (TileJournal.EDIT.size + 5))
+
+        world = makeWorld()
+        self.assertEqual(TileJournal(self.directory).replay(world), 2)
+        self.assertIdentical(tileAt(world, 1, 1), ironTile)
+        self.assertIdentical(tileAt(world, 2, 2), ironTile)
+
+    def test_corruptBatch(self):
+        """
+        A batch whose edits do not match its checksum is not replayed.
+        """
+        self.writeSegment([((1, 1), ironTile)])
+        path = self.writeSegment([((2, 2), ironTile)])
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(last) ^ 0xff))
+
+        world = makeWorld()
+        self.assertEqual(TileJournal(self.directory).replay(world), 1)
+        self.assertIdentical(tileAt(world, 1, 1), ironTile)
+        self.assertIdentical(tileAt(world, 2, 2), airTile)
+
+    def test_checkpoint(self):
+        """
+        Checkpointing a segment deletes the segments before it, and only
+        the edits appended after it was started are replayed.
+        """
+        world = makeWorld()
+        journal = self.journal()
+        world.journal = journal
+        world.setTileAt((1, 1), ironTile)
+        segment = journal.rotate()
+        world.setTileAt((2, 2), ironTile)
+        journal.checkpoint(segment)
+        journal.stop()
+        self.assertEqual(journal.segments(), [segment])
+
+        world = makeWorld()
+        self.assertEqual(TileJournal(self.directory).replay(world), 1)
+        self.assertIdentical(tileAt(world, 1, 1), airTile)
+        self.assertIdentical(tileAt(world, 2, 2), ironTile)
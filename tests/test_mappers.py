@@ -0,0 +1,78 @@
+from twisted.trial import unittest
+
+from db.mappers import TileSectionMapper
+from game.tiles import Tile, TileType, airTile, dirtTile, ironTile, \
+    SECTION_WIDTH, SECTION_HEIGHT
+
+
+def sectionTiles():
+    """
+    Returns the tiles of a section with a few distinct tiles in it.
+    """
+    tiles = [airTile] * (SECTION_WIDTH * SECTION_HEIGHT)
+    for i in xrange(0, len(tiles), 7):
+        tiles[i] = ironTile
+    for i in xrange(3, len(tiles), 11):
+        tiles[i] = dirtTile
+    for i in xrange(5, len(tiles), 101):
+        tiles[i] = Tile(TileType.Air, isLighted=True, frameX=0, frameY=0,
+                        wall=4, liquid=255, isLava=True)
+    return tiles
+
+
+class TileSectionMapperTests(unittest.TestCase):
+    """
+    Tests for L{TileSectionMapper}.
+    """
+
+    def setUp(self):
+        self.mapper = TileSectionMapper()
+
+    def test_roundTrip(self):
+        """
+        Decoding an encoded section gives back the same tiles.
+        """
+        tiles = sectionTiles()
+        blob, digest = self.mapper.encode(tiles)
+        self.assertEqual(self.mapper.decode(blob), tiles)
+
+    def test_roundTripLargePalette(self):
+        """
+        Sections with more than 256 distinct tiles round trip too.
+        """
+        tiles = [Tile(TileType.Dirt, wall=i % 20, liquid=i % 30, active=True)
+                 for i in xrange(SECTION_WIDTH * SECTION_HEIGHT)]
+        blob, digest = self.mapper.encode(tiles)
+        self.assertEqual(self.mapper.decode(blob), tiles)
+
+    def test_unallocated(self):
+        """
+        A section which was never allocated decodes to C{None}.
+        """
+        blob, digest = self.mapper.encode(None)
+        self.assertIdentical(self.mapper.decode(blob), None)
+
+    def test_rebuiltTilesEncodeTheSame(self):
+        """
+        A section encodes to the same bytes once its tiles are rebuilt as
+        new objects, as they are in another process, so its hash can tell
+        whether its content changed since it was stored.
+        """
+        tiles = sectionTiles()
+        encoded = self.mapper.encode(tiles)
+
+        interned = Tile._interned
+        self.addCleanup(setattr, Tile, '_interned', interned)
+        Tile._interned = {}
+        rebuilt = [Tile(*tile.sortKey()) for tile in reversed(tiles)]
+        rebuilt.reverse()
+        self.assertNotIdentical(rebuilt[0], tiles[0])
+        self.assertEqual(self.mapper.encode(rebuilt), encoded)
+
+    def test_unknownFormat(self):
+        """
+        Decoding a BLOB of another format fails.
+        """
+        import zlib
+        blob = zlib.compress(TileSectionMapper.HEADER.pack(99, 0))
+        self.assertRaises(ValueError, self.mapper.decode, blob)
@@ -0,0 +1,137 @@
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest
+
+from config.database import SimpleDatabaseConfig
+from db.adapters import DatabaseAdapter
+from db.repositories import CachingWorldRepository, WorldRepository
+from tests.helpers import makeWorld
+
+
+class CachingWorldRepositoryTests(unittest.TestCase):
+    """
+    Tests for L{CachingWorldRepository}.
+    """
+
+    def setUp(self):
+        self.adapter = DatabaseAdapter(SimpleDatabaseConfig(
+            "sqlite", ":memory:", None, None, None, None))
+        self.adapter.start()
+        self.addCleanup(self.adapter.stop)
+        self.repository = CachingWorldRepository(self.adapter, cacheSize=2)
+
+    def saveWorld(self, name, spawn=(10, 10)):
+        world = makeWorld(columns=1, rows=1)
+        world.name = name
+        world.spawn = spawn
+        return self.repository.saveWorld(world)
+
+    def test_cached(self):
+        """
+        A world looked up once is found again by id or name without
+        querying the database.
+        """
+        d = self.saveWorld("Cached")
+        d.addCallback(lambda world: self.repository.getWorldHeader(
+            name="Cached"))
+
+        def lookUpAgain(header):
+            self.assertEqual(self.repository.headers.misses, 1)
+            d = self.repository.getWorldHeader(header.worldId)
+            d.addCallback(self.assertIdentical, header)
+            d.addCallback(lambda ignored: self.repository.getWorldHeader(
+                name="Cached"))
+            d.addCallback(self.assertIdentical, header)
+            return d
+
+        def check(ignored):
+            self.assertEqual(self.repository.headers.misses, 1)
+            self.assertEqual(self.repository.headers.hits, 2)
+        d.addCallback(lookUpAgain)
+        return d.addCallback(check)
+
+    def test_savedWorldInvalidated(self):
+        """
+        Saving a world drops its cached header, so the next lookup reads
+        what was saved.
+        """
+        d = self.saveWorld("Saved")
+        d.addCallback(lambda world: self.repository.getWorldHeader(
+            name="Saved"))
+
+        def save(header):
+            self.assertEqual(header.spawn, (10, 10))
+            world = makeWorld(columns=1, rows=1)
+            world.worldId = header.worldId
+            world.name = "Saved"
+            world.spawn = (20, 30)
+            return self.repository.saveWorld(world)
+
+        def check(header):
+            self.assertEqual(header.spawn, (20, 30))
+            self.assertEqual(self.repository.headers.misses, 2)
+        d.addCallback(save)
+        d.addCallback(lambda world: self.repository.getWorldHeader(
+            name="Saved"))
+        return d.addCallback(check)
+
+    def test_otherName(self):
+        """
+        A cached header is not returned for a lookup by its id but under
+        another name, which the database would not find.
+        """
+        d = self.saveWorld("Named")
+        d.addCallback(lambda world: self.repository.getWorldHeader(
+            name="Named"))
+        d.addCallback(lambda header: self.repository.getWorldHeader(
+            header.worldId, "Other"))
+        return d.addCallback(self.assertIdentical, None)
+
+    def test_evicted(self):
+        """
+        A header dropped to make room is no longer found by its name.
+        """
+        d = self.saveWorld("First")
+        for name in ("Second", "Third"):
+            d.addCallback(lambda ignored, name=name: self.saveWorld(name))
+        for name in ("First", "Second", "Third"):
+            d.addCallback(
+                lambda ignored, name=name: self.repository.getWorldHeader(
+                    name=name))
+
+        def check(ignored):
+            self.assertEqual(self.repository.headers.evictions, 1)
+            self.assertNotIn("First", self.repository._ids)
+            return self.repository.getWorldHeader(name="First")
+        d.addCallback(check)
+        d.addCallback(lambda header: self.assertEqual(header.name, "First"))
+        return d
+
+    def test_invalidatedWhileLookingUp(self):
+        """
+        A lookup which started before the world was invalidated returns
+        what it read but does not cache it, as a save may have changed it
+        meanwhile.
+        """
+        lookups = []
+
+        def getWorldHeader(repository, worldId=0, name=""):
+            lookups.append(Deferred())
+            return lookups[-1]
+        self.patch(WorldRepository, "getWorldHeader", getWorldHeader)
+
+        d = self.saveWorld("Racing")
+
+        def lookUp(world):
+            results = []
+            self.repository.getWorldHeader(name="Racing").addCallback(
+                results.append)
+            self.repository.invalidate(world.worldId, "Racing")
+            self.repository.getWorldHeader(world.worldId, "Racing")
+            lookups[0].callback(world)
+            self.assertEqual(results, [world])
+            self.assertEqual(len(self.repository.headers), 0)
+
+            # a lookup which started after the invalidation is cached
+            lookups[1].callback(world)
+            self.assertEqual(len(self.repository.headers), 1)
+        return d.addCallback(lookUp)
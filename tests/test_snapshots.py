@@ -0,0 +1,86 @@
+from twisted.trial import unittest
+
+from game.tiles import airTile, dirtTile, ironTile
+from tests.helpers import makeWorld, setTile
+
+
+class WorldSnapshotTests(unittest.TestCase):
+    """
+    Tests for L{WorldSnapshot} and the copy on write of the
+    L{TileSection}s it views.
+    """
+
+    def setUp(self):
+        self.world = makeWorld()
+        self.world.name = "Before"
+        setTile(self.world, 1, 1, ironTile)
+        self.section = self.world.getSectionAt((1, 1))
+
+    def test_isolatedFromSetTile(self):
+        """
+        Tiles set after a snapshot was taken do not show in it, while the
+        world sees them.
+        """
+        snapshot = self.world.snapshot()
+        self.addCleanup(snapshot.release)
+        setTile(self.world, 1, 1, dirtTile)
+        setTile(self.world, 2, 2, dirtTile)
+
+        view = snapshot.getSectionAt((1, 1))
+        self.assertIdentical(view.getTileAt((1, 1)), ironTile)
+        self.assertIdentical(view.getTileAt((2, 2)), airTile)
+        self.assertEqual(view.version, 1)
+        self.assertIdentical(self.section.tiles[201], dirtTile)
+        self.assertFalse(view.isShared())
+
+    def test_unallocatedSection(self):
+        """
+        A section allocated after the snapshot is still unallocated in
+        it.
+        """
+        snapshot = self.world.snapshot()
+        self.addCleanup(snapshot.release)
+        setTile(self.world, 300, 1, ironTile)
+        view = snapshot.getSectionAt((300, 1))
+        self.assertFalse(view.allocated)
+        self.assertIdentical(view.getTileAt((100, 1)), None)
+
+    def test_header(self):
+        """
+        The snapshot keeps the world's header fields as they were.
+        """
+        snapshot = self.world.snapshot()
+        self.addCleanup(snapshot.release)
+        self.world.name = "After"
+        self.assertEqual(snapshot.name, "Before")
+
+    def test_overlappingSnapshots(self):
+        """
+        Each of several snapshots sees the tiles as they were when it was
+        taken, whichever is released first.
+        """
+        first = self.world.snapshot()
+        setTile(self.world, 1, 1, dirtTile)
+        second = self.world.snapshot()
+        setTile(self.world, 1, 1, airTile)
+        first.release()
+        setTile(self.world, 1, 1, ironTile)
+
+        self.assertIdentical(
+            second.getSectionAt((1, 1)).getTileAt((1, 1)), dirtTile)
+        second.release()
+        self.assertEqual(self.world.snapshots, set())
+
+    def test_writesInPlaceOnceReleased(self):
+        """
+        Once every snapshot sharing a section's tiles is released, the
+        section writes to them in place again.
+        """
+        snapshot = self.world.snapshot()
+        snapshot.acquire()
+        snapshot.release()
+        tiles = self.section.tiles
+        snapshot.release()
+        setTile(self.world, 1, 1, dirtTile)
+        self.assertIdentical(self.section.tiles, tiles)
+        self.assertRaises(ValueError, snapshot.acquire)
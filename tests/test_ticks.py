@@ -0,0 +1,91 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from game import ticks
+from game.environment import SimulationTime
+from game.ticks import TickEngine, INPUT, REPLICATION, PERSISTENCE
+
+# Frames per second, a power of two so frame times are exact
+GRANULARITY = 8
+FRAME = 1.0 / GRANULARITY
+
+
+class TickEngineTests(unittest.TestCase):
+    """
+    Tests for L{TickEngine}.
+    """
+
+    def setUp(self):
+        self.platform = Clock()
+        self.simulation = SimulationTime(GRANULARITY, self.platform)
+        self.simulation.start()
+        self.engine = TickEngine(self.simulation, self.platform)
+        self.ran = {}
+        for phase in (INPUT, REPLICATION, PERSISTENCE):
+            self.ran[phase] = []
+            self.engine.addTask(phase, self.ran[phase].append)
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+
+    def test_frames(self):
+        """
+        Every phase runs once a frame while the reactor keeps up.
+        """
+        for i in xrange(3):
+            self.platform.advance(FRAME)
+        for phase in (INPUT, REPLICATION, PERSISTENCE):
+            self.assertEqual(self.ran[phase], [1, 2, 3])
+
+    def test_catchUp(self):
+        """
+        Frames missed while the reactor was busy are run back to back.
+        Non-essential phases only run on the last of them, unless they
+        were already skipped C{maxSkipped} frames in a row.
+        """
+        self.platform.advance(5 * FRAME)
+        self.assertEqual(self.ran[INPUT], [1, 2, 3, 4, 5])
+        self.assertEqual(self.ran[REPLICATION], [3, 5])
+        self.assertEqual(self.ran[PERSISTENCE], [5])
+        self.assertEqual(self.engine.getPhase(PERSISTENCE).skipped, 4)
+
+    def test_dropped(self):
+        """
+        Frames beyond C{maxCatchUp} are dropped.
+        """
+        self.platform.advance(12 * FRAME)
+        self.assertEqual(self.ran[INPUT], range(8, 13))
+        self.assertEqual(self.engine.droppedFrames, 7)
+
+    def test_overBudget(self):
+        """
+        Non-essential phases are skipped when the frame is over budget,
+        but never for more than C{maxSkipped} frames in a row.
+        """
+        now = [0.0]
+        self.patch(ticks, "monotonic", lambda: now[0])
+
+        def slow(frame):
+            now[0] += self.engine.budget * 2
+        self.engine.addTask(INPUT, slow)
+        for i in xrange(4):
+            self.platform.advance(FRAME)
+        self.assertEqual(self.ran[REPLICATION], [3])
+        self.assertEqual(self.ran[PERSISTENCE], [])
+        self.assertEqual(self.engine.overBudgetFrames, 4)
+
+    def test_raisingSimulationCall(self):
+        """
+        A simulation call which raises is logged, the calls due after it
+        still run on the same frame, and the engine keeps running.
+        """
+        def boom():
+            raise ZeroDivisionError()
+        ran = []
+        self.simulation.callLater(FRAME, boom)
+        self.simulation.callLater(FRAME, ran.append, 1)
+        self.platform.advance(FRAME)
+        self.assertEqual(ran, [1])
+        self.simulation.callLater(FRAME, ran.append, 2)
+        self.platform.advance(FRAME)
+        self.assertEqual(ran, [1, 2])
+        self.assertEqual(self.ran[INPUT], [1, 2])
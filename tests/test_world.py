@@ -0,0 +1,42 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from game.world import World
+
+
+class DayNightCycleTests(unittest.TestCase):
+    """
+    Tests for the day/night cycle of a L{World}.
+    """
+
+    def setUp(self):
+        self.platform = Clock()
+        # days of two seconds and nights of one
+        self.world = World(granularity=4, platformClock=self.platform,
+                           nightLength=4, dayLength=8)
+        self.transitions = []
+        self.world.cycleObservers.append(
+            lambda world: self.transitions.append(world.isDay))
+        self.world.start()
+        self.addCleanup(self.world.stop)
+
+    def test_transitions(self):
+        """
+        Observers are told of each dusk and dawn.
+        """
+        self.platform.advance(2)
+        self.assertEqual(self.transitions, [False])
+        self.platform.advance(1)
+        self.assertEqual(self.transitions, [False, True])
+
+    def test_raisingObserver(self):
+        """
+        An observer which raises neither keeps the others from being told
+        nor stops the cycle.
+        """
+        def boom(world):
+            raise ZeroDivisionError()
+        self.world.cycleObservers.insert(0, boom)
+        for i in xrange(12):
+            self.platform.advance(0.5)
+        self.assertEqual(self.transitions, [False, True, False, True])
@@ -0,0 +1,174 @@
+import os
+
+from twisted.trial import unittest
+
+from config.database import SimpleDatabaseConfig
+from db.adapters import DatabaseAdapter
+from db.importer import WorldImporter
+from db.repositories import WorldRepository
+from game.tiles import Tile, airTile, dirtTile, ironTile, \
+    SECTION_WIDTH, SECTION_HEIGHT
+from tests.helpers import makeWorld, tileAt
+from util.readers import WorldFileReader
+from util.writers import WorldFileWriter
+
+
+def writableWorld(columns, rows):
+    """
+    Returns a world of C{columns} by C{rows} unallocated air sections,
+    with what a world file needs besides its tiles.
+    """
+    world = makeWorld(columns, rows)
+    world.name = "Written"
+    world.spawn = (10, 20)
+    return world
+
+
+class WorldFileWriterTests(unittest.TestCase):
+    """
+    Tests for writing worlds with L{WorldFileWriter} and reading them
+    back with L{WorldFileReader}.
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, "written.wld")
+
+    def roundTrip(self, world):
+        """
+        Writes C{world} and reads it back.
+
+        @return: the world read and its columns of tiles
+        """
+        WorldFileWriter(self.path).writeWorld(world)
+        reader = WorldFileReader(self.path)
+        read = reader.readHeader()
+        try:
+            columns = reader.tileReader(read).readColumns(read.width)
+        finally:
+            reader.close()
+        return read, columns
+
+    def assertTiles(self, world, columns):
+        self.assertEqual(len(columns), world.width)
+        for x, column in enumerate(columns):
+            self.assertEqual(len(column), world.height)
+            for y, tile in enumerate(column):
+                if tile is not tileAt(world, x, y):
+                    self.fail("(%d, %d) is %r instead of %r" % (
+                        x, y, tile, tileAt(world, x, y)))
+
+    def test_roundTrip(self):
+        """
+        A world written is read back with the same header and tiles,
+        whatever they hold.
+        """
+        world = writableWorld(columns=2, rows=2)
+        tree = Tile(5, frameX=22, frameY=66, wall=2, liquid=0,
+                    isLighted=True, active=True)
+        lava = Tile(-1, frameX=0, frameY=0, wall=0, liquid=255,
+                    isLava=True, isLighted=True)
+        for x in xrange(0, world.width, 7):
+            world.setTileAt((x, 10), ironTile)
+            world.setTileAt((x, 11), dirtTile)
+            world.setTileAt((x, 200), tree)
+            world.setTileAt((x, 201), lava)
+        read, columns = self.roundTrip(world)
+        self.assertEqual(
+            (read.name, read.spawn, read.width, read.height),
+            ("Written", (10, 20), world.width, world.height))
+        self.assertTiles(world, columns)
+
+    def test_partialSections(self):
+        """
+        A world whose size is not a whole number of sections is written
+        without the tiles of its sections past its edges.
+        """
+        world = writableWorld(columns=2, rows=2)
+        world.setTileAt((SECTION_WIDTH + 10, SECTION_HEIGHT + 5), ironTile)
+        world.width = SECTION_WIDTH + 50
+        world.height = SECTION_HEIGHT + 20
+        read, columns = self.roundTrip(world)
+        self.assertTiles(world, columns)
+        self.assertIdentical(
+            columns[SECTION_WIDTH + 10][SECTION_HEIGHT + 5], ironTile)
+
+    def test_unallocated(self):
+        """
+        Sections which were never allocated, or are missing, are written
+        as air.
+        """
+        world = writableWorld(columns=2, rows=2)
+        world.setTileAt((5, 5), ironTile)
+        world.tileSections[1][1] = None
+        read, columns = self.roundTrip(world)
+        self.assertIdentical(columns[5][5], ironTile)
+        for x in (0, SECTION_WIDTH + 1, world.width - 1):
+            self.assertEqual(
+                set(columns[x]) - set([ironTile]), set([airTile]))
+
+    def test_longRuns(self):
+        """
+        A run of tiles longer than a record can stand for is split over
+        several records.
+        """
+        rows = -(-(WorldFileWriter.MAX_COPIES * 2 + 10) // SECTION_HEIGHT)
+        world = writableWorld(columns=1, rows=rows)
+        world.width = 2
+        world.setTileAt((0, world.height - 1), ironTile)
+        read, columns = self.roundTrip(world)
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(columns[0], [airTile] * (world.height - 1) +
+                         [ironTile])
+        self.assertEqual(columns[1], [airTile] * world.height)
+
+
+class StreamedExportTests(unittest.TestCase):
+    """
+    Tests for writing worlds with L{WorldFileWriter} from section columns
+    read from the database.
+    """
+
+    def setUp(self):
+        self.adapter = DatabaseAdapter(SimpleDatabaseConfig(
+            "sqlite", ":memory:", None, None, None, None))
+        self.adapter.start()
+        self.addCleanup(self.adapter.stop)
+        self.repository = WorldRepository(self.adapter)
+
+        world = writableWorld(columns=3, rows=1)
+        for x in xrange(0, world.width, 3):
+            world.setTileAt((x, 20), ironTile)
+            world.setTileAt((x, 30), dirtTile)
+        self.directory = self.mktemp()
+        os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, "imported.wld")
+        WorldFileWriter(self.path).writeWorld(world)
+
+    def test_exportStreamed(self):
+        """
+        A world exported a section column at a time from the database is
+        written as it is from the world with all of its sections loaded.
+        """
+        streamed = os.path.join(self.directory, "streamed.wld")
+        loaded = os.path.join(self.directory, "loaded.wld")
+        importer = WorldImporter(self.repository, self.path)
+
+        def imported(importer):
+            world = importer.world
+            writer = WorldFileWriter(streamed)
+            d = self.repository.readSectionColumns(
+                world, lambda columns: writer.writeWorld(world, columns))
+            d.addCallback(lambda size: self.repository.loadSections(world))
+            return d
+
+        def check(world):
+            WorldFileWriter(loaded).writeWorld(world)
+            with open(loaded, "rb") as f:
+                expected = f.read()
+            with open(streamed, "rb") as f:
+                self.assertEqual(f.read(), expected)
+        d = importer.run()
+        d.addCallback(imported)
+        return d.addCallback(check)
@@ -0,0 +1,27 @@
+"""
+Tracks what the reactor thread is doing right now, so diagnostics which
+run on other threads (the stall watchdog, the sampling profiler) can
+say what was being handled when they looked.
+
+Labels are plain strings held in a module global; setting one is a
+single assignment, cheap enough for every message.
+"""
+
+current = None
+
+
+def enter(label):
+    """
+    Marks the start of C{label}. Returns the previous label, which
+    should be handed to L{leave} when done.
+    """
+
+    global current
+    previous = current
+    current = label
+    return previous
+
+
+def leave(previous):
+    global current
+    current = previous
@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A mapping of at most C{maxSize} entries, which drops the least
+    recently used entry to make room for a new one. May be used from any
+    thread.
+
+    @ivar hits: Lookups which found their entry.
+    @ivar misses: Lookups which did not.
+    @ivar evictions: Entries dropped to make room.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns the entry for C{key}, making it the most recently used, or
+        C{default} if there is none.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Adds or replaces the entry for C{key}.
+
+        @return: the C{(key, value)} entries dropped to make room
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            evicted = []
+            while len(self._entries) > self.maxSize:
+                evicted.append(self._entries.popitem(last=False))
+            self.evictions += len(evicted)
+            return evicted
+
+    def pop(self, key, default=None):
+        """
+        Removes the entry for C{key}, without counting a hit or miss.
+
+        @return: the entry, or C{default} if there was none
+        """
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
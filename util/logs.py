@@ -0,0 +1,120 @@
+import Queue
+import logging
+import sys
+import threading
+
+from util.timer import monotonic
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how often records with the same format string are let
+    through, so high frequency events (e.g. a debug line per player
+    update) cannot flood the log.
+
+    Each (logger, format string) pair gets a token bucket which refills
+    at C{rate} records a second up to C{burst}. Records which find the
+    bucket empty are dropped and counted; the next record let through
+    for that key says how many were suppressed.
+    """
+
+    def __init__(self, rate=10.0, burst=50):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.burst = burst
+        self._buckets = {}
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+
+        key = (record.name, record.msg)
+        now = monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return False
+
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class QueuedStreamHandler(logging.Handler):
+    """
+    A stream handler which hands records to a background thread for
+    formatting and writing, so logging never blocks the caller on I/O.
+
+    Arguments are formatted on the background thread, so they should
+    not be mutated after being logged. When the queue is full, records
+    are dropped rather than waited on, and the number dropped is
+    reported once there is room again. A L{RateLimitFilter} is applied
+    before queueing.
+
+    Usable from logging.cfg, e.g.::
+
+        class=util.logs.QueuedStreamHandler
+        args=(sys.stdout, 10, 50)
+    """
+
+    def __init__(self, stream=None, rate=10.0, burst=50, maxQueued=10000):
+        logging.Handler.__init__(self)
+        if stream is None:
+            stream = sys.stderr
+        self.stream = stream
+        self.dropped = 0
+        self._queue = Queue.Queue(maxQueued)
+        self.addFilter(RateLimitFilter(rate, burst))
+        self._thread = threading.Thread(
+            target=self._run, name="QueuedStreamHandler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                self.stream.flush()
+                return
+            self._write(record)
+            # only flush once the queue has been drained
+            if self._queue.empty():
+                self.stream.flush()
+
+    def _write(self, record):
+        try:
+            message = self.format(record)
+            suppressed = getattr(record, 'suppressed', 0)
+            if suppressed:
+                message = "%s (%d similar suppressed)" % (message, suppressed)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.stream.write(
+                    "%d log records dropped, queue full\n" % (dropped,))
+            self.stream.write("%s\n" % (message,))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """
+        Writes out everything still queued before closing.
+        """
+
+        if self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join(5)
+        logging.Handler.close(self)
@@ -0,0 +1,222 @@
+from bisect import bisect_left
+
+# Upper bounds (in seconds) of the default latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket bounds. Observing a value only
+    increments counters, so it is cheap enough for hot paths.
+
+    @ivar bounds: Sorted upper bounds of each bucket. Values above the
+        last bound land in an extra overflow bucket.
+    @ivar counts: Number of values observed in each bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction
+        of observations, or the largest value seen for the overflow bucket.
+        """
+
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max
+
+    def summary(self):
+        return "n=%d mean=%.2fms p50=%.2fms p99=%.2fms max=%.2fms" % (
+            self.count, self.mean() * 1000, self.percentile(0.5) * 1000,
+            self.percentile(0.99) * 1000, self.max * 1000)
+
+
+class MessageStats(object):
+    """
+    Counters and latency histograms for one message class.
+    """
+
+    __slots__ = (
+        'name', 'received', 'sent', 'bytesIn', 'bytesOut', 'parse',
+        'handle', 'serialize')
+
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.sent = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.parse = Histogram()
+        self.handle = Histogram()
+        self.serialize = Histogram()
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.iteritems()))
+
+
+def _histogramLines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        bucketLabels = dict(labels, le=_formatValue(bound))
+        lines.append("%s_bucket%s %d" % (
+            name, _formatLabels(bucketLabels), cumulative))
+    lines.append("%s_bucket%s %d" % (
+        name, _formatLabels(dict(labels, le="+Inf")), histogram.count))
+    lines.append("%s_sum%s %r" % (name, _formatLabels(labels), histogram.total))
+    lines.append("%s_count%s %d" % (
+        name, _formatLabels(labels), histogram.count))
+    return lines
+
+
+class MetricsRegistry(object):
+    """
+    Collects the server's metrics and renders them in the Prometheus
+    text exposition format.
+
+    Per-message statistics are kept in one L{MessageStats} per message
+    class, created the first time the class is seen, so recording a
+    message only bumps counters. Other subsystems register their
+    histograms and gauges once with L{addHistogram} and L{addGauge}.
+    """
+
+    def __init__(self):
+        self.messages = {}
+        self._histograms = []
+        self._gauges = []
+
+    def messageStats(self, messageClass):
+        try:
+            return self.messages[messageClass]
+        except KeyError:
+            stats = self.messages[messageClass] = MessageStats(
+                messageClass.__name__)
+            return stats
+
+    def addHistogram(self, name, description, histogram, **labels):
+        self._histograms.append((name, description, labels, histogram))
+
+    def addGauge(self, name, description, func, kind="gauge", **labels):
+        """
+        Registers C{func()} to be read whenever metrics are rendered.
+
+        @param kind: The Prometheus metric type, C{"gauge"} or
+            C{"counter"}.
+        """
+
+        self._gauges.append((name, description, kind, labels, func))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+
+        lines = []
+        stats = sorted(self.messages.values(), key=lambda s: s.name)
+        for field, name, description in (
+                ('received', 'terraria_messages_received_total',
+                 'Messages received'),
+                ('sent', 'terraria_messages_sent_total', 'Messages sent'),
+                ('bytesIn', 'terraria_message_bytes_received_total',
+                 'Bytes received, including headers'),
+                ('bytesOut', 'terraria_message_bytes_sent_total',
+                 'Bytes sent, including headers')):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s counter" % (name,))
+            for s in stats:
+                lines.append("%s%s %d" % (
+                    name, _formatLabels({'type': s.name}), getattr(s, field)))
+
+        for field, name, description in (
+                ('parse', 'terraria_message_parse_seconds',
+                 'Time spent parsing messages'),
+                ('handle', 'terraria_message_handle_seconds',
+                 'Time from dispatch until the handler finished'),
+                ('serialize', 'terraria_message_serialize_seconds',
+                 'Time spent serializing messages')):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s histogram" % (name,))
+            for s in stats:
+                lines.extend(_histogramLines(
+                    name, {'type': s.name}, getattr(s, field)))
+
+        # samples of one metric have to be contiguous
+        described = set()
+        for name, description, labels, histogram in sorted(
+                self._histograms, key=lambda h: h[0]):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s histogram" % (name,))
+            lines.extend(_histogramLines(name, labels, histogram))
+
+        for name, description, kind, labels, func in sorted(
+                self._gauges, key=lambda g: g[0]):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s%s %s" % (
+                name, _formatLabels(labels), _formatValue(func())))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns short human readable lines, one per message class seen.
+        """
+
+        lines = []
+        for s in sorted(self.messages.values(), key=lambda s: s.name):
+            lines.append(
+                "%s: in=%d (%dB) out=%d (%dB) parse %.3fms handle %.3fms "
+                "serialize %.3fms" % (
+                    s.name, s.received, s.bytesIn, s.sent, s.bytesOut,
+                    s.parse.mean() * 1000, s.handle.mean() * 1000,
+                    s.serialize.mean() * 1000))
+        return lines
+
+
+# The process wide registry
+registry = MetricsRegistry()
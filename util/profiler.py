@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+
+from util import activity
+
+# Root frame used for samples taken while no activity label is set
+IDLE_LABEL = "reactor"
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler which samples the stack of one thread.
+
+    A daemon thread wakes C{rate} times a second, grabs the target
+    thread's current frame from C{sys._current_frames} and counts the
+    stack, keyed by function. The current L{util.activity} label is
+    added as the root frame, so samples group by the message type or
+    tick phase being handled. The counts can be written out in the
+    collapsed stack format read by flame graph tools.
+
+    @ivar samples: Number of samples taken.
+    @ivar stacks: Maps stack tuples (root first) to sample counts.
+    """
+
+    def __init__(self, threadId, rate=200):
+        self.threadId = threadId
+        self.rate = rate
+        self.samples = 0
+        self.stacks = {}
+        self._codeNames = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def isRunning(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="SamplingProfiler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        while not self._stopped.isSet():
+            self._sample()
+            self._stopped.wait(interval)
+
+    def _codeName(self, code):
+        name = self._codeNames.get(code)
+        if name is None:
+            name = "%s (%s:%d)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno)
+            self._codeNames[code] = name
+        return name
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.threadId)
+        if frame is None:
+            return
+
+        stack = []
+        while frame is not None:
+            stack.append(self._codeName(frame.f_code))
+            frame = frame.f_back
+        stack.append("[%s]" % (activity.current or IDLE_LABEL))
+        stack.reverse()
+        stack = tuple(stack)
+
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def topFunctions(self, limit=20):
+        """
+        Returns (function, self samples) pairs for the functions most
+        often found at the top of the stack.
+        """
+
+        counts = {}
+        for stack, count in self.stacks.iteritems():
+            counts[stack[-1]] = counts.get(stack[-1], 0) + count
+        top = sorted(counts.iteritems(), key=lambda item: -item[1])
+        return top[:limit]
+
+    def writeCollapsed(self, path):
+        """
+        Writes one C{frame;frame;frame count} line per distinct stack.
+        """
+
+        out = open(path, 'w')
+        try:
+            for stack, count in sorted(self.stacks.iteritems()):
+                out.write("%s %d\n" % (";".join(stack), count))
+        finally:
+            out.close()
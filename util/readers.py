@@ -1,5 +1,6 @@
-from struct import calcsize, unpack
+from struct import Struct, calcsize, error as StructError, unpack
 
+from game.tiles import IMPORTANT_TILES, Tile, TileType
 from game.world import World
 
 byteOrder = "<"
@@ -12,6 +13,9 @@ doubleFormatLen = calcsize(doubleFormat)
 boolFormat = byteOrder + "?"
 boolFormatLen = calcsize(boolFormat)
 
+# Newest world file format the readers know
+MAX_WORLD_VERSION = 39
+
 
 class TerrariaFileReader(object):
     """
@@ -39,6 +43,21 @@ class TerrariaFileReader(object):
     def readBoolean(self):
         return self._read(boolFormat, boolFormatLen)
 
+    def readString(self):
+        """
+        Reads a string prefixed with its length in 7 bit groups, as .NET
+        writes them.
+        """
+        length = 0
+        shift = 0
+        while True:
+            byte = self.readUChar()
+            length |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        return self.fileHandle.read(length)
+
 
 class WorldFileReader(TerrariaFileReader):
     """
@@ -49,11 +68,23 @@ class WorldFileReader(TerrariaFileReader):
         self.worldFilePath = worldFilePath
 
     def readWorld(self):
+        w = self.readHeader()
+        self.close()
+        return w
+
+    def readHeader(self):
+        """
+        Reads the world's header, leaving the file open at the first tile
+        column for L{tileReader}.
+        """
         w = World()
         self.fileHandle = open(self.worldFilePath, 'rb')
         w.version = self.readInt32()
-        worldNameLen = self.readUChar()
-        w.name = self.fileHandle.read(worldNameLen)
+        if w.version > MAX_WORLD_VERSION:
+            self.close()
+            raise ValueError("Unsupported world file version %d" % (
+                w.version,))
+        w.name = self.readString()
         w.worldId = self.readInt32()
         w.leftWorld = self.readInt32()
         w.rightWorld = self.readInt32()
@@ -75,12 +106,237 @@ class WorldFileReader(TerrariaFileReader):
         w.bossOneDowned = self.readBoolean()
         w.bossTwoDowned = self.readBoolean()
         w.bossThreeDowned = self.readBoolean()
+        # saved NPCs, later bosses and hard mode are not modelled by the
+        # server, so they are skipped
+        if w.version >= 29:
+            self.readBoolean()  # saved goblin
+            self.readBoolean()  # saved wizard
+            if w.version >= 34:
+                self.readBoolean()  # saved mechanic
+            self.readBoolean()  # goblins downed
+        if w.version >= 32:
+            self.readBoolean()  # clown downed
+        if w.version >= 37:
+            self.readBoolean()  # frost legion downed
         w.shadowOrbSmashed = self.readBoolean()
         w.spawnMeteor = self.readBoolean()
         w.shadowOrbCount = self.readUChar()
+        if w.version >= 23:
+            self.readInt32()  # altars smashed
+            self.readBoolean()  # hard mode
         w.invasionDelay = self.readInt32()
         w.invasionSize = self.readInt32()
         w.invasionType = self.readInt32()
         w.invasionX = self.readDouble()
-        self.fileHandle.close()
         return w
+
+    def tileReader(self, world):
+        """
+        Returns a L{TileColumnReader} for the tiles following the header
+        L{readHeader} returned as C{world}.
+        """
+        return TileColumnReader(self.fileHandle, world.version, world.height)
+
+    def close(self):
+        self.fileHandle.close()
+
+
+class TileColumnReader(object):
+    """
+    Streams the tiles of a world file, one column of C{height} tiles at a
+    time, left to right. Each column is a run of records::
+
+        bool: active
+            byte: tile type, if active
+                int16, int16: frame x and y, if the type is important
+        bool: lighted, up to version 25 only
+        bool: has a wall
+            byte: wall, if it has one
+        bool: has liquid
+            byte, bool: liquid and lava, if it has some
+        bool: wire, from version 33 (ignored, the server has no wiring)
+        int16: number of following tiles which are the same, from version
+            25
+
+    The file is read in L{BUFFER_SIZE} chunks, and a record's tile is
+    looked up by the record's bytes, so a tile is only built the first
+    time its record is seen.
+
+    @ivar column: The index of the next column to be read.
+    """
+
+    BUFFER_SIZE = 1 << 20
+    # the longest record, with its repeat count
+    MAX_RECORD = 15
+    COPIES = Struct("<h")
+    FRAMES = Struct("<hh")
+
+    def __init__(self, fileHandle, version, height):
+        self.fileHandle = fileHandle
+        self.height = height
+        self.column = 0
+        self.hasLighted = version <= 25
+        self.hasWire = version >= 33
+        self.hasCopies = version >= 25
+        self._important = [False] * 256
+        for tileType in IMPORTANT_TILES:
+            self._important[tileType] = True
+        self._tiles = {}
+        self._buffer = ""
+        self._pos = 0
+        # file offset of the start of the buffer
+        self._bufferOffset = fileHandle.tell()
+        self._captured = None
+        self._captureStart = 0
+
+    def tell(self):
+        """
+        Returns the file offset of the next column, to L{seek} back to it
+        later.
+        """
+        return self._bufferOffset + self._pos
+
+    def seek(self, column, offset):
+        """
+        Continues reading at C{column}, which starts at file offset
+        C{offset} as returned by L{tell}.
+        """
+        self.fileHandle.seek(offset)
+        self.column = column
+        self._buffer = ""
+        self._pos = 0
+        self._bufferOffset = offset
+
+    def readColumns(self, count):
+        """
+        Reads C{count} columns.
+
+        @return: a list of columns, each a list of C{height} L{Tile}s
+        """
+        return [self._readColumn(True) for i in xrange(count)]
+
+    def readColumnData(self, count):
+        """
+        Skips C{count} columns, without building their tiles.
+
+        @return: the columns' bytes, which a L{TileColumnReader} for the
+            same version and height can read
+        """
+        self._captured = []
+        self._captureStart = self._pos
+        try:
+            for i in xrange(count):
+                self._readColumn(False)
+            self._captured.append(self._buffer[self._captureStart:self._pos])
+            return "".join(self._captured)
+        finally:
+            self._captured = None
+
+    def _fill(self):
+        if self._captured is not None:
+            self._captured.append(self._buffer[self._captureStart:self._pos])
+            self._captureStart = 0
+        self._bufferOffset += self._pos
+        self._buffer = self._buffer[self._pos:] + self.fileHandle.read(
+            self.BUFFER_SIZE)
+        self._pos = 0
+
+    def _readColumn(self, build):
+        height = self.height
+        hasLighted = self.hasLighted
+        hasWire = self.hasWire
+        hasCopies = self.hasCopies
+        important = self._important
+        tiles = self._tiles
+        unpackCopies = self.COPIES.unpack_from
+        column = []
+        filled = 0
+        buf = self._buffer
+        pos = self._pos
+        end = len(buf)
+        try:
+            while filled < height:
+                if end - pos < self.MAX_RECORD:
+                    self._pos = pos
+                    self._fill()
+                    buf = self._buffer
+                    pos = 0
+                    end = len(buf)
+                start = pos
+                if buf[pos] != "\0":
+                    if important[ord(buf[pos + 1])]:
+                        pos += 6
+                    else:
+                        pos += 2
+                else:
+                    pos += 1
+                if hasLighted:
+                    pos += 1
+                pos += 2 if buf[pos] != "\0" else 1
+                pos += 3 if buf[pos] != "\0" else 1
+                if hasWire:
+                    pos += 1
+                record = buf[start:pos]
+                if hasCopies:
+                    copies = unpackCopies(buf, pos)[0] + 1
+                    pos += 2
+                else:
+                    copies = 1
+                if pos > end:
+                    raise IndexError(pos)
+                filled += copies
+                if build:
+                    tile = tiles.get(record)
+                    if tile is None:
+                        tile = tiles[record] = self._tileOf(record)
+                    if copies == 1:
+                        column.append(tile)
+                    else:
+                        column.extend([tile] * copies)
+        except (IndexError, StructError):
+            raise ValueError("World file ends within column %d" % (
+                self.column,))
+        if filled != height:
+            raise ValueError("Column %d has %d tiles instead of %d" % (
+                self.column, filled, height))
+        self._pos = pos
+        self.column += 1
+        return column
+
+    def _tileOf(self, record):
+        """
+        Builds the tile a record describes. Tiles which are not stored
+        lighted are lighted, like those of generated worlds.
+        """
+        if record[0] != "\0":
+            tileType = ord(record[1])
+            active = True
+            if self._important[tileType]:
+                frameX, frameY = self.FRAMES.unpack_from(record, 2)
+                pos = 6
+            else:
+                frameX = frameY = -1
+                pos = 2
+        else:
+            # matches airTile when there is no wall or liquid either
+            tileType = TileType.Air
+            active = False
+            frameX = frameY = 0
+            pos = 1
+        isLighted = True
+        if self.hasLighted:
+            isLighted = record[pos] != "\0"
+            pos += 1
+        wall = 0
+        if record[pos] != "\0":
+            wall = ord(record[pos + 1])
+            pos += 2
+        else:
+            pos += 1
+        liquid = 0
+        isLava = False
+        if record[pos] != "\0":
+            liquid = ord(record[pos + 1])
+            isLava = record[pos + 2] != "\0"
+        return Tile(tileType, frameX, frameY, wall, liquid, isLava,
+                    isLighted, active)
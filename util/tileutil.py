@@ -4,15 +4,17 @@ log = logging.getLogger()
 
 
 def dumpTile(pos, tile):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
     log.debug("======Tile Data=====")
-    log.debug("Pos: " + str(pos[0]) + ", " + str(pos[1]))
-    log.debug("Type: " + str(tile.tileType))
-    log.debug("Active: " + str(tile.isActive))
-    log.debug("FrameX: " + str(tile.frameX))
-    log.debug("FrameY: " + str(tile.frameY))
-    log.debug("Wall: " + str(tile.wall))
-    log.debug("Lava: " + str(tile.isLava))
-    log.debug("Lighted: " + str(tile.isLighted))
-    log.debug("Liquid: " + str(tile.liquid))
-    log.debug("Flags: " + str(tile.getFlags()))
+    log.debug("Pos: %s, %s", pos[0], pos[1])
+    log.debug("Type: %s", tile.tileType)
+    log.debug("Active: %s", tile.active)
+    log.debug("FrameX: %s", tile.frameX)
+    log.debug("FrameY: %s", tile.frameY)
+    log.debug("Wall: %s", tile.wall)
+    log.debug("Lava: %s", tile.isLava)
+    log.debug("Lighted: %s", tile.isLighted)
+    log.debug("Liquid: %s", tile.liquid)
+    log.debug("Flags: %s", tile.getFlags())
     log.debug("=====    End =======")
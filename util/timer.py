@@ -1,9 +1,79 @@
+import os
+import sys
 import time
 
 # Number of milliseconds in one minute
 MS_PER_MIN = 1000
 
 
+def _posixMonotonic():
+    """
+    Returns a clock_gettime(CLOCK_MONOTONIC) based clock, or C{None} if
+    it is not available on this platform.
+    """
+
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    if sys.platform.startswith('linux'):
+        clockId = 1
+    elif sys.platform == 'darwin':
+        clockId = 6
+    else:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        library = ctypes.CDLL(
+            ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+            use_errno=True)
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        spec = timespec()
+        if clock_gettime(clockId, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+
+def _clampedTime():
+    """
+    Falls back to time.time(), never letting the result go backwards.
+    """
+
+    last = [time.time()]
+
+    def monotonic():
+        now = time.time()
+        if now < last[0]:
+            now = last[0]
+        last[0] = now
+        return now
+
+    return monotonic
+
+
+# A high resolution time in seconds that never goes backwards. Only the
+# difference between two results is meaningful.
+monotonic = getattr(time, 'monotonic', None) or _posixMonotonic() or \
+    _clampedTime()
+
+
 class Timer(object):
     """
     A simple timer class to keep track of
@@ -42,12 +112,12 @@ class Timer(object):
     def resume(self):
         if self.paused:
             self.paused = False
-            self.startTicks = self.__timeMs() - self.startTicks
+            self.startTicks = self.__timeMs() - self.pausedTicks
             self.pausedTicks = 0
 
     def __timeMs(self):
         """
-        Helper method because time.time() returns seconds
+        Helper method because monotonic() returns seconds
         We care about milliseconds
         """
-        return time.time() * MS_PER_MIN
+        return monotonic() * MS_PER_MIN
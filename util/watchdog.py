@@ -0,0 +1,136 @@
+import logging
+import os
+import select
+import sys
+import threading
+import traceback
+
+from twisted.internet.task import LoopingCall
+
+from util import activity
+from util.metrics import Histogram
+from util.timer import monotonic
+
+logger = logging.getLogger()
+
+# Upper bounds (in seconds) of the reactor lag histogram buckets
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0)
+
+# Slack (in seconds) added to the watching thread's sleeps
+MIN_WAIT = 0.01
+
+
+class Watchdog(object):
+    """
+    Detects when the reactor thread stops servicing its event loop.
+
+    A heartbeat scheduled on the reactor every C{interval} seconds
+    records when it last ran and how late it was. A daemon thread sleeps
+    until the next heartbeat is C{threshold} seconds overdue; if it still
+    has not run by then, the reactor thread's stack is captured with
+    C{sys._current_frames} and logged along with the current
+    L{util.activity} label. Each stall is logged once. The interval is
+    coarse so an idle server only wakes up about once a second, while
+    stalls are still caught C{threshold} seconds in.
+
+    The thread sleeps in C{select} on a pipe which L{stop} writes to,
+    rather than in C{threading.Event.wait}: on Python 2 a wait with a
+    timeout polls, waking up every few milliseconds.
+
+    @ivar lagHistogram: A L{Histogram} of how late each heartbeat ran.
+    @ivar stalls: Number of stalls detected.
+    @ivar longestStall: The longest heartbeat delay seen, in seconds.
+    """
+
+    def __init__(self, reactor, threshold=0.25, interval=1.0):
+        self.reactor = reactor
+        self.threshold = threshold
+        self.interval = interval
+        self.lagHistogram = Histogram(LAG_BUCKETS)
+        self.stalls = 0
+        self.longestStall = 0.0
+        self._lastBeat = None
+        self._reactorThreadId = None
+        self._reported = False
+        self._stopped = False
+        self._wakeup = None
+        self._heartbeat = None
+        self._thread = None
+
+    def start(self):
+        """
+        Starts watching. Must be called from the reactor thread.
+        """
+
+        self._reactorThreadId = threading.current_thread().ident
+        self._stopped = False
+        self._wakeup = os.pipe()
+        self._heartbeat = LoopingCall(self._beat)
+        self._heartbeat.clock = self.reactor
+        self._heartbeat.start(self.interval, now=True)
+        self._thread = threading.Thread(
+            target=self._watch, name="Watchdog")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        if self._thread is not None:
+            os.write(self._wakeup[1], b"x")
+            self._thread.join()
+            self._thread = None
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def _sleep(self, timeout):
+        """
+        Sleeps for C{timeout} seconds, or until L{stop} is called.
+        """
+        select.select([self._wakeup[0]], [], [], timeout)
+
+    def _beat(self):
+        now = monotonic()
+        if self._lastBeat is not None:
+            lag = max(0.0, now - self._lastBeat - self.interval)
+            self.lagHistogram.observe(lag)
+            if lag > self.longestStall:
+                self.longestStall = lag
+            if self._reported:
+                logger.warning("Reactor recovered after a %.3fs stall", lag)
+        self._reported = False
+        self._lastBeat = now
+
+    def _watch(self):
+        while not self._stopped:
+            lastBeat = self._lastBeat
+            if lastBeat is None or self._reported:
+                self._sleep(self.interval)
+                continue
+            overdue = monotonic() - lastBeat - self.interval
+            if overdue > self.threshold:
+                self._reported = True
+                self.stalls += 1
+                self._reportStall(overdue)
+            else:
+                # wake up just as the next heartbeat becomes overdue
+                self._sleep(self.threshold - overdue + MIN_WAIT)
+
+    def _reportStall(self, overdue):
+        label = activity.current
+        frame = sys._current_frames().get(self._reactorThreadId)
+        if frame is None:
+            stack = "  (reactor thread not found)\n"
+        else:
+            stack = "".join(traceback.format_stack(frame))
+        logger.warning(
+            "Reactor stalled for %.3fs while handling %s:\n%s",
+            overdue, label or "nothing in particular", stack)
+
+    def report(self):
+        return ["reactor lag: %s stalls=%d longest=%.3fs" % (
+            self.lagHistogram.summary(), self.stalls, self.longestStall)]
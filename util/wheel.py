@@ -0,0 +1,300 @@
+from __future__ import absolute_import
+
+import math
+
+from zope.interface import implements
+from twisted.internet.interfaces import IDelayedCall
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+
+# Each level of the wheel has 2 ** SLOT_BITS slots
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 5
+
+# Tolerance used when converting times to ticks so that float noise does
+# not push a call into the following tick
+TICK_EPSILON = 1e-9
+
+
+class WheelCall(object):
+    """
+    A call scheduled on a L{TimingWheel}.
+
+    @ivar time: The time (in seconds) at which the call is due.
+    @ivar tick: The wheel tick on which the call will run.
+    """
+
+    implements(IDelayedCall)
+
+    __slots__ = (
+        'time', 'tick', 'func', 'args', 'kw', 'seq', 'called',
+        'cancelled', '_wheel', '_slot', '_level')
+
+    def __init__(self, wheel, time, func, args, kw):
+        self._wheel = wheel
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.called = False
+        self.cancelled = False
+        self._slot = None
+        self._level = None
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self.cancelled = True
+        self._wheel._remove(self)
+
+    def reset(self, secondsFromNow):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self._wheel._remove(self)
+        self._wheel._insert(self, self._wheel.seconds() + secondsFromNow)
+        self._wheel._rescheduled()
+
+    def delay(self, secondsLater):
+        if self.cancelled:
+            raise AlreadyCancelled
+        if self.called:
+            raise AlreadyCalled
+        self._wheel._remove(self)
+        self._wheel._insert(self, self.time + secondsLater)
+        self._wheel._rescheduled()
+
+    def __repr__(self):
+        return "<WheelCall %s at %r (tick %d)>" % (
+            getattr(self.func, '__name__', self.func), self.time, self.tick)
+
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel.
+
+    Calls are bucketed by tick into L{LEVELS} wheels of L{SLOTS} slots;
+    level n covers calls due within C{SLOTS ** (n + 1)} ticks. Each slot is
+    a dict keyed by sequence number, so scheduling and cancelling are O(1).
+    When the lower wheel wraps around, the matching slot of the wheel
+    above is cascaded down. Runs of empty ticks are skipped a whole slot
+    range at a time.
+
+    @ivar granularity: Number of ticks per second.
+    @ivar tick: The tick currently (or most recently) being run.
+    @ivar seconds: Callable returning the current time, used by
+        L{WheelCall.reset}.
+    @ivar rescheduled: Callable run after L{WheelCall.reset} or
+        L{WheelCall.delay} moved a call, so the owner can re-arm its timer
+        as it does after scheduling, or C{None}.
+    """
+
+    def __init__(self, granularity, seconds, rescheduled=None):
+        self.granularity = granularity
+        self.seconds = seconds
+        self.rescheduled = rescheduled
+        self.tick = 0
+        self._current = 0
+        self._seq = 0
+        self._levels = [[{} for i in xrange(SLOTS)] for l in xrange(LEVELS)]
+        self._counts = [0] * LEVELS
+        self._overflow = {}
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+    def toTick(self, time):
+        """
+        Converts a time in seconds to the first tick at or after it.
+        """
+
+        return int(math.ceil(time * self.granularity - TICK_EPSILON))
+
+    def schedule(self, time, func, args, kw):
+        """
+        Schedules C{func(*args, **kw)} to run at C{time}.
+
+        @return: a L{WheelCall}
+        """
+
+        call = WheelCall(self, time, func, args, kw)
+        self._insert(call, time)
+        return call
+
+    def _insert(self, call, time):
+        self._seq += 1
+        call.seq = self._seq
+        call.time = time
+        call.tick = tick = max(self.toTick(time), self._current)
+
+        delta = tick - self._current
+        level = 0
+        while level < LEVELS:
+            if delta < 1 << (SLOT_BITS * (level + 1)):
+                slot = self._levels[level][
+                    (tick >> (SLOT_BITS * level)) & SLOT_MASK]
+                break
+            level += 1
+        else:
+            slot = self._overflow
+
+        slot[call.seq] = call
+        call._slot = slot
+        call._level = level
+        if level < LEVELS:
+            self._counts[level] += 1
+        self._pending += 1
+
+    def _rescheduled(self):
+        if self.rescheduled is not None:
+            self.rescheduled()
+
+    def _remove(self, call):
+        slot = call._slot
+        if slot is None:
+            return
+        del slot[call.seq]
+        call._slot = None
+        if call._level < LEVELS:
+            self._counts[call._level] -= 1
+        self._pending -= 1
+
+    def _cascade(self, tick):
+        """
+        Moves the calls of every higher level slot which starts at C{tick}
+        down the wheel. Higher levels go first so their calls land in
+        slots that are cascaded straight after.
+        """
+
+        levels = []
+        level = 1
+        while level < LEVELS and not tick & ((1 << (SLOT_BITS * level)) - 1):
+            levels.append(level)
+            level += 1
+
+        if level == LEVELS and self._overflow:
+            overflow = self._overflow.values()
+            self._overflow.clear()
+            for call in overflow:
+                self._pending -= 1
+                self._insert(call, call.time)
+
+        for level in reversed(levels):
+            slot = self._levels[level][(tick >> (SLOT_BITS * level)) & SLOT_MASK]
+            if not slot:
+                continue
+            calls = slot.values()
+            slot.clear()
+            self._counts[level] -= len(calls)
+            self._pending -= len(calls)
+            for call in calls:
+                self._insert(call, call.time)
+
+    def _skipTarget(self, current, lastTick):
+        """
+        Returns the next tick at or after C{current} which may have work,
+        given which levels are empty.
+        """
+
+        if not self._pending:
+            return lastTick + 1
+
+        # Overflow calls are cascaded on top level boundaries, so never
+        # skip further than one of those
+        level = 0
+        while level < LEVELS - 1 and not self._counts[level]:
+            level += 1
+        if level == 0:
+            return current
+
+        unit = 1 << (SLOT_BITS * level)
+        if not current & (unit - 1):
+            return current
+        return min(((current >> (SLOT_BITS * level)) + 1) << (SLOT_BITS * level),
+                   lastTick + 1)
+
+    def runUntil(self, time):
+        """
+        Runs every call due on or before the tick containing C{time}.
+        Calls within a tick run in order of due time, then scheduling
+        order. If a call raises, the exception propagates and the calls
+        after it are left pending.
+        """
+
+        lastTick = int(math.floor(time * self.granularity + TICK_EPSILON))
+        level0 = self._levels[0]
+        while self._current <= lastTick:
+            current = self._current
+            if not current & SLOT_MASK:
+                self._cascade(current)
+
+            slot = level0[current & SLOT_MASK]
+            self.tick = current
+            while slot:
+                calls = slot.values()
+                slot.clear()
+                self._counts[0] -= len(calls)
+                self._pending -= len(calls)
+                calls.sort(key=lambda c: (c.time, c.seq))
+                for call in calls:
+                    call._slot = None
+                for i, call in enumerate(calls):
+                    if call.cancelled:
+                        continue
+                    call.called = True
+                    try:
+                        call.func(*call.args, **call.kw)
+                    except:
+                        # like task.Clock, the calls left stay pending
+                        # and run on the next runUntil
+                        for later in calls[i + 1:]:
+                            if not later.cancelled:
+                                self._insert(later, later.time)
+                        raise
+
+            self._current = self._skipTarget(current + 1, lastTick)
+
+    def nextTime(self):
+        """
+        A lower bound on the time of the earliest pending call, or C{None}
+        if nothing is scheduled. It is exact when the call is due within
+        the next L{SLOTS} ticks.
+        """
+
+        if not self._pending:
+            return None
+
+        for level in xrange(LEVELS):
+            if not self._counts[level]:
+                continue
+            shift = SLOT_BITS * level
+            base = self._current >> shift
+            slots = self._levels[level]
+            for offset in xrange(SLOTS):
+                if slots[(base + offset) & SLOT_MASK]:
+                    tick = max(self._current, (base + offset) << shift)
+                    return float(tick) / self.granularity
+
+        # Only overflow calls are left; the next top level boundary is the
+        # earliest point at which they get cascaded
+        shift = SLOT_BITS * (LEVELS - 1)
+        tick = ((self._current >> shift) + 1) << shift
+        return float(tick) / self.granularity
+
+    def getDelayedCalls(self):
+        calls = self._overflow.values()
+        for slots in self._levels:
+            for slot in slots:
+                calls.extend(slot.itervalues())
+        return calls
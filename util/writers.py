@@ -0,0 +1,232 @@
+import os
+from itertools import groupby
+from struct import Struct, pack
+
+from game.tiles import airTile, SECTION_WIDTH, SECTION_HEIGHT
+
+byteOrder = "<"
+int32Format = byteOrder + "i"
+ucharFormat = byteOrder + "B"
+doubleFormat = byteOrder + "d"
+boolFormat = byteOrder + "?"
+
+# Format version of the world files written: the newest whose layout
+# after the tiles holds nothing the server does not model
+EXPORT_VERSION = 30
+# Chests and signs a world file has room for
+MAX_CHESTS = 1000
+MAX_SIGNS = 1000
+
+
+class TerrariaFileWriter(object):
+    """
+    Base object for writing various Terraria files
+    """
+
+    fileHandle = None
+
+    def _write(self, format, value):
+        self.fileHandle.write(pack(format, value))
+
+    def writeInt32(self, value):
+        self._write(int32Format, value)
+
+    def writeUChar(self, value):
+        self._write(ucharFormat, value)
+
+    def writeDouble(self, value):
+        self._write(doubleFormat, value)
+
+    def writeBoolean(self, value):
+        self._write(boolFormat, value)
+
+    def writeString(self, value):
+        """
+        Writes a string prefixed with its length in 7 bit groups, as .NET
+        reads them.
+        """
+        length = len(value)
+        while length >= 0x80:
+            self.writeUChar(length & 0x7f | 0x80)
+            length >>= 7
+        self.writeUChar(length)
+        self.fileHandle.write(value)
+
+
+class WorldFileWriter(TerrariaFileWriter):
+    """
+    Writes a L{World} to a file in Terraria's format (version
+    L{EXPORT_VERSION}), as read by L{WorldFileReader}.
+
+    The world may be a L{World} nothing else changes meanwhile, or a
+    L{WorldSnapshot} of a live one. Its tiles may also come from another
+    source of section columns, such as
+    L{WorldRepository.readSectionColumns}, so a world need not be held in
+    memory to be written. Tiles are written one column at a
+    time, read straight from the column's sections, with runs of the same
+    tile written once along with their length. A few distinct runs make
+    up most of a world, so their encodings are kept for reuse. Output
+    goes through a L{BUFFER_SIZE} file buffer, so the memory used is the
+    same whatever the size of the world. Chests, signs and NPCs are not
+    modelled by the server, so the file has none.
+    """
+
+    BUFFER_SIZE = 1 << 20
+    COPIES = Struct("<h")
+    FRAMES = Struct("<hh")
+    # longest run a record can stand for
+    MAX_COPIES = 0x8000
+    # encoded runs kept for reuse
+    MAX_RUNS = 1 << 16
+
+    def __init__(self, worldFilePath):
+        self.worldFilePath = worldFilePath
+        self._runs = {}
+
+    def writeWorld(self, world, sectionColumns=None):
+        """
+        Writes the file, replacing it only once it is complete.
+
+        @param sectionColumns: An iterable of the world's section columns,
+            left to right (see L{writeTiles}), the columns of
+            C{world.tileSections} by default.
+        @return: the number of bytes written
+        """
+        partial = self.worldFilePath + ".partial"
+        self.fileHandle = open(partial, 'wb', self.BUFFER_SIZE)
+        try:
+            self.writeHeader(world)
+            self.writeTiles(world, sectionColumns)
+            self.writeTrailer(world)
+            self.fileHandle.flush()
+            os.fsync(self.fileHandle.fileno())
+            size = self.fileHandle.tell()
+        except Exception:
+            self.fileHandle.close()
+            os.remove(partial)
+            raise
+        self.fileHandle.close()
+        os.rename(partial, self.worldFilePath)
+        return size
+
+    def writeHeader(self, w):
+        self.writeInt32(EXPORT_VERSION)
+        self.writeString(w.name)
+        self.writeInt32(w.worldId)
+        self.writeInt32(w.leftWorld)
+        self.writeInt32(w.rightWorld)
+        self.writeInt32(w.topWorld)
+        self.writeInt32(w.bottomWorld)
+        self.writeInt32(w.height)
+        self.writeInt32(w.width)
+        self.writeInt32(w.spawn[0])
+        self.writeInt32(w.spawn[1])
+        self.writeDouble(w.worldSurface)
+        self.writeDouble(w.rockLayer)
+        self.writeDouble(w.time)
+        self.writeBoolean(w.isDay)
+        self.writeInt32(w.moonPhase)
+        self.writeBoolean(w.isBloodMoon)
+        self.writeInt32(w.dungeonX)
+        self.writeInt32(w.dungeonY)
+        self.writeBoolean(w.bossOneDowned)
+        self.writeBoolean(w.bossTwoDowned)
+        self.writeBoolean(w.bossThreeDowned)
+        self.writeBoolean(False)  # saved goblin
+        self.writeBoolean(False)  # saved wizard
+        self.writeBoolean(False)  # goblins downed
+        self.writeBoolean(w.shadowOrbSmashed)
+        self.writeBoolean(w.spawnMeteor)
+        self.writeUChar(w.shadowOrbCount)
+        self.writeInt32(0)  # altars smashed
+        self.writeBoolean(False)  # hard mode
+        self.writeInt32(w.invasionDelay)
+        self.writeInt32(w.invasionSize)
+        self.writeInt32(w.invasionType)
+        self.writeDouble(w.invasionX)
+
+    def writeTiles(self, world, sectionColumns=None):
+        """
+        Writes the world's tiles.
+
+        @param sectionColumns: An iterable of the world's section columns,
+            left to right, each a list of the tiles of its sections, top to
+            bottom, or C{None} for a section which was never allocated.
+            Each column is let go of once its tiles are written.
+        """
+        if sectionColumns is None:
+            sectionColumns = self._sectionColumns(world)
+        columns = iter(sectionColumns)
+        rows = -(-world.height // SECTION_HEIGHT)
+        # stands in for sections which were never allocated or are
+        # missing
+        emptyTiles = [airTile] * (SECTION_WIDTH * SECTION_HEIGHT)
+        write = self.fileHandle.write
+        for x in xrange(0, world.width, SECTION_WIDTH):
+            column = next(columns, [])
+            sectionTiles = []
+            for y in xrange(rows):
+                tiles = column[y] if y < len(column) else None
+                sectionTiles.append(emptyTiles if tiles is None else tiles)
+            for tx in xrange(min(SECTION_WIDTH, world.width - x)):
+                tiles = []
+                for sectionTile in sectionTiles:
+                    tiles.extend(sectionTile[tx::SECTION_WIDTH])
+                del tiles[world.height:]
+                write(self._encodeColumn(tiles))
+
+    def _sectionColumns(self, world):
+        for column in world.tileSections:
+            yield [None if section is None else section.tiles
+                   for section in column]
+
+    def _encodeColumn(self, tiles):
+        runs = self._runs
+        parts = []
+        for tile, run in groupby(tiles):
+            key = (tile, len(list(run)))
+            encoded = runs.get(key)
+            if encoded is None:
+                if len(runs) >= self.MAX_RUNS:
+                    runs.clear()
+                encoded = runs[key] = self._encodeRun(*key)
+            parts.append(encoded)
+        return "".join(parts)
+
+    def _encodeRun(self, tile, copies):
+        record = self._record(tile)
+        parts = []
+        while copies > 0:
+            count = min(copies, self.MAX_COPIES)
+            parts.append(record + self.COPIES.pack(count - 1))
+            copies -= count
+        return "".join(parts)
+
+    def _record(self, tile):
+        """
+        Encodes a tile as a world file record, without its repeat count
+        (see L{TileColumnReader}).
+        """
+        if tile.active:
+            record = pack("<?B", True, tile.tileType)
+            if tile.important:
+                record += self.FRAMES.pack(tile.frameX, tile.frameY)
+        else:
+            record = pack("<?", False)
+        if tile.wall > 0:
+            record += pack("<?B", True, tile.wall)
+        else:
+            record += pack("<?", False)
+        if tile.liquid > 0:
+            record += pack("<?B?", True, tile.liquid, tile.isLava)
+        else:
+            record += pack("<?", False)
+        return record
+
+    def writeTrailer(self, w):
+        self.fileHandle.write("\0" * (MAX_CHESTS + MAX_SIGNS))
+        self.writeBoolean(False)  # no more NPCs
+        # lets the game tell the file was written out completely
+        self.writeBoolean(True)
+        self.writeString(w.name)
+        self.writeInt32(w.worldId)
@@ -0,0 +1,132 @@
+import sys, getopt
+
+from twisted.internet.task import react
+
+from db.adapters import DatabaseAdapter
+from db.backups import BackupStore, backupWorld, restoreWorld
+from db.repositories import WorldRepository
+from config.database import SimpleDatabaseConfig
+
+def usage():
+  print "Terraria World Backup"
+  print "Usage: world_backup.py [OPTIONS] COMMAND"
+  print ""
+  print "Commands:"
+  print ""
+  print "backup WORLD\tBack up the named world as it was last saved"
+  print ""
+  print "list [WORLD]\tList the backups, of one world only if given"
+  print ""
+  print "verify [BACKUP]\tCheck that a backup, or all of them, can be restored"
+  print ""
+  print "restore BACKUP\tReplace the saved world with a backup. Stop the server first"
+  print ""
+  print "prune COUNT\tKeep the COUNT newest backups of each world and delete what else they do not use"
+  print ""
+  print "Options:"
+  print ""
+  print "--store\t\tThe backup directory (default: backups)"
+  print ""
+  print "--dbtype\tThe database type. Valid types: sqlite, mysql, postgresql, oracle, mssql"
+  print ""
+  print "--dbname\tThe database name. If dbtype is sqlite then this should be the relative path to the database file"
+  print ""
+  print "--dbuser\t(OPTIONAL) The user to connect to the database as. Not used for sqlite"
+  print ""
+  print "--dbpass\t(OPTIONAL) The password used to connect to the database. Not used for sqlite"
+  print ""
+  print "--dbhost\t(OPTIONAL) The host name of the database server. Not used for sqlite"
+  print ""
+  print "--dbport\t(OPTIONAL) The port of the database server. Not used for sqlite"
+
+def listBackups(store, worldName=None):
+  for name in store.manifests(worldName):
+    manifest = store.readManifest(name)
+    print "%s\t%d sections" % (name, len(manifest['sections']))
+  return 0
+
+def verifyBackups(store, name=None):
+  names = [name] if name else store.manifests()
+  problems = []
+  for name in names:
+    problems.extend(store.verify(name))
+  for problem in problems:
+    print problem
+  print "%d backups checked, %d problems" % (len(names), len(problems))
+  return 1 if problems else 0
+
+def pruneBackups(store, keep):
+  manifests, objects, freed = store.prune(keep)
+  print "%d backups and %d objects deleted, %d bytes freed" % (
+    manifests, objects, freed)
+  return 0
+
+def runWithDatabase(dbConfig, func, *args):
+  def run(reactor):
+    adapter = DatabaseAdapter(dbConfig)
+    adapter.start()
+    return func(WorldRepository(adapter), *args)
+  react(run)
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "store=", "dbtype=", "dbname=", "dbuser=", "dbpass=", "dbhost=", "dbport="])
+  except getopt.GetoptError, err:
+    print str(err)
+    usage()
+    sys.exit(2)
+  storeDir = "backups"
+  dbType = "sqlite"
+  dbName = None
+  dbUser = None
+  dbHost = None
+  dbPass = None
+  dbPort = None
+  for o, a in opts:
+    if o == "--store":
+      storeDir = a
+    elif o == "--dbtype":
+      dbType = a
+    elif o == "--dbname":
+      dbName = a
+    elif o == "--dbuser":
+      dbUser = a
+    elif o == "--dbpass":
+      dbPass = a
+    elif o == "--dbhost":
+      dbHost = a
+    elif o == "--dbport":
+      dbPort = a
+    elif o in ("-h", "--help"):
+      usage()
+      sys.exit()
+  if not args:
+    usage()
+    sys.exit(2)
+
+  store = BackupStore(storeDir)
+  command, args = args[0], args[1:]
+  if command == "list":
+    sys.exit(listBackups(store, *args[:1]))
+  elif command == "verify":
+    sys.exit(verifyBackups(store, *args[:1]))
+  elif command == "prune" and len(args) == 1:
+    sys.exit(pruneBackups(store, int(args[0])))
+
+  c = SimpleDatabaseConfig(dbType, dbName, dbUser, dbPass, dbHost, dbPort)
+  if command == "backup" and len(args) == 1:
+    def backedUp(result):
+      print result.describe()
+    runWithDatabase(
+      c, lambda repository: backupWorld(repository, store, args[0]).addCallback(backedUp))
+  elif command == "restore" and len(args) == 1:
+    def restored((written, size)):
+      print "%d sections, %d bytes restored" % (written, size)
+    runWithDatabase(
+      c, lambda repository: restoreWorld(repository, store, args[0]).addCallback(restored))
+  else:
+    usage()
+    sys.exit(2)
+
+if __name__ == "__main__":
+  main()
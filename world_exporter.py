@@ -0,0 +1,100 @@
+import sys, getopt
+
+from twisted.internet.task import react
+
+from db.adapters import DatabaseAdapter
+from db.repositories import WorldRepository
+from config.database import SimpleDatabaseConfig
+from game.world import World
+from util.writers import WorldFileWriter
+
+def usage():
+  print "Terraria World Exporter"
+  print "Usage: world_exporter.py [OPTIONS]"
+  print ""
+  print "Writes a world saved in the database to a Terraria world file."
+  print ""
+  print "Options:"
+  print ""
+  print "--worldname\tThe name of the world to export"
+  print ""
+  print "--worldfile\tThe world file (.wld) to write"
+  print ""
+  print "--dbtype\tThe database type. Valid types: sqlite, mysql, postgresql, oracle, mssql"
+  print ""
+  print "--dbname\tThe database name to export from. If dbtype is sqlite then this should be the relative path to the database file"
+  print ""
+  print "--dbuser\t(OPTIONAL) The user to connect to the database as. Not used for sqlite"
+  print ""
+  print "--dbpass\t(OPTIONAL) The password used to connect to the database. Not used for sqlite"
+  print ""
+  print "--dbhost\t(OPTIONAL) The host name of the database server. Not used for sqlite"
+  print ""
+  print "--dbport\t(OPTIONAL) The port of the database server. Not used for sqlite"
+
+def exportWorld(worldName, worldfile, c):
+  def run(reactor):
+    adapter = DatabaseAdapter(c)
+    adapter.start()
+    repository = WorldRepository(adapter)
+    world = World()
+    world.name = worldName
+    def gotWorld(world):
+      if world.worldId <= 0:
+        raise ValueError("There is no world named %r" % (world.name,))
+      # streams the sections from the database a column at a time, so
+      # the whole world is never in memory
+      writer = WorldFileWriter(worldfile)
+      return repository.readSectionColumns(
+        world, lambda columns: writer.writeWorld(world, columns))
+    def written(size):
+      print "%s: %d bytes written" % (worldfile, size)
+    d = repository.getWorld(world)
+    d.addCallback(gotWorld)
+    d.addCallback(written)
+    return d
+  react(run)
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "dbtype=", "dbname=", "dbuser=", "dbpass=", "dbhost=", "dbport=", "worldname=", "worldfile="])
+  except getopt.GetoptError, err:
+    print str(err)
+    usage()
+    sys.exit(2)
+  dbType = "sqlite"
+  dbName = None
+  dbUser = None
+  dbHost = None
+  dbPass = None
+  dbPort = None
+  worldName = None
+  worldfile = None
+  for o, a in opts:
+    if o == "--dbtype":
+      dbType = a
+    elif o == "--dbname":
+      dbName = a
+    elif o == "--dbuser":
+      dbUser = a
+    elif o == "--dbpass":
+      dbPass = a
+    elif o == "--dbhost":
+      dbHost = a
+    elif o == "--dbport":
+      dbPort = a
+    elif o == "--worldname":
+      worldName = a
+    elif o == "--worldfile":
+      worldfile = a
+    elif o in ("-h", "--help"):
+      usage()
+      sys.exit()
+  if worldName is None or worldfile is None or dbName is None:
+    usage()
+    sys.exit(2)
+  c = SimpleDatabaseConfig(dbType, dbName, dbUser, dbPass, dbHost, dbPort)
+  exportWorld(worldName, worldfile, c)
+
+if __name__ == "__main__":
+  main()
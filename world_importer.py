@@ -1,18 +1,26 @@
 import sys, getopt
 
+from twisted.internet.task import react
 
-from game.services import WorldService
-from db.repositories import WorldRepository
 from db.adapters import DatabaseAdapter
+from db.importer import WorldImporter, DEFAULT_BATCH_COLUMNS
+from db.repositories import WorldRepository
 from config.database import SimpleDatabaseConfig
-from game.world import World
 
 def usage():
   print "Terraria World Importer"
   print "Usage: world_importer.py [OPTIONS]"
   print ""
+  print "Imports a world file into the database. An interrupted import carries on where it left off when run again."
+  print ""
   print "Options:"
   print ""
+  print "--worldfile\tThe world file (.wld) to import"
+  print ""
+  print "--workers\t(OPTIONAL) Processes decoding the world's tiles in parallel (default: 0, decode them in this process)"
+  print ""
+  print "--batch\t\t(OPTIONAL) Columns of tile sections written per transaction (default: %d)" % (DEFAULT_BATCH_COLUMNS,)
+  print ""
   print "--dbtype\tThe database type. Valid types: sqlite, mysql, postgresql, oracle, mssql"
   print ""
   print "--dbname\tThe database name to import into.If dbtype is sqlite then this should be the relative path to the database file"
@@ -25,26 +33,39 @@ def usage():
   print ""
   print "--dbport\t(OPTIONAL) The port of the database server. Not used for sqlite"
 
-def importWorldFile(worldfile, c):
-  w = World()
-  
-  
-  
+def printProgress(importer):
+  print importer.describe()
+  sys.stdout.flush()
+
+def importWorldFile(worldfile, c, workers, batchColumns):
+  def run(reactor):
+    adapter = DatabaseAdapter(c)
+    adapter.start()
+    importer = WorldImporter(
+      WorldRepository(adapter), worldfile, workers, batchColumns,
+      printProgress)
+    def done(importer):
+      print "Done:", importer.describe()
+    return importer.run().addCallback(done)
+  react(run)
+
 def main():
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "hx", ["help", "dbtype=", "dbname=", "dbuser=", "dbpass=", "dbhost=", "dbport=", "worldfile="])
+    opts, args = getopt.getopt(sys.argv[1:], "hx", ["help", "dbtype=", "dbname=", "dbuser=", "dbpass=", "dbhost=", "dbport=", "worldfile=", "workers=", "batch="])
   except getopt.GetoptError, err:
     # print help information and exit:
     print str(err) # will print something like "option -a not recognized"
     usage()
     sys.exit(2)
-  dbType = None
+  dbType = "sqlite"
   dbName = None
   dbUser = None
   dbHost = None
   dbPass = None
   dbPort = None
   worldfile = None
+  workers = 0
+  batchColumns = DEFAULT_BATCH_COLUMNS
   for o, a in opts:
     if o == "--dbtype":
       dbType = a
@@ -54,17 +75,26 @@ def main():
       dbUser = a
     elif o == "--dbpass":
       dbPass = a
+    elif o == "--dbhost":
+      dbHost = a
     elif o == "--dbport":
       dbPort = a
-    elif o == "--worldfile=":
+    elif o == "--worldfile":
       worldfile = a
+    elif o == "--workers":
+      workers = int(a)
+    elif o == "--batch":
+      batchColumns = max(1, int(a))
     elif o in ("-h", "--help"):
       usage()
       sys.exit()
     else:
       assert False, "unhandled option"
-  c = SimpleDatabaseConfig(dbType, dbName, userName, dbPass, dbHost, dbPort)
-  importWorldFile(worldfile, c)
+  if worldfile is None or dbName is None:
+    usage()
+    sys.exit(2)
+  c = SimpleDatabaseConfig(dbType, dbName, dbUser, dbPass, dbHost, dbPort)
+  importWorldFile(worldfile, c, workers, batchColumns)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()